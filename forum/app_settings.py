@@ -9,6 +9,25 @@ STANDALONE              = getattr(settings, 'FORUM_STANDALONE',              Fal
 DEFAULT_POSTS_PER_PAGE  = getattr(settings, 'FORUM_DEFAULT_POSTS_PER_PAGE',  20)
 DEFAULT_TOPICS_PER_PAGE = getattr(settings, 'FORUM_DEFAULT_TOPICS_PER_PAGE', 30)
 POST_FORMATTER          = getattr(settings, 'FORUM_POST_FORMATTER',          'forum.formatters.PostFormatter')
+RENDER_CACHE_SIZE       = getattr(settings, 'FORUM_RENDER_CACHE_SIZE',       1000)
+RENDER_CACHE_REDIS      = getattr(settings, 'FORUM_RENDER_CACHE_REDIS',      False)
+RENDER_CACHE_TIMEOUT    = getattr(settings, 'FORUM_RENDER_CACHE_TIMEOUT',    24 * 60 * 60)
+SEARCH_BACKEND          = getattr(settings, 'FORUM_SEARCH_BACKEND',          'forum.search.SearchBackend')
+SEARCH_INDEX_BATCH_SIZE = getattr(settings, 'FORUM_SEARCH_INDEX_BATCH_SIZE', 100)
+SEARCH_INDEX_MAX_DELAY  = getattr(settings, 'FORUM_SEARCH_INDEX_MAX_DELAY',  30)
+SEARCH_RANK_CANDIDATES  = getattr(settings, 'FORUM_SEARCH_RANK_CANDIDATES',  2000)
+SEARCH_RECENCY_BOOST    = getattr(settings, 'FORUM_SEARCH_RECENCY_BOOST',    0.5)
+SEARCH_BOOST_HALF_LIFE  = getattr(settings, 'FORUM_SEARCH_BOOST_HALF_LIFE',  30)
+SEARCH_REUSE_TIMEOUT    = getattr(settings, 'FORUM_SEARCH_REUSE_TIMEOUT',    300)
+SEARCH_MAX_AGE          = getattr(settings, 'FORUM_SEARCH_MAX_AGE',          7 * 24 * 60 * 60)
+SEARCH_MAX_PER_USER     = getattr(settings, 'FORUM_SEARCH_MAX_PER_USER',     50)
+SEARCH_SWEEP_CHANCE     = getattr(settings, 'FORUM_SEARCH_SWEEP_CHANCE',     0)
+SEARCH_TIME_LIMIT       = getattr(settings, 'FORUM_SEARCH_TIME_LIMIT',       5)
+SEARCH_ROW_LIMIT        = getattr(settings, 'FORUM_SEARCH_ROW_LIMIT',        0)
+SEARCH_SCAN_CHUNK_SIZE  = getattr(settings, 'FORUM_SEARCH_SCAN_CHUNK_SIZE',  5000)
+COUNTER_FLUSH_INTERVAL  = getattr(settings, 'FORUM_COUNTER_FLUSH_INTERVAL',  0)
+USERNAME_INDEX_CHECK_INTERVAL  = getattr(settings, 'FORUM_USERNAME_INDEX_CHECK_INTERVAL',  10)
+USERNAME_INDEX_RELOAD_INTERVAL = getattr(settings, 'FORUM_USERNAME_INDEX_RELOAD_INTERVAL', 10 * 60)
 MAX_AVATAR_FILESIZE     = getattr(settings, 'FORUM_MAX_AVATAR_FILESIZE',     512 * 1024)
 ALLOWED_AVATAR_FORMATS  = getattr(settings, 'FORUM_ALLOWED_AVATAR_FORMATS',  ('GIF', 'JPEG', 'PNG'))
 MAX_AVATAR_DIMENSIONS   = getattr(settings, 'FORUM_MAX_AVATAR_DIMENSIONS',   (64, 64))
@@ -0,0 +1,161 @@
+"""
+Checking and repair of denormalised data which has drifted from the data
+it summarises, using aggregate queries rather than recalculating each
+object in turn.
+
+Discrepancies are represented as (model, object id, field name, stored
+value, expected value) five-tuples.
+"""
+from itertools import groupby
+from operator import itemgetter
+
+from django.contrib.auth.models import User
+from django.db import models, transaction
+
+from forum.models import Forum, ForumProfile, Post, Topic
+from forum.search import SQL_CHUNK_SIZE, keyset_chunks
+
+def compare(model, object_id, stored, expected):
+    """
+    Returns discrepancies between dicts of stored and expected field
+    values for an object.
+    """
+    return [(model, object_id, field_name, stored[field_name], expected[field_name])
+            for field_name in sorted(expected)
+            if stored[field_name] != expected[field_name]]
+
+def check_forum(forum):
+    """
+    Returns discrepancies in the given Forum's Topics and in the sequence
+    numbers of their Posts.
+
+    Post counts and last Post times come from aggregate queries. Sequence
+    numbers and last Post Users come from a single pass over the Forum's
+    Posts in posting order. Gaps in sequence numbers are expected, so only
+    numbers which don't increase in posting order are renumbered, from
+    the previous Post's number - except for each Topic's first Post,
+    which is expected to be numbered before Posts which were moved into
+    its Topic even if they're older.
+    """
+    expected = {}
+    for topic_id in Topic.objects.filter(forum=forum).values_list('id', flat=True):
+        expected[topic_id] = {'post_count': 0, 'metapost_count': 0,
+                              'last_post_at': None, 'last_user_id': None,
+                              'last_username': ''}
+    for stats in Post.objects.filter(topic__forum=forum) \
+                             .values('topic', 'meta') \
+                             .order_by() \
+                             .annotate(count=models.Count('id'),
+                                       last_post_at=models.Max('posted_at')):
+        topic = expected[stats['topic']]
+        if stats['meta']:
+            topic['metapost_count'] = stats['count']
+        else:
+            topic['post_count'] = stats['count']
+            topic['last_post_at'] = stats['last_post_at']
+
+    discrepancies = []
+    last_user_ids = {}
+    last_nums = {}
+    for topic_id, posts in groupby(
+            Post.objects.filter(topic__forum=forum) \
+                        .order_by('topic', 'posted_at', 'id') \
+                        .values_list('id', 'topic', 'meta', 'num_in_topic',
+                                     'user').iterator(),
+            itemgetter(1)):
+        posts = list(posts)
+        non_meta = [post for post in posts if not post[2]]
+        if non_meta:
+            last_user_ids[topic_id] = non_meta[-1][4]
+            # As for Topic.get_first_post
+            first_post = min(non_meta, key=lambda post: (post[3], post[0]))
+            posts.remove(first_post)
+            posts.insert(0, first_post)
+        previous_num = 0
+        for post_id, topic_id, meta, num_in_topic, user_id in posts:
+            if num_in_topic <= previous_num:
+                discrepancies.append((Post, post_id, 'num_in_topic',
+                                      num_in_topic, previous_num + 1))
+                num_in_topic = previous_num + 1
+            previous_num = num_in_topic
+        last_nums[topic_id] = previous_num
+    usernames = dict(User.objects.filter(pk__in=set(last_user_ids.values())) \
+                                 .values_list('id', 'username'))
+    for topic_id, user_id in last_user_ids.items():
+        expected[topic_id]['last_user_id'] = user_id
+        expected[topic_id]['last_username'] = usernames[user_id]
+
+    for stored in Topic.objects.filter(forum=forum).values(
+            'id', 'post_count', 'metapost_count', 'last_post_at',
+            'last_user_id', 'last_username', 'last_num_in_topic'):
+        # Numbers given to since deleted Posts mustn't be given out again
+        expected[stored['id']]['last_num_in_topic'] = max(
+            stored['last_num_in_topic'], last_nums.get(stored['id'], 0))
+        discrepancies.extend(compare(Topic, stored['id'], stored,
+                                     expected[stored['id']]))
+    return discrepancies
+
+def check_forums():
+    """
+    Returns discrepancies in Forums' Topic counts and last Post details.
+    """
+    topic_counts = dict(Topic.objects.values_list('forum') \
+                                     .order_by() \
+                                     .annotate(count=models.Count('id')))
+    discrepancies = []
+    for forum in Forum.objects.all():
+        expected = {'topic_count': topic_counts.get(forum.pk, 0),
+                    'last_post_at': None, 'last_topic_id': None,
+                    'last_topic_title': '', 'last_user_id': None,
+                    'last_username': ''}
+        try:
+            post = Post.objects.filter(meta=False, topic__forum=forum,
+                                       topic__hidden=False) \
+                               .select_related('topic', 'user') \
+                               .order_by('-posted_at', '-id')[0]
+            expected.update({'last_post_at': post.posted_at,
+                             'last_topic_id': post.topic_id,
+                             'last_topic_title': post.topic.title,
+                             'last_user_id': post.user_id,
+                             'last_username': post.user.username})
+        except IndexError:
+            pass
+        discrepancies.extend(compare(Forum, forum.pk, forum.__dict__, expected))
+    return discrepancies
+
+def check_profiles():
+    """
+    Returns discrepancies in ForumProfiles' Post counts, checking a chunk
+    of ForumProfiles at a time.
+    """
+    discrepancies = []
+    for profiles in keyset_chunks(
+            ForumProfile.objects.values_list('id', 'user', 'post_count'),
+            SQL_CHUNK_SIZE, descending=False):
+        post_counts = dict(Post.objects.filter(
+            user__in=[user_id for profile_id, user_id, post_count in profiles]) \
+                .values_list('user') \
+                .order_by() \
+                .annotate(count=models.Count('id')))
+        for profile_id, user_id, post_count in profiles:
+            discrepancies.extend(compare(ForumProfile, profile_id,
+                {'post_count': post_count},
+                {'post_count': post_counts.get(user_id, 0)}))
+    return discrepancies
+
+def repair(discrepancies):
+    """
+    Sets the expected values for the given discrepancies, updating Post
+    sequence numbers in a single batch and each other object once.
+    """
+    numbered_posts = []
+    updates = {}
+    for model, object_id, field_name, stored, expected in discrepancies:
+        if model is Post:
+            numbered_posts.append((object_id, expected))
+        else:
+            updates.setdefault((model, object_id), {})[field_name] = expected
+    Post.objects.update_num_in_topic(numbered_posts)
+    for (model, object_id), values in updates.items():
+        model._default_manager.filter(pk=object_id).update(**values)
+    transaction.commit_unless_managed()
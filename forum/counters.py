@@ -0,0 +1,257 @@
+"""
+Write-behind accumulation of the changes new Posts make to denormalised
+data, so replies to busy Topics don't each update the same Topic, Forum
+and ForumProfile rows.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.core import signals
+from django.db import connection, transaction
+
+from forum import app_settings
+
+qn = connection.ops.quote_name
+
+logger = logging.getLogger(__name__)
+
+# Last Post detail fields, in the order they're held in, by kind of object
+LAST_POST_FIELDS = {
+    'topic': ('last_post_at', 'last_user_id', 'last_username'),
+    'forum': ('last_post_at', 'last_user_id', 'last_username', 'last_topic_id',
+              'last_topic_title'),
+}
+
+class CounterBuffer(object):
+    """
+    Accumulates changes to Post counts and last Post details made by new
+    Posts in this process, applying them in coalesced batches once
+    ``interval`` seconds have passed since they were last applied, which
+    is checked at the end of each request while it's the counter buffer
+    in use.
+
+    Only data which is displayed is accumulated - nothing may be decided
+    from it until it's applied, as waiting changes can't be seen by other
+    processes. Post numbers are allocated by ``Topic`` instead.
+
+    Changes are held as a dict mapping (kind, object id, field name) to an
+    amount to add, where kind is ``'topic'``, ``'forum'`` or ``'profile'``
+    and the id of a ForumProfile is its User's id, and a dict mapping
+    (kind, object id) to the details of the latest Post, as listed in
+    ``LAST_POST_FIELDS``.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = {}
+        self.last_posts = {}
+        self.last_flushed_at = time.time()
+        self.lock = threading.Lock()
+
+    def add_post(self, post):
+        """
+        Records the changes a new Post makes to its Topic, its Forum and
+        its User's ForumProfile.
+        """
+        topic = post.topic
+        counts = {
+            ('topic', topic.pk, post.meta and 'metapost_count' or 'post_count'): 1,
+            ('profile', post.user_id, 'post_count'): 1,
+        }
+        last_posts = {}
+        if not post.meta:
+            details = (post.posted_at, post.user_id, post.user.username)
+            last_posts[('topic', topic.pk)] = details
+            # Don't update the forum's last post if the topic is hidden
+            if not topic.hidden:
+                last_posts[('forum', topic.forum_id)] = details + (topic.pk,
+                                                                   topic.title)
+        self.store(counts, last_posts)
+
+    def store(self, counts, last_posts):
+        """
+        Adds changes to those waiting to be applied, keeping the latest
+        last Post details for each object.
+        """
+        self.lock.acquire()
+        try:
+            for key, amount in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + amount
+            for key, details in last_posts.items():
+                if key not in self.last_posts or \
+                   details[0] >= self.last_posts[key][0]:
+                    self.last_posts[key] = details
+        finally:
+            self.lock.release()
+
+    def take(self):
+        """
+        Removes and returns all changes waiting to be applied.
+        """
+        self.lock.acquire()
+        try:
+            counts, self.counts = self.counts, {}
+            last_posts, self.last_posts = self.last_posts, {}
+        finally:
+            self.lock.release()
+        return counts, last_posts
+
+    def request_finished(self, **kwargs):
+        """
+        Applies waiting changes if ``interval`` has passed since they were
+        last applied.
+        """
+        if time.time() - self.last_flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Applies all waiting changes, using a batched update for each
+        field being counted and for each kind of last Post details.
+
+        Last Post details are only applied if they're at least as recent
+        as those already held, so batches applied out of order can't set
+        an earlier Post as the last.
+
+        If applying the changes fails, they're rolled back and put back
+        with any changes added in the meantime, to be applied by a later
+        flush, and the error is logged rather than raised - flushing
+        happens at the end of unrelated requests and at exit.
+        """
+        self.last_flushed_at = time.time()
+        counts, last_posts = self.take()
+        if not counts and not last_posts:
+            return
+        try:
+            self.apply(counts, last_posts)
+        except Exception:
+            transaction.rollback_unless_managed()
+            self.store(counts, last_posts)
+            logger.exception('Error applying counter changes - they will be '
+                             'applied by a later flush')
+
+    def apply(self, counts, last_posts):
+        """
+        Applies the given changes, as returned by ``take``.
+
+        ForumProfiles are created first for Users who don't have one, so
+        their changes aren't lost.
+        """
+        from django.contrib.auth.models import User
+        from forum.models import Forum, ForumProfile, Topic
+        models = {
+            'topic': (Topic, Topic._meta.pk.column),
+            'forum': (Forum, Forum._meta.pk.column),
+            'profile': (ForumProfile, ForumProfile._meta.get_field('user').column),
+        }
+        user_ids = set([object_id for kind, object_id, field_name in counts
+                        if kind == 'profile'])
+        if user_ids:
+            user_ids.difference_update(ForumProfile.objects.filter(
+                user__in=list(user_ids)).values_list('user', flat=True))
+        if user_ids:
+            for user in User.objects.filter(pk__in=list(user_ids)):
+                ForumProfile.objects.get_or_create(user=user)
+        cursor = connection.cursor()
+        amounts = {}
+        for (kind, object_id, field_name), amount in counts.items():
+            if amount:
+                amounts.setdefault((kind, field_name), []).append(
+                    (amount, object_id))
+        for (kind, field_name), params in amounts.items():
+            model, id_column = models[kind]
+            cursor.executemany("""
+                UPDATE %(table)s
+                SET %(count)s=%(count)s+%%s
+                WHERE %(id)s=%%s""" % {
+                    'table': qn(model._meta.db_table),
+                    'count': qn(model._meta.get_field(field_name).column),
+                    'id': qn(id_column),
+                }, params)
+        for kind, field_names in LAST_POST_FIELDS.items():
+            params = []
+            for (details_kind, object_id), details in last_posts.items():
+                if details_kind == kind:
+                    posted_at = connection.ops.value_to_db_datetime(details[0])
+                    params.append((posted_at,) + details[1:] +
+                                  (object_id, posted_at))
+            if not params:
+                continue
+            model, id_column = models[kind]
+            opts = model._meta
+            cursor.executemany("""
+                UPDATE %(table)s
+                SET %(fields)s
+                WHERE %(id)s=%%s
+                  AND (%(last_post_at)s IS NULL OR %(last_post_at)s<=%%s)""" % {
+                    'table': qn(opts.db_table),
+                    'fields': ','.join(['%s=%%s' % qn(opts.get_field(f).column)
+                                        for f in field_names]),
+                    'id': qn(id_column),
+                    'last_post_at': qn(opts.get_field('last_post_at').column),
+                }, params)
+        transaction.commit_unless_managed()
+
+class RedisCounterBuffer(CounterBuffer):
+    """
+    Accumulates changes in Redis, so changes made by all processes are
+    coalesced and can be applied by any of them.
+    """
+    def store(self, counts, last_posts):
+        from forum import redis_connection as redis
+        redis.add_counter_changes(counts, last_posts)
+
+    def take(self):
+        from forum import redis_connection as redis
+        return redis.take_counter_changes()
+
+def create_counter_buffer():
+    """
+    Creates a counter buffer as specified by current settings, or returns
+    ``None`` if changes should be applied immediately.
+    """
+    if not app_settings.COUNTER_FLUSH_INTERVAL:
+        return None
+    interval = app_settings.COUNTER_FLUSH_INTERVAL / 1000.0
+    if app_settings.USE_REDIS:
+        return RedisCounterBuffer(interval)
+    return CounterBuffer(interval)
+
+def get_counter_buffer():
+    """
+    Returns the counter buffer in use, or ``None`` if changes are being
+    applied immediately.
+    """
+    return counter_buffer
+
+def set_counter_buffer(buffer):
+    """
+    Replaces the counter buffer in use, returning the one it replaced.
+    Any changes waiting in the replaced buffer aren't applied.
+    """
+    global counter_buffer
+    previous, counter_buffer = counter_buffer, buffer
+    return previous
+
+def flush_counters():
+    """
+    Applies any waiting changes, which must be done before denormalised
+    data is read to make decisions or recalculated.
+    """
+    if counter_buffer is not None:
+        counter_buffer.flush()
+
+def request_finished(**kwargs):
+    """
+    Gives the counter buffer in use the chance to apply waiting changes at
+    the end of a request.
+    """
+    if counter_buffer is not None:
+        counter_buffer.request_finished()
+
+# A single instance of the currently specified counter buffer is used, which
+# is flushed after each request and when the process exits.
+counter_buffer = create_counter_buffer()
+signals.request_finished.connect(request_finished)
+atexit.register(flush_counters)
@@ -1,12 +1,57 @@
+import hashlib
 import re
+import string
+import threading
 
 from django.conf import settings
-from django.utils.html import escape, linebreaks, urlize
+from django.utils.encoding import force_unicode
+from django.utils.functional import SimpleLazyObject
+from django.utils.html import escape, punctuation_re, simple_email_re
+from django.utils.http import urlquote
 from django.utils.text import normalize_newlines, wrap
 
 from forum.formatters.emoticons import Emoticons
 
 quote_post_re = re.compile(r'^', re.MULTILINE)
+# Matches paragraph breaks, line breaks and whitespace-delimited words which
+# could be URLs or email addresses.
+basic_token_re = re.compile(r'((?:\r\n|\r(?!\n)|\n){2,})|(\r\n|\r|\n)|(?<!\S)\S*[.@:]\S*')
+url_start_chars = string.ascii_letters + string.digits
+
+def urlize_word(word):
+    """
+    Converts an escaped word to a link if it looks like a URL or email
+    address, as ``django.utils.html.urlize`` does.
+    """
+    lead, middle, trail = punctuation_re.match(word).groups()
+    if middle.startswith('http://') or middle.startswith('https://'):
+        url = urlquote(middle, safe='/&=:;#?+*')
+    elif middle.startswith('www.') or ('@' not in middle and \
+            middle and middle[0] in url_start_chars and \
+            (middle.endswith('.org') or middle.endswith('.net') or middle.endswith('.com'))):
+        url = urlquote('http://%s' % middle, safe='/&=:;#?+*')
+    elif '@' in middle and not ':' in middle and simple_email_re.match(middle):
+        url = 'mailto:%s' % middle
+    else:
+        return word
+    return u'%s<a href="%s">%s</a>%s' % (lead, url, middle, trail)
+
+class PerThread(threading.local):
+    """
+    Holds an ``instance`` created by calling the given factory, separately
+    for each thread which uses it, for objects which keep state while
+    formatting and so can't be shared between threads.
+    """
+    def __init__(self, factory):
+        self.instance = factory()
+
+def format_basic_token(match):
+    paragraph_break, line_break = match.group(1, 2)
+    if paragraph_break:
+        return u'</p>\n\n<p>'
+    elif line_break:
+        return u'<br />'
+    return urlize_word(match.group(0))
 
 class PostFormatter(object):
     """
@@ -14,16 +59,46 @@ class PostFormatter(object):
 
     If used as a post formatter itself, performs basic formatting,
     preserving linebreaks and converting URLs to links.
+
+    If a ``RenderCache`` is given, formatted post bodies are cached in
+    it.
+
+    ``version`` identifies the formatter class, its ``VERSION`` and the
+    emoticons in use, so Posts formatted differently can be detected.
+    ``VERSION`` should be incremented whenever a change is made to a
+    formatter which changes its output.
     """
     QUICK_HELP_TEMPLATE = 'forum/help/basic_formatting_quick.html'
     FULL_HELP_TEMPLATE  = 'forum/help/basic_formatting.html'
+    VERSION = 1
 
-    def __init__(self, emoticons=None):
+    def __init__(self, emoticons=None, render_cache=None):
         if emoticons is None: emoticons = {}
-        self.emoticon_processor = Emoticons(emoticons,
-            base_url='%sforum/img/emoticons/' % settings.STATIC_URL)
+        base_url = '%sforum/img/emoticons/' % settings.STATIC_URL
+        self.emoticon_processor = Emoticons(emoticons, base_url=base_url)
+        self.render_cache = render_cache
+        self.version = hashlib.sha1(repr((self.__class__.__module__,
+                                          self.__class__.__name__,
+                                          self.VERSION,
+                                          sorted(emoticons.items()),
+                                          base_url))).hexdigest()
 
     def format_post(self, body, process_emoticons=True):
+        """
+        Formats the given post body, replacing emoticon symbols with
+        images if ``emoticons`` is ``True``, using the render cache if
+        there is one.
+        """
+        if self.render_cache is None:
+            return self.render_post(body, process_emoticons)
+        key = self.render_cache.make_key(self, body, process_emoticons)
+        html = self.render_cache.get(key)
+        if html is None:
+            html = self.render_post(body, process_emoticons)
+            self.render_cache.set(key, html)
+        return html
+
+    def render_post(self, body, process_emoticons=True):
         """
         Formats the given post body, replacing emoticon symbols with
         images if ``emoticons`` is ``True``.
@@ -36,8 +111,17 @@ class PostFormatter(object):
     def format_post_body(self, body):
         """
         Formats the given raw post body as HTML.
+
+        Produces the same output as ``linebreaks(urlize(escape(body)))``
+        with a single pass over the escaped body, which only stops at line
+        breaks and words which could be links.
         """
-        return linebreaks(urlize(escape(body.strip())))
+        escaped = force_unicode(body.strip()).replace('&', '&amp;') \
+                                             .replace('<', '&lt;') \
+                                             .replace('>', '&gt;') \
+                                             .replace('"', '&quot;') \
+                                             .replace("'", '&#39;')
+        return u'<p>%s</p>' % basic_token_re.sub(format_basic_token, escaped)
 
     def quote_post(self, post):
         """
@@ -51,6 +135,9 @@ class PostFormatter(object):
 class MarkdownFormatter(PostFormatter):
     """
     Post formatter which uses Markdown to format posts.
+
+    ``Markdown`` objects keep state while converting, so each thread gets
+    its own.
     """
     QUICK_HELP_TEMPLATE = 'forum/help/markdown_formatting_quick.html'
     FULL_HELP_TEMPLATE  = 'forum/help/markdown_formatting.html'
@@ -58,15 +145,14 @@ class MarkdownFormatter(PostFormatter):
     def __init__(self, *args, **kwargs):
         super(MarkdownFormatter, self).__init__(*args, **kwargs)
         from markdown2 import Markdown
-        self.md = Markdown(safe_mode='escape')
+        self.md = PerThread(lambda: Markdown(safe_mode='escape'))
 
     def format_post_body(self, body):
         """
         Formats the given raw post body as HTML using Markdown
         formatting.
         """
-        self.md.reset()
-        return self.md.convert(body).strip()
+        return self.md.instance.convert(body).strip()
 
     def quote_post(self, post):
         """
@@ -82,6 +168,9 @@ class MarkdownFormatter(PostFormatter):
 class BBCodeFormatter(PostFormatter):
     """
     Post formatter which uses BBCode syntax to format posts.
+
+    ``PostMarkup`` objects create new parser state and tags each time they
+    render, so one can be shared between threads.
     """
     QUICK_HELP_TEMPLATE = 'forum/help/bbcode_formatting_quick.html'
     FULL_HELP_TEMPLATE  = 'forum/help/bbcode_formatting.html'
@@ -123,8 +212,17 @@ def get_post_formatter():
         formatter_class = getattr(mod, classname)
     except AttributeError:
         raise exceptions.ImproperlyConfigured, 'Post formatting module "%s" does not define a "%s" class' % (modulename, classname)
-    return formatter_class(emoticons=app_settings.EMOTICONS)
+    render_cache = None
+    if app_settings.RENDER_CACHE_SIZE:
+        from forum.formatters.cache import RenderCache
+        render_cache = RenderCache(app_settings.RENDER_CACHE_SIZE,
+            use_redis=app_settings.USE_REDIS and app_settings.RENDER_CACHE_REDIS,
+            timeout=app_settings.RENDER_CACHE_TIMEOUT)
+    return formatter_class(emoticons=app_settings.EMOTICONS,
+                           render_cache=render_cache)
 
 # For convenience, make a single instance of the currently specified post
-# formatter available for reuse.
-post_formatter = get_post_formatter()
+# formatter available for reuse. It's created when first used, so processes
+# which never format anything don't import the formatting library or compile
+# emoticon patterns.
+post_formatter = SimpleLazyObject(get_post_formatter)
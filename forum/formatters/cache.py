@@ -0,0 +1,104 @@
+"""
+Caching of formatted post bodies, so formatting the same body again -
+when previewing repeatedly or re-saving an unchanged Post - skips the
+formatter.
+"""
+import hashlib
+import threading
+
+from django.utils.datastructures import SortedDict
+
+class RenderCache(object):
+    """
+    A bounded, least-recently-used cache of formatted post bodies, keyed
+    on the formatter's version, whether or not emoticons were processed
+    and a digest of the raw post body.
+
+    If ``use_redis`` is ``True``, formatted bodies are also stored in
+    Redis for ``timeout`` seconds, so they can be shared between
+    processes.
+
+    ``hits`` and ``misses`` count lookups which did and didn't find a
+    formatted body.
+    """
+    def __init__(self, size, use_redis=False, timeout=None):
+        self.size = size
+        self.use_redis = use_redis
+        self.timeout = timeout
+        self.entries = SortedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, formatter, body, process_emoticons):
+        """
+        Creates a cache key for the given raw post body as formatted by
+        the given formatter.
+        """
+        return '%s:%d:%s' % (formatter.version, bool(process_emoticons),
+                             hashlib.sha1(body.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """
+        Returns the formatted body cached with the given key, or ``None``.
+        """
+        self.lock.acquire()
+        try:
+            html = self.entries.pop(key, None)
+            if html is not None:
+                # Reinsert to mark as most recently used
+                self.entries[key] = html
+                self.hits += 1
+                return html
+        finally:
+            self.lock.release()
+        if self.use_redis:
+            from forum import redis_connection as redis
+            html = redis.get_formatted_post(key)
+            if html is not None:
+                self.store(key, html, hit=True)
+                return html
+        self.lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            self.lock.release()
+        return None
+
+    def set(self, key, html):
+        """
+        Caches a formatted body with the given key.
+        """
+        self.store(key, html)
+        if self.use_redis:
+            from forum import redis_connection as redis
+            redis.set_formatted_post(key, html, self.timeout)
+
+    def store(self, key, html, hit=False):
+        """
+        Stores a formatted body in this process, evicting the least
+        recently used if the cache is full, and counts a hit if it was
+        found in Redis.
+        """
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = html
+            while len(self.entries) > self.size:
+                del self.entries[self.entries.keyOrder[0]]
+            if hit:
+                self.hits += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """
+        Removes all formatted bodies cached in this process and resets
+        the hit and miss counters.
+        """
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.hits = self.misses = 0
+        finally:
+            self.lock.release()
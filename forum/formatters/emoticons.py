@@ -23,14 +23,40 @@ Other tests::
    >>> em = Emoticons({})
    >>> em.process(u'Cheeky :p')
    u'Cheeky :p'
+   >>> em = Emoticons({':(': 'sad.gif', ':((': 'sob.gif', ':(((': 'wail.gif'})
+   >>> em.process(u':(( :( :(((( :')
+   u'<img src="sob.gif" alt=":(("> <img src="sad.gif" alt=":("> <img src="wail.gif" alt=":(((">( :'
 
 """
 import re
 
+def trie_pattern(trie):
+    """
+    Creates a regular expression matching the symbols in the given trie,
+    a dict mapping characters to the tries of symbols which continue with
+    them, where a ``None`` key marks the end of a symbol.
+
+    The longest continuation of a symbol is always tried first.
+    """
+    alternatives = [re.escape(char) + trie_pattern(child)
+                    for char, child in sorted(trie.items()) if char is not None]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and None not in trie:
+        return alternatives[0]
+    pattern = '(?:%s)' % '|'.join(alternatives)
+    if None in trie:
+        pattern += '?'
+    return pattern
+
 class Emoticons:
     """
-    Replacement of multiple string pairs in one go based on
-    http://effbot.org/zone/python-replace.htm
+    Replacement of multiple string pairs in one go.
+
+    Emoticon symbols are compiled into a trie-shaped regular expression,
+    so the regular expression engine follows a single branch for each
+    character instead of trying every symbol in turn, and the longest
+    symbol starting at any position is matched.
     """
     def __init__ (self, emoticons, base_url='', xhtml=False):
         """
@@ -48,10 +74,15 @@ class Emoticons:
             [(k, '<img src="%s%s" alt="%s"%s>' % (base_url, v, k,
                                                   xhtml and ' /' or '')) \
              for k, v in emoticons.items()])
-        keys = emoticons.keys()
-        keys.sort() # lexical order
-        keys.reverse() # use longest match first
-        self.pattern = re.compile('|'.join([re.escape(key) for key in keys]))
+        trie = {}
+        for key in emoticons:
+            node = trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[None] = True
+        self.pattern = None
+        if trie:
+            self.pattern = re.compile('(%s)' % trie_pattern(trie))
 
     def process(self, text):
         """
@@ -61,10 +92,16 @@ class Emoticons:
         text
            The text to be processed.
         """
-        def repl(match, get=self.emoticons.get):
-            item = match.group(0)
-            return get(item, item)
-        return self.pattern.sub(repl, text)
+        if self.pattern is None:
+            return text
+        # Symbols are at odd indices of the split text, which avoids calling
+        # back into Python for every match.
+        parts = self.pattern.split(text)
+        if len(parts) == 1:
+            return text
+        emoticons = self.emoticons
+        parts[1::2] = [emoticons[symbol] for symbol in parts[1::2]]
+        return u''.join(parts)
 
 if __name__ == '__main__':
     import doctest
@@ -1,15 +1,21 @@
 import datetime
+import hashlib
 import operator
+import time
 import urllib
 
 from django import forms
 from django.db.models.query_utils import Q
 from django.forms.models import modelform_factory
 from django.template.defaultfilters import filesizeformat
-from django.utils.text import capfirst, get_text_list, smart_split
+from django.utils import simplejson
+from django.utils.text import (capfirst, get_text_list, smart_split,
+    truncate_words)
 
 from forum import app_settings
 from forum.models import Forum, ForumProfile, Post, Search, Section, Topic
+from forum.search import SQL_CHUNK_SIZE, id_range_chunks, search_backend
+from forum.search.usernames import username_index
 
 # Try to import PIL in either of the two ways it can end up installed.
 try:
@@ -145,6 +151,43 @@ class ReplyForm(forms.ModelForm):
         if not meta:
             del self.fields['meta']
 
+class MoveToTopicForm(forms.Form):
+    """
+    Base form for moving Posts from a Topic to another Topic, which is
+    specified by its id.
+    """
+    topic = forms.IntegerField(label='Topic id')
+
+    def __init__(self, topic, *args, **kwargs):
+        super(MoveToTopicForm, self).__init__(*args, **kwargs)
+        self.from_topic = topic
+
+    def clean_topic(self):
+        """Validates that the Topic exists and isn't the current Topic."""
+        try:
+            topic = Topic.objects.get(pk=self.cleaned_data['topic'])
+        except Topic.DoesNotExist:
+            raise forms.ValidationError('There is no Topic with this id.')
+        if topic.pk == self.from_topic.pk:
+            raise forms.ValidationError('Posts must be moved to a different Topic.')
+        return topic
+
+class MovePostsForm(MoveToTopicForm):
+    """
+    Form for moving selected Posts to another Topic - the first Post in
+    the Topic can't be selected, so the Topic keeps at least one Post.
+    """
+    posts = forms.ModelMultipleChoiceField(queryset=Post.objects.none(),
+        widget=forms.CheckboxSelectMultiple)
+
+    def __init__(self, topic, *args, **kwargs):
+        super(MovePostsForm, self).__init__(topic, *args, **kwargs)
+        self.fields['posts'].queryset = topic.posts.select_related('user') \
+            .exclude(pk=topic.get_first_post().pk).order_by('num_in_topic', 'id')
+        self.fields['posts'].label_from_instance = lambda post: u'%s%s: %s' % (
+            post.meta and u'Metapost by ' or u'', post.user.username,
+            truncate_words(post.body, 10))
+
 class SearchForm(forms.Form):
     """
     Criteria for searching Topics or Posts.
@@ -188,6 +231,13 @@ class SearchForm(forms.Form):
         SEARCH_NEWER: 'gte',
     }
 
+    SORT_BY_RELEVANCE = 'R'
+    SORT_BY_DATE      = 'D'
+    SORT_BY_CHOICES = (
+        (SORT_BY_RELEVANCE, 'Relevance'),
+        (SORT_BY_DATE, 'Date'),
+    )
+
     SORT_DESCENDING = 'D'
     SORT_ASCENDING  = 'A'
     SORT_DIRECTION_CHOICES = (
@@ -199,8 +249,6 @@ class SearchForm(forms.Form):
         SORT_ASCENDING: '',
     }
 
-    USERNAME_LOOKUP = {True: '', False: '__icontains'}
-
     search_type    = forms.ChoiceField(choices=Search.TYPE_CHOICES, initial=Search.POST_SEARCH, widget=forms.RadioSelect)
     keywords       = forms.CharField()
     username       = forms.CharField(required=False)
@@ -209,6 +257,7 @@ class SearchForm(forms.Form):
     search_in      = forms.MultipleChoiceField(required=False, initial=[SEARCH_ALL_FORUMS])
     search_from    = forms.ChoiceField(choices=SEARCH_FROM_CHOICES)
     search_when    = forms.ChoiceField(choices=SEARCH_WHEN_CHOICES, initial=SEARCH_OLDER, widget=forms.RadioSelect)
+    sort_by        = forms.ChoiceField(choices=SORT_BY_CHOICES, initial=SORT_BY_RELEVANCE, widget=forms.RadioSelect)
     sort_direction = forms.ChoiceField(choices=SORT_DIRECTION_CHOICES, initial=SORT_DESCENDING, widget=forms.RadioSelect)
 
     def __init__(self, *args, **kwargs):
@@ -276,7 +325,6 @@ class SearchForm(forms.Form):
             section_lookup = 'topic__forum__section'
             forum_lookup = 'topic__forum'
             date_lookup = 'posted_at'
-            text_lookup = 'body'
             # Searching should not give the user access to Posts in
             # hidden Topics.
             filters.append(Q(topic__hidden=False))
@@ -284,7 +332,6 @@ class SearchForm(forms.Form):
             section_lookup = 'forum__section'
             forum_lookup = 'forum'
             date_lookup = 'started_at'
-            text_lookup = 'title'
             # Searching should not give the user access to hidden Topics
             filters.append(Q(hidden=False))
 
@@ -308,26 +355,7 @@ class SearchForm(forms.Form):
             filters.append(Q(**{'%s__%s' % (date_lookup, lookup_type): from_date}))
 
         if self.cleaned_data['username']:
-            lookup_type = self.USERNAME_LOOKUP[self.cleaned_data['exact_username']]
-            filters.append(Q(**{'user__username%s' % lookup_type: \
-                                self.cleaned_data['username']}))
-
-        one_of_filters = []
-        phrase_filters = []
-        for keyword in smart_split(self.cleaned_data['keywords']):
-            if keyword[0] == '+':
-                filters.append(Q(**{'%s__icontains' % text_lookup: keyword[1:]}))
-            elif keyword[0] == '-':
-                filters.append(~Q(**{'%s__icontains' % text_lookup: keyword[1:]}))
-            elif keyword[0] == '"' and keyword[-1] == '"' or \
-                 keyword[0] == "'" and keyword[-1] == "'":
-                phrase_filters.append(Q(**{'%s__icontains' % text_lookup: keyword[1:-1]}))
-            else:
-                one_of_filters.append(Q(**{'%s__icontains' % text_lookup: keyword}))
-        if one_of_filters:
-            filters.append(reduce(operator.or_, one_of_filters))
-        if phrase_filters:
-            filters.append(reduce(operator.or_, phrase_filters))
+            filters.append(self.get_username_filter())
 
         # Apply filters and perform ordering
         if search_type == Search.POST_SEARCH:
@@ -336,11 +364,155 @@ class SearchForm(forms.Form):
             qs = Topic.objects.all()
         if len(filters):
             qs = qs.filter(reduce(operator.and_, filters))
+        # Keyword filtering is performed by the configured search backend
+        qs = search_backend.filter_queryset(qs, search_type,
+                                            self.cleaned_data['keywords'])
         sort_direction_flag = \
             self.SORT_DIRECTION_FLAG[self.cleaned_data['sort_direction']]
         return qs.order_by('%s%s' % (sort_direction_flag, date_lookup),
                            '%sid' % sort_direction_flag)
 
+    def get_username_filter(self):
+        """
+        Creates a ``Q`` object for the username criterion.
+
+        Partial usernames are resolved to User ids using the username
+        index, unless they match too many Users to filter by id.
+        """
+        username = self.cleaned_data['username']
+        if self.cleaned_data['exact_username']:
+            return Q(user__username=username)
+        user_ids = username_index.user_ids(username)
+        if len(user_ids) <= SQL_CHUNK_SIZE:
+            return Q(user__in=sorted(user_ids))
+        return Q(user__username__icontains=username)
+
+    def get_criteria_hash(self):
+        """
+        Creates a hash of the search criteria specified in this form, which
+        will be the same for any form specifying an equivalent search.
+
+        Returns ``None`` if the form doesn't appear to have been
+        validated.
+        """
+        if not hasattr(self, 'cleaned_data'):
+            return None
+
+        criteria = {
+            'search_type': self.cleaned_data['search_type'],
+            # All search backends match keywords case-insensitively
+            'keywords': u' '.join(smart_split(self.cleaned_data['keywords'].lower())),
+            'username': self.cleaned_data['username'],
+            'sort_by': self.cleaned_data['sort_by'],
+        }
+        if self.cleaned_data['username']:
+            criteria['exact_username'] = self.cleaned_data['exact_username']
+        if self.cleaned_data['search_type'] == Search.POST_SEARCH:
+            criteria['post_type'] = self.cleaned_data['post_type']
+        if self.cleaned_data['search_in'] and \
+           self.SEARCH_ALL_FORUMS not in self.cleaned_data['search_in']:
+            criteria['search_in'] = sorted(self.cleaned_data['search_in'])
+        if self.cleaned_data['search_from'] != self.SEARCH_ANY_DATE:
+            # Relative dates depend on the current date
+            criteria['search_from'] = self.cleaned_data['search_from']
+            criteria['search_when'] = self.cleaned_data['search_when']
+            criteria['date'] = datetime.date.today().isoformat()
+        if self.cleaned_data['sort_by'] == self.SORT_BY_DATE:
+            criteria['sort_direction'] = self.cleaned_data['sort_direction']
+        return hashlib.sha1(simplejson.dumps(criteria, sort_keys=True)).hexdigest()
+
+    def get_search_scope(self):
+        """
+        Returns the ``search_in`` choice for the smallest Forum, Section
+        or all Forums which contains everything searched in, as stored in
+        ``Search.scope``.
+
+        Returns ``None`` if the form doesn't appear to have been
+        validated.
+        """
+        if not hasattr(self, 'cleaned_data'):
+            return None
+
+        search_in = self.cleaned_data['search_in']
+        if not search_in or self.SEARCH_ALL_FORUMS in search_in:
+            return self.SEARCH_ALL_FORUMS
+        if len(search_in) == 1:
+            return search_in[0]
+        section_ids, forum_ids = set(), []
+        for item in search_in:
+            bits = item.split('.')
+            if bits[0] == self.SEARCH_IN_SECTION:
+                section_ids.add(int(bits[1]))
+            else:
+                forum_ids.append(int(bits[1]))
+        if forum_ids:
+            section_ids.update(Forum.objects.filter(pk__in=forum_ids) \
+                                            .values_list('section', flat=True))
+        if len(section_ids) == 1:
+            return '%s.%s' % (self.SEARCH_IN_SECTION, section_ids.pop())
+        return self.SEARCH_ALL_FORUMS
+
+    def perform_search(self, limit):
+        """
+        Performs the search specified in this form, returning a two-tuple
+        of (list of the ids of up to ``limit`` results in the order they
+        should be displayed, ``True`` if the results are partial).
+
+        Matching items are found in chunks of
+        ``FORUM_SEARCH_SCAN_CHUNK_SIZE`` consecutive ids, newest first
+        unless sorting by ascending date, which relies on ids increasing
+        with each item's date, so each query examines a bounded number of
+        rows. Only as many rows as are still wanted are fetched from each
+        chunk. Searching stops and results are partial if there may be
+        matching items left once ``FORUM_SEARCH_TIME_LIMIT`` seconds have
+        passed or ``FORUM_SEARCH_ROW_LIMIT`` matching items have been
+        found.
+
+        When sorting by relevance, the configured search backend ranks
+        matching items - otherwise, results are ordered by date.
+
+        Returns ``None`` if the form doesn't appear to have been
+        validated.
+        """
+        qs = self.get_queryset()
+        if qs is None:
+            return None
+        search_type = self.cleaned_data['search_type']
+        by_relevance = self.cleaned_data['sort_by'] == self.SORT_BY_RELEVANCE
+        if by_relevance:
+            qs = qs.values_list('id', search_backend.get_text_field(search_type),
+                                search_backend.get_date_field(search_type))
+            wanted = app_settings.SEARCH_RANK_CANDIDATES
+        else:
+            qs = qs.values_list('id', flat=True)
+            wanted = limit
+        descending = by_relevance or \
+            self.cleaned_data['sort_direction'] == self.SORT_DESCENDING
+        deadline = None
+        if app_settings.SEARCH_TIME_LIMIT:
+            deadline = time.time() + app_settings.SEARCH_TIME_LIMIT
+        chunk_size = app_settings.SEARCH_SCAN_CHUNK_SIZE
+        row_limit = app_settings.SEARCH_ROW_LIMIT
+        results, partial = [], False
+        for i, chunk in enumerate(id_range_chunks(qs, chunk_size, descending)):
+            # The next chunk is only searched if there's time left
+            if i and deadline is not None and time.time() >= deadline:
+                partial = True
+                break
+            fetch = min(chunk_size, wanted - len(results))
+            if row_limit:
+                fetch = min(fetch, row_limit - len(results))
+            results.extend(chunk[:fetch])
+            if len(results) >= wanted:
+                break
+            if row_limit and len(results) >= row_limit:
+                partial = True
+                break
+        if by_relevance:
+            results = search_backend.rank_items(results,
+                self.cleaned_data['keywords'], limit)
+        return results, partial
+
 class ImageURLField(forms.URLField):
     """
     A URL field specifically for images, which can validate details
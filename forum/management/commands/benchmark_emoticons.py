@@ -0,0 +1,80 @@
+import re
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from forum import app_settings
+from forum.formatters import post_formatter
+from forum.formatters.emoticons import Emoticons
+from forum.models import Post
+
+class AlternationEmoticons(Emoticons):
+    """
+    Emoticon replacement using a single alternation of every symbol, with
+    a callback for each match, as previously used, for comparison.
+    """
+    def __init__(self, emoticons, **kwargs):
+        Emoticons.__init__(self, emoticons, **kwargs)
+        keys = emoticons.keys()
+        keys.sort() # lexical order
+        keys.reverse() # use longest match first
+        self.pattern = re.compile('|'.join([re.escape(key) for key in keys]))
+
+    def process(self, text):
+        def repl(match, get=self.emoticons.get):
+            item = match.group(0)
+            return get(item, item)
+        return self.pattern.sub(repl, text)
+
+def time_processor(processor, texts, repeat):
+    """
+    Returns the best time taken to process all the given texts out of
+    ``repeat`` runs, and the processed texts.
+    """
+    best = None
+    for i in xrange(repeat):
+        started_at = time.time()
+        processed = [processor.process(text) for text in texts]
+        taken = time.time() - started_at
+        if best is None or taken < best:
+            best = taken
+    return best, processed
+
+class Command(NoArgsCommand):
+    help = ('Compares the speed of emoticon replacement with the previous '
+            'alternation-based implementation, using formatted Post bodies.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', dest='limit', type='int', default=5000,
+            help='Number of most recent Posts to use.'),
+        make_option('--extra-emoticons', dest='extra_emoticons', type='int',
+            default=0,
+            help='Number of additional made-up emoticons to add to '
+                 'FORUM_EMOTICONS, to simulate large custom sets.'),
+        make_option('--repeat', dest='repeat', type='int', default=3,
+            help='Number of times to time each implementation, taking the '
+                 'best.'),
+    )
+
+    def handle_noargs(self, **options):
+        emoticons = dict(app_settings.EMOTICONS)
+        for i in xrange(options['extra_emoticons']):
+            emoticons[':custom%s:' % i] = 'custom%s.gif' % i
+        texts = [post_formatter.format_post_body(body) for body in
+                 Post.objects.order_by('-id').values_list('body', flat=True)[
+                     :options['limit']]]
+        if not texts:
+            self.stdout.write('There are no Posts to benchmark with.\n')
+            return
+        repeat = max(options['repeat'], 1)
+        results = []
+        for name, processor_class in (('alternation', AlternationEmoticons),
+                                      ('trie', Emoticons)):
+            processor = processor_class(emoticons)
+            taken, processed = time_processor(processor, texts, repeat)
+            results.append(processed)
+            self.stdout.write('%-11s %.3fs (%.1f Posts/s)\n' % (
+                name, taken, len(texts) / max(taken, 0.000001)))
+        differences = len([1 for old, new in zip(*results) if old != new])
+        self.stdout.write('%s Posts, %s emoticons, %s differences\n' % (
+            len(texts), len(emoticons), differences))
@@ -0,0 +1,162 @@
+import multiprocessing
+import random
+import resource
+from optparse import make_option
+from timeit import default_timer
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from forum import app_settings
+from forum.formatters import BBCodeFormatter, MarkdownFormatter
+
+BUNDLED_FORMATTERS = [
+    'forum.formatters.PostFormatter',
+    'forum.formatters.MarkdownFormatter',
+    'forum.formatters.BBCodeFormatter',
+]
+
+WORDS = (u'the forum post reply topic thread about with some more text than '
+         u'this that would could should have been there where when what why '
+         u'how people think really quite good bad new old first last').split()
+
+# Markup which may replace a word, by formatting syntax. Each is formatted
+# with the replaced word.
+BASIC_MARKUP = [
+    u'http://example.com/%s',
+    u'www.example.com/%s?a=1&b=2',
+    u'%s@example.com',
+    u'(%s)',
+    u'"%s"',
+    u'<%s>',
+]
+MARKDOWN_MARKUP = [
+    u'*%s*',
+    u'**%s**',
+    u'`%s`',
+    u'[%s](http://example.com/ "Title")',
+    u'<http://example.com/%s>',
+    u'\n\n> %s',
+    u'\n\n- %s\n',
+]
+BBCODE_MARKUP = [
+    u'[b]%s[/b]',
+    u'[i]%s[/i]',
+    u'[url=http://example.com/]%s[/url]',
+    u'[quote]%s[/quote]',
+    u'[code]%s[/code]',
+    u'[list][*]%s[/list]',
+    u'[color=red]%s[/color]',
+]
+
+def get_formatter_class(path):
+    try:
+        dot = path.rindex('.')
+        mod = __import__(path[:dot], {}, {}, [''])
+        return getattr(mod, path[dot+1:])
+    except (ValueError, ImportError, AttributeError):
+        raise CommandError('Could not import post formatter "%s"' % path)
+
+def get_markup(formatter_class):
+    """
+    Returns the markup to use in Posts for the given formatter class.
+    """
+    if issubclass(formatter_class, MarkdownFormatter):
+        return MARKDOWN_MARKUP
+    elif issubclass(formatter_class, BBCodeFormatter):
+        return BBCODE_MARKUP
+    return BASIC_MARKUP
+
+def generate_posts(count, max_words, markup_density, markup, emoticons, seed):
+    """
+    Generates raw post bodies with random lengths of up to ``max_words``
+    words, split into lines and paragraphs, where roughly
+    ``markup_density`` of the words are marked up or are emoticons.
+    """
+    rng = random.Random(seed)
+    emoticons = sorted(emoticons.keys())
+    posts = []
+    for i in xrange(count):
+        # Most posts are short, with a few much longer ones
+        length = min(int(rng.expovariate(1.0 / max(max_words // 8, 1))) + 1,
+                     max_words)
+        words = []
+        for j in xrange(length):
+            word = rng.choice(WORDS)
+            if rng.random() < markup_density:
+                if emoticons and rng.random() < 0.25:
+                    word = rng.choice(emoticons)
+                else:
+                    word = rng.choice(markup) % word
+            words.append(word)
+            if rng.random() < 0.05:
+                words.append(rng.choice((u'\n', u'\n\n')))
+        posts.append(u' '.join(words))
+    return posts
+
+def percentile(sorted_values, percent):
+    return sorted_values[int(round(percent / 100.0 * (len(sorted_values) - 1)))]
+
+def benchmark(path, posts, process_emoticons):
+    """
+    Formats the given posts with the formatter class at the given path,
+    returning posts/s, the 50th and 99th percentile time taken per post in
+    ms and the increase in peak memory use in KB.
+
+    Intended to be run in a separate process, so memory use isn't affected
+    by other formatters.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    formatter = get_formatter_class(path)(emoticons=app_settings.EMOTICONS)
+    # Warm up
+    for body in posts[:50]:
+        formatter.render_post(body, process_emoticons)
+    times = []
+    for body in posts:
+        started_at = default_timer()
+        formatter.render_post(body, process_emoticons)
+        times.append(default_timer() - started_at)
+    times.sort()
+    return (len(times) / max(sum(times), 0.000001),
+            percentile(times, 50) * 1000,
+            percentile(times, 99) * 1000,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss)
+
+class Command(NoArgsCommand):
+    help = ('Measures how quickly post formatters format a generated set of '
+            'Posts, with and without emoticons.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--formatter', dest='formatters', action='append',
+            help='Dotted path to a post formatter class to benchmark. May be '
+                 'given more than once. Defaults to the bundled formatters.'),
+        make_option('--posts', dest='posts', type='int', default=2000,
+            help='Number of Posts to format.'),
+        make_option('--max-words', dest='max_words', type='int', default=800,
+            help='Maximum number of words in a Post.'),
+        make_option('--markup-density', dest='markup_density', type='float',
+            default=0.1,
+            help='Proportion of words which are marked up or are emoticons.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Seed for generating Posts, so runs can be compared.'),
+    )
+
+    def handle_noargs(self, **options):
+        paths = options.get('formatters') or BUNDLED_FORMATTERS
+        self.stdout.write('%-36s %-9s %9s %8s %8s %9s\n' % (
+            'Formatter', 'Emoticons', 'Posts/s', 'p50 ms', 'p99 ms',
+            'Memory KB'))
+        for path in paths:
+            posts = generate_posts(max(options['posts'], 1),
+                                   max(options['max_words'], 1),
+                                   options['markup_density'],
+                                   get_markup(get_formatter_class(path)),
+                                   app_settings.EMOTICONS, options['seed'])
+            for process_emoticons in (False, True):
+                pool = multiprocessing.Pool(1)
+                try:
+                    result = pool.apply(benchmark,
+                                        (path, posts, process_emoticons))
+                finally:
+                    pool.close()
+                    pool.join()
+                self.stdout.write('%-36s %-9s %9.1f %8.3f %8.3f %9d\n' % (
+                    (path, process_emoticons and 'on' or 'off') + result))
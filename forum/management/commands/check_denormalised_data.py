@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from forum import consistency
+from forum.counters import flush_counters
+from forum.models import Forum
+
+class Command(NoArgsCommand):
+    help = ('Checks denormalised Post counts, last Post details and Post '
+            'sequence numbers against the data they summarise, optionally '
+            'repairing any discrepancies.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--repair', action='store_true', dest='repair',
+            default=False,
+            help='Set the expected values for any discrepancies found.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        repair = options['repair']
+        flush_counters()
+        checks = [(forum.name, lambda forum=forum: consistency.check_forum(forum))
+                  for forum in Forum.objects.all()]
+        checks.append(('Forums', consistency.check_forums))
+        checks.append(('Forum Profiles', consistency.check_profiles))
+        total = 0
+        for name, check in checks:
+            discrepancies = check()
+            if verbosity > 1:
+                for model, object_id, field_name, stored, expected in discrepancies:
+                    self.stdout.write('%s %s %s: %r should be %r\n' % (
+                        model.__name__, object_id, field_name, stored, expected))
+            if discrepancies:
+                if repair:
+                    consistency.repair(discrepancies)
+                if verbosity > 0:
+                    self.stdout.write('%s: %s %s\n' % (name, len(discrepancies),
+                        repair and 'repaired' or 'found'))
+            total += len(discrepancies)
+        if verbosity > 0:
+            self.stdout.write('%s discrepancies %s\n' % (total,
+                repair and 'repaired' or 'found'))
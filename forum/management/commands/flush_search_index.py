@@ -0,0 +1,10 @@
+from django.core.management.base import NoArgsCommand
+
+from forum.search import search_backend
+
+class Command(NoArgsCommand):
+    help = ('Applies changes queued for the search index, for sites whose '
+            'requests are too infrequent to apply them promptly.')
+
+    def handle_noargs(self, **options):
+        search_backend.flush()
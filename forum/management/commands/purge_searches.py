@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from forum.models import Search
+
+class Command(NoArgsCommand):
+    help = ('Deletes Searches which are older than FORUM_SEARCH_MAX_AGE or '
+            'beyond the FORUM_SEARCH_MAX_PER_USER most recent for each user.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of expired Searches to delete at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        deleted = Search.objects.purge(chunk_size=options['chunk_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Deleted %s searches\n' % deleted)
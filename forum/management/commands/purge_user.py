@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from forum import moderation
+
+class Command(BaseCommand):
+    args = '<username>'
+    help = ('Deletes all Topics started by and Posts made by the given User, '
+            'for cleaning up after spammers.')
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Report what would be deleted and updated without making '
+                 'any changes.'),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Enter the username of the User to purge.')
+        try:
+            user = User.objects.get(username=args[0])
+        except User.DoesNotExist:
+            raise CommandError('There is no User with username "%s".' % args[0])
+        dry_run = options['dry_run']
+        report = moderation.purge_user(user, dry_run=dry_run)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write(
+                '%s %s topics and %s posts, updating %s topics, %s forums '
+                'and %s other users\' post counts\n' % (
+                    dry_run and 'Would delete' or 'Deleted', report['topics'],
+                    report['posts'], report['updated_topics'],
+                    report['updated_forums'], report['updated_profiles']))
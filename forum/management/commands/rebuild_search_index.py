@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from forum.models import Search
+from forum.search import search_backend
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the search index from scratch.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of items to index at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        type_names = dict(Search.TYPE_CHOICES)
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(search_type, indexed, total):
+            if verbosity > 0:
+                self.stdout.write('%s: indexed %s of %s\n' % (
+                    type_names[search_type], indexed, total))
+
+        search_backend.rebuild(chunk_size=options['chunk_size'],
+                               progress=progress)
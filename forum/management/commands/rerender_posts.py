@@ -0,0 +1,75 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from forum.formatters import post_formatter
+from forum.models import Post
+
+def render_posts(posts):
+    """
+    Formats a list of (post id, raw body, emoticons, ``edited_at``)
+    four-tuples, returning a list of (post id, formatted body,
+    ``edited_at``) three-tuples.
+
+    The render cache is bypassed, as formatting every Post would only
+    evict the formatted bodies which are actually in use.
+    """
+    return [(post_id, post_formatter.render_post(body, emoticons), edited_at)
+            for post_id, body, emoticons, edited_at in posts]
+
+class Command(NoArgsCommand):
+    help = ('Formats every Post body again with the current post formatter, '
+            'for use after changing FORUM_POST_FORMATTER or FORUM_EMOTICONS.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+            help='Number of Posts to read and update at a time.'),
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(),
+            help='Number of processes to format Posts with.'),
+        make_option('--start-after', dest='start_after', type='int', default=0,
+            help='Only format Posts with ids greater than this, to resume an '
+                 'interrupted run.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options['chunk_size']
+        processes = max(options['processes'], 1)
+        pool = None
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+        queryset = Post.objects.order_by('id').values_list('id', 'body',
+                                                           'emoticons',
+                                                           'edited_at')
+        total = queryset.filter(pk__gt=options['start_after']).count()
+        last_id, rendered, started_at = options['start_after'], 0, time.time()
+        try:
+            while True:
+                posts = list(queryset.filter(pk__gt=last_id)[:chunk_size])
+                if not posts:
+                    break
+                if pool is None:
+                    formatted_posts = render_posts(posts)
+                else:
+                    # Split the chunk so each process gets a share
+                    share = -(-len(posts) // processes)
+                    formatted_posts = []
+                    for result in pool.map(render_posts,
+                            [posts[i:i+share]
+                             for i in xrange(0, len(posts), share)]):
+                        formatted_posts.extend(result)
+                Post.objects.update_body_html(formatted_posts,
+                                              post_formatter.version)
+                rendered += len(posts)
+                last_id = posts[-1][0]
+                if verbosity > 0:
+                    self.stdout.write(
+                        'Formatted %s of %s Posts, up to id %s (%.1f Posts/s)\n' % (
+                        rendered, total, last_id,
+                        rendered / max(time.time() - started_at, 0.001)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
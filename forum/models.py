@@ -1,23 +1,33 @@
 """
 Models for a discussion forum.
 """
+import atexit
 import datetime
+import threading
 from itertools import izip
 
 from django.contrib.auth.models import User
+from django.core import signals
 from django.db import connection, models, transaction
+from django.db.models.query_utils import Q
+from django.utils import simplejson
 from django.utils.encoding import smart_unicode
 from django.utils.text import truncate_words
 
 from forum import app_settings
+from forum.counters import flush_counters, get_counter_buffer
 from forum.formatters import post_formatter
+from forum.search import (SQL_CHUNK_SIZE, search_backend,
+    tokenize_positions)
 from forum.utils import models as model_utils
+from forum.utils.fields import PackedIdsField
 from pytz import common_timezones
 
 if app_settings.USE_REDIS:
     from forum import redis_connection as redis
 
-__all__ = ['ForumProfile', 'Section', 'Forum', 'Topic',  'Post', 'Search']
+__all__ = ['ForumProfile', 'Section', 'Forum', 'Topic',  'Post', 'Search',
+           'SearchIndexEntry']
 
 qn = connection.ops.quote_name
 
@@ -37,6 +47,7 @@ class ForumProfileManager(models.Manager):
         """
         Updates ``post_count`` for Users with the given ids.
         """
+        flush_counters()
         opts = self.model._meta
         post_opts = Post._meta
         query = """
@@ -57,6 +68,33 @@ class ForumProfileManager(models.Manager):
         cursor = connection.cursor()
         cursor.execute(query, user_ids)
 
+    def decrement_post_counts(self, posts):
+        """
+        Subtracts from ``post_count`` for Users who made any of the given
+        Posts, which are about to be deleted, without counting their
+        remaining Posts.
+        """
+        self.subtract_post_counts([(user['user'], user['count']) for user in \
+            posts.values('user').order_by().annotate(count=models.Count('id'))])
+
+    def subtract_post_counts(self, user_post_counts):
+        """
+        Subtracts from ``post_count`` for Users, given a list of (user id,
+        number of Posts) two-tuples, using a single batched update.
+        """
+        if not user_post_counts:
+            return
+        opts = self.model._meta
+        cursor = connection.cursor()
+        cursor.executemany("""
+            UPDATE %(forum_profile)s
+            SET %(post_count)s=%(post_count)s-%%s
+            WHERE %(user_fk)s=%%s""" % {
+                'forum_profile': qn(opts.db_table),
+                'post_count': qn(opts.get_field('post_count').column),
+                'user_fk': qn(opts.get_field('user').column),
+            }, [(count, user_id) for user_id, count in user_post_counts])
+
 TIMEZONE_CHOICES = tuple([(tz, tz) for tz in common_timezones])
 
 TOPICS_PER_PAGE_CHOICES = (
@@ -133,11 +171,22 @@ class ForumProfile(models.Model):
         """
         Updates this ForumProfile's ``post_count`` with the number of
         Posts currently associated with its User.
+
+        Post counts are kept up to date as Posts are added and deleted, so
+        this is only needed to repair them.
         """
+        flush_counters()
         self.post_count = self.user.posts.count()
         model_utils.update(self, 'post_count')
     update_post_count.alters_data = True
 
+    def increment_post_count(self, amount=1):
+        """
+        Adds to this ForumProfile's ``post_count``.
+        """
+        model_utils.increment(self, {'post_count': amount})
+    increment_post_count.alters_data = True
+
 class SectionManager(models.Manager):
     def get_forums_by_section(self):
         """
@@ -191,16 +240,15 @@ class Section(models.Model):
         """
         This method is overridden to maintain consecutive ordering and
         to update the Post counts of any Users who had Posts in this
-        Section.
+        Section and to remove its Topics and Posts from the search index.
         """
-        affected_user_ids = [user['id'] for user in \
-            User.objects.filter(posts__topic__forum__section=self) \
-                         .distinct() \
-                          .values('id')]
+        posts = Post.objects.filter(topic__forum__section=self)
+        ForumProfile.objects.decrement_post_counts(posts)
+        search_backend.remove_topics(Topic.objects.filter(
+            forum__section=self).values_list('id', flat=True))
+        search_backend.remove_posts(posts.values_list('id', flat=True))
         super(Section, self).delete()
         Section.objects.decrement_orders(self.order)
-        if len(affected_user_ids):
-            ForumProfile.objects.update_post_counts_in_bulk(affected_user_ids)
         transaction.commit_unless_managed()
 
     class Meta:
@@ -267,18 +315,16 @@ class Forum(models.Model):
 
     def delete(self):
         """
-        This method is overridden to maintain consecutive ordering and
-        to update the Post counts of any Users who had posts in this
-        Forum.
+        This method is overridden to maintain consecutive ordering, to
+        update the Post counts of any Users who had posts in this Forum
+        and to remove its Topics and Posts from the search index.
         """
-        affected_user_ids = [user['id'] for user in \
-            User.objects.filter(posts__topic__forum=self) \
-                         .distinct() \
-                          .values('id')]
+        posts = Post.objects.filter(topic__forum=self)
+        ForumProfile.objects.decrement_post_counts(posts)
+        search_backend.remove_topics(self.topics.values_list('id', flat=True))
+        search_backend.remove_posts(posts.values_list('id', flat=True))
         super(Forum, self).delete()
         Forum.objects.decrement_orders(self.section_id, self.order)
-        if len(affected_user_ids) > 0:
-            ForumProfile.objects.update_post_counts_in_bulk(affected_user_ids)
         transaction.commit_unless_managed()
 
     class Meta:
@@ -291,11 +337,22 @@ class Forum(models.Model):
     def update_topic_count(self):
         """
         Updates this Forum's ``topic_count``.
+
+        Topic counts are kept up to date as Topics are added and deleted,
+        so this is only needed to repair them.
         """
+        flush_counters()
         self.topic_count = self.topics.count()
         model_utils.update(self, 'topic_count')
     update_topic_count.alters_data = True
 
+    def increment_topic_count(self, amount=1):
+        """
+        Adds to this Forum's ``topic_count``.
+        """
+        model_utils.increment(self, {'topic_count': amount})
+    increment_topic_count.alters_data = True
+
     def set_last_post(self, post=None):
         """
         Updates denormalised details about this Forum's last Post.
@@ -311,6 +368,7 @@ class Forum(models.Model):
         """
         try:
             if post is None:
+                flush_counters()
                 post = Post.objects.filter(meta=False,
                                            topic__forum=self,
                                            topic__hidden=False) \
@@ -497,6 +555,7 @@ class Topic(models.Model):
     last_post_at   = models.DateTimeField(null=True, blank=True)
     last_user_id   = models.PositiveIntegerField(null=True, blank=True)
     last_username  = models.CharField(max_length=30, blank=True)
+    last_num_in_topic = models.PositiveIntegerField(default=0)
 
     objects = TopicManager()
 
@@ -513,20 +572,21 @@ class Topic(models.Model):
         - If ``title`` has been updated and this Topic was set in its
           Forum's last Post details, it needs to be updated in the
           Forum as well.
+        - Updating the search index.
         """
         is_new = False
         if not self.pk:
             self.started_at = datetime.datetime.now()
             is_new = True
         super(Topic, self).save(*args, **kwargs)
+        search_backend.update_topic(self)
         if is_new:
-            self.forum.update_topic_count()
-            transaction.commit_unless_managed()
+            self.forum.increment_topic_count()
         elif self.pk == self.forum.last_topic_id and \
              self.title != self.forum.last_topic_title and \
              not self.hidden:
             self.forum.set_last_post()
-            transaction.commit_unless_managed()
+        transaction.commit_unless_managed()
 
     def delete(self):
         """
@@ -538,17 +598,22 @@ class Topic(models.Model):
           Topic always have to be updated.
         - If it was set as the Topic in the Forum's last Post details,
           these need to be updated.
+        - The Topic and its Posts need to be removed from the search
+          index.
         """
         forum = self.forum
+        if get_counter_buffer() is not None:
+            # Use the Forum as updated by any waiting changes
+            flush_counters()
+            forum = Forum.objects.get(pk=self.forum_id)
         was_last_topic = self.pk == forum.last_topic_id
-        affected_user_ids = [user['id'] for user in \
-            User.objects.filter(posts__topic=self).distinct().values('id')]
+        ForumProfile.objects.decrement_post_counts(self.posts.all())
+        search_backend.remove_topics([self.pk])
+        search_backend.remove_posts(self.posts.values_list('id', flat=True))
         super(Topic, self).delete()
-        forum.update_topic_count()
+        forum.increment_topic_count(-1)
         if was_last_topic:
             forum.set_last_post()
-        if len(affected_user_ids) > 0:
-            ForumProfile.objects.update_post_counts_in_bulk(affected_user_ids)
         transaction.commit_unless_managed()
 
     class Meta:
@@ -564,15 +629,26 @@ class Topic(models.Model):
 
     def get_first_post(self):
         """
-        Gets the first Post in this Topic.
+        Gets the first Post in this Topic, caching it the first time it is
+        looked up.
+
+        Posts given duplicate numbers before ``last_num_in_topic`` was
+        populated are ordered by id, so the opening Post is still first.
         """
-        return self.posts.filter(meta=False).order_by('num_in_topic')[0]
+        if not hasattr(self, '_first_post_cache'):
+            self._first_post_cache = self.posts.filter(meta=False) \
+                                               .order_by('num_in_topic', 'id')[0]
+        return self._first_post_cache
 
     def update_post_count(self, meta=False):
         """
         Updates one of this Topic's denormalised Post counts, based on
         ``meta``.
+
+        Post counts are kept up to date by ``add_post`` and ``remove_post``,
+        so this is only needed to repair them.
         """
+        flush_counters()
         field_name = '%spost_count' % (meta and 'meta' or '',)
         setattr(self, field_name, self.posts.filter(meta=meta).count())
         model_utils.update(self, field_name)
@@ -587,6 +663,7 @@ class Topic(models.Model):
 
         If the last Post is not given, it will be looked up.
         """
+        flush_counters()
         if post is None:
             post = self.posts.filter(meta=False).order_by('-posted_at', '-id')[0]
         self.post_count = self.posts.filter(meta=False).count()
@@ -597,6 +674,101 @@ class Topic(models.Model):
                            'last_username')
     set_last_post.alters_data = True
 
+    def renumber_posts(self, first_post_id):
+        """
+        Numbers this Topic's Posts from 1, updating only those whose
+        number changes, for when Posts have been moved into it.
+
+        The Post with the given id, which should be the first Post in this
+        Topic from before Posts were moved into it, keeps number 1 so it
+        stays first - the rest are numbered in posting order.
+        """
+        flush_counters()
+        numbered_posts = []
+        num_in_topic = 1
+        if self.posts.get(pk=first_post_id).num_in_topic != 1:
+            numbered_posts.append((first_post_id, 1))
+        for post_id, current_num in self.posts.exclude(pk=first_post_id) \
+                                              .order_by('posted_at', 'id') \
+                                              .values_list('id', 'num_in_topic') \
+                                              .iterator():
+            num_in_topic += 1
+            if current_num != num_in_topic:
+                numbered_posts.append((post_id, num_in_topic))
+        Post.objects.update_num_in_topic(numbered_posts)
+        self.last_num_in_topic = num_in_topic
+        model_utils.update(self, 'last_num_in_topic')
+    renumber_posts.alters_data = True
+
+    def add_post(self, post):
+        """
+        Updates this Topic's denormalised data for a new Post, adding to
+        its Post count without counting its Posts.
+        """
+        if post.meta:
+            model_utils.increment(self, {'metapost_count': 1})
+        else:
+            self.last_post_at = post.posted_at
+            self.last_user_id = post.user.pk
+            self.last_username = post.user.username
+            model_utils.increment(self, {'post_count': 1}, 'last_post_at',
+                                  'last_user_id', 'last_username')
+    add_post.alters_data = True
+
+    def allocate_num_in_topic(self):
+        """
+        Allocates the next number in this Topic's Post sequence for a new
+        Post, returning it.
+
+        The number is incremented in the database and read back in the
+        same transaction, so the row lock taken by the update stops
+        concurrent Posts from being given the same number. The caller is
+        responsible for committing once the Post has been saved.
+        """
+        opts = self._meta
+        params = {
+            'table': qn(opts.db_table),
+            'last_num': qn(opts.get_field('last_num_in_topic').column),
+            'id': qn(opts.pk.column),
+        }
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE %(table)s
+            SET %(last_num)s=%(last_num)s+1
+            WHERE %(id)s=%%s""" % params, [self.pk])
+        cursor.execute("""
+            SELECT %(last_num)s
+            FROM %(table)s
+            WHERE %(id)s=%%s""" % params, [self.pk])
+        self.last_num_in_topic = cursor.fetchone()[0]
+        return self.last_num_in_topic
+    allocate_num_in_topic.alters_data = True
+
+    def remove_post(self, post):
+        """
+        Updates this Topic's denormalised data for a deleted Post,
+        subtracting from its Post count without counting its Posts, and
+        looking up the new last Post if the deleted Post was the last.
+        """
+        if post.meta:
+            model_utils.increment(self, {'metapost_count': -1})
+        elif post.posted_at == self.last_post_at:
+            last_post = self.posts.filter(meta=False).order_by('-posted_at', '-id')[0]
+            self.last_post_at = last_post.posted_at
+            self.last_user_id = last_post.user.pk
+            self.last_username = last_post.user.username
+            model_utils.increment(self, {'post_count': -1}, 'last_post_at',
+                                  'last_user_id', 'last_username')
+        else:
+            model_utils.increment(self, {'post_count': -1})
+    remove_post.alters_data = True
+
+# Formatted bodies of Posts refreshed by PostManager.refresh_body_html and
+# the edited_at they were read with, keyed by Post id, which are waiting to
+# be written back.
+refreshed_body_html = {}
+refreshed_lock = threading.Lock()
+
 class PostManager(models.Manager):
     def with_user_details(self):
         """
@@ -639,8 +811,9 @@ class PostManager(models.Manager):
     def with_standalone_details(self):
         """
         Creates a ``QuerySet`` containing Posts which have additional
-        information about the User who created them and their Topic, Forum and
-        Section, as required to display a Post's complete details.
+        information about the User who created them, their Topic, Forum and
+        Section and their position in their Topic, as required to display a
+        Post's complete details.
         """
         opts = self.model._meta
         topic_opts = Topic._meta
@@ -649,8 +822,23 @@ class PostManager(models.Manager):
         topic_table = qn(topic_opts.db_table)
         forum_table = qn(forum_opts.db_table)
         section_table = qn(section_opts.db_table)
+        post_table = qn(opts.db_table)
+        position = """
+            SELECT COUNT(*) FROM %(post_table)s p
+            WHERE p.%(topic_fk)s=%(post_table)s.%(topic_fk)s
+              AND p.%(meta)s=%(post_table)s.%(meta)s
+              AND (p.%(num_in_topic)s<%(post_table)s.%(num_in_topic)s
+                   OR p.%(num_in_topic)s=%(post_table)s.%(num_in_topic)s
+                  AND p.%(id)s<=%(post_table)s.%(id)s)""" % {
+            'post_table': post_table,
+            'topic_fk': qn(opts.get_field('topic').column),
+            'meta': qn(opts.get_field('meta').column),
+            'num_in_topic': qn(opts.get_field('num_in_topic').column),
+            'id': qn(opts.pk.column),
+        }
         return self.with_user_details().extra(
             select={
+                'position': position,
                 'topic_title': '%s.%s' % (topic_table, qn(topic_opts.get_field('title').column)),
                 'topic_post_count': '%s.%s' % (topic_table, qn(topic_opts.get_field('post_count').column)),
                 'forum_id': '%s.%s' % (topic_table, qn(topic_opts.get_field('forum').column)),
@@ -681,28 +869,100 @@ class PostManager(models.Manager):
             ]
         )
 
-    def update_num_in_topic(self, topic, start_at, increment=False, meta=False):
+    def update_num_in_topic(self, numbered_posts):
         """
-        Updates ``num_in_topic`` for all Posts in the given Topic
-        which have a ``num_in_topic`` greater than ``start_at``.
-
-        Values will be incremented or decremented based on ``increment``.
+        Updates ``num_in_topic`` for Posts, given a list of (post id,
+        sequence number) two-tuples, using a single batched update.
         """
+        if not numbered_posts:
+            return
         opts = self.model._meta
         cursor = connection.cursor()
-        operator = {True: '+', False: '-'}[increment]
-        cursor.execute("""
+        cursor.executemany("""
             UPDATE %(post_table)s
-            SET %(num_in_topic)s=%(num_in_topic)s%(operator)s1
-            WHERE %(topic_fk)s=%%s
-              AND %(meta)s=%%s
-              AND %(num_in_topic)s>%%s""" % {
+            SET %(num_in_topic)s=%%s
+            WHERE %(post_pk)s=%%s""" % {
                 'post_table': qn(opts.db_table),
-                'meta': qn(opts.get_field('meta').column),
                 'num_in_topic': qn(opts.get_field('num_in_topic').column),
-                'operator': operator,
-                'topic_fk': qn(opts.get_field('topic').column),
-            }, [topic.pk, meta, start_at])
+                'post_pk': qn(opts.pk.column),
+            }, [(num_in_topic, post_id)
+                for post_id, num_in_topic in numbered_posts])
+
+    def update_body_html(self, formatted_posts, formatter_version):
+        """
+        Updates ``body_html`` for Posts, given a list of (post id,
+        formatted body, ``edited_at``) three-tuples and the version of the
+        formatter which formatted them, using batched updates and without
+        triggering any of the other updates ``save`` performs.
+
+        ``edited_at`` is the value which was read along with the body
+        which was formatted - Posts which have been edited since then are
+        left alone, as saving them formatted their new body.
+        """
+        if not formatted_posts:
+            return
+        opts = self.model._meta
+        update = """
+            UPDATE %(post_table)s
+            SET %(body_html)s=%%s, %(formatter_version)s=%%s
+            WHERE %(post_pk)s=%%s AND %(edited_at)s""" % {
+                'post_table': qn(opts.db_table),
+                'body_html': qn(opts.get_field('body_html').column),
+                'formatter_version': qn(opts.get_field('formatter_version').column),
+                'post_pk': qn(opts.pk.column),
+                'edited_at': qn(opts.get_field('edited_at').column),
+            }
+        edited, never_edited = [], []
+        for post_id, body_html, edited_at in formatted_posts:
+            if edited_at is None:
+                never_edited.append((body_html, formatter_version, post_id))
+            else:
+                edited.append((body_html, formatter_version, post_id,
+                               connection.ops.value_to_db_datetime(edited_at)))
+        cursor = connection.cursor()
+        if edited:
+            cursor.executemany(update + '=%s', edited)
+        if never_edited:
+            cursor.executemany(update + ' IS NULL', never_edited)
+        transaction.commit_unless_managed()
+
+    def refresh_body_html(self, posts):
+        """
+        Formats any of the given Posts which were formatted by a different
+        version of the post formatter again, so they display as the
+        current formatter would format them.
+
+        Refreshed Posts are written back once the current request has
+        finished, unless they've been edited in the meantime.
+        """
+        refreshed = {}
+        for post in posts:
+            if post.formatter_version != post_formatter.version:
+                post.body_html = post_formatter.format_post(post.body,
+                                                            post.emoticons)
+                post.formatter_version = post_formatter.version
+                refreshed[post.pk] = (post.body_html, post.edited_at)
+        if refreshed:
+            refreshed_lock.acquire()
+            try:
+                refreshed_body_html.update(refreshed)
+            finally:
+                refreshed_lock.release()
+        return posts
+
+    def write_refreshed_body_html(self, **kwargs):
+        """
+        Writes back Posts refreshed by ``refresh_body_html``.
+        """
+        refreshed_lock.acquire()
+        try:
+            refreshed = [(post_id, body_html, edited_at)
+                         for post_id, (body_html, edited_at) \
+                         in refreshed_body_html.items()]
+            refreshed_body_html.clear()
+        finally:
+            refreshed_lock.release()
+        self.update_body_html(refreshed, post_formatter.version)
 
     def add_topic_view_counts(self, posts):
         """
@@ -721,13 +981,17 @@ class Post(models.Model):
     topic     = models.ForeignKey(Topic, related_name='posts')
     body      = models.TextField()
     body_html = models.TextField(editable=False)
+    formatter_version = models.CharField(max_length=40, blank=True, editable=False)
     posted_at = models.DateTimeField(editable=False)
     edited_at = models.DateTimeField(editable=False, null=True, blank=True)
     user_ip   = models.IPAddressField(editable=False, null=True, blank=True)
     meta      = models.BooleanField(default=False)
     emoticons = models.BooleanField(default=True)
 
-    # Denormalised data
+    # Denormalised data - a sequence number shared by Posts and metaposts in
+    # a Topic, which increases in posting order. Numbers of deleted Posts
+    # aren't reused and later Posts aren't renumbered, so a Post's position
+    # among the Posts displayed with it is calculated when needed.
     num_in_topic = models.PositiveIntegerField(default=0)
 
     objects = PostManager()
@@ -742,33 +1006,39 @@ class Post(models.Model):
         - Formatting and escaping the raw Post body as HTML at save time.
         - Populating or updating non-editable time fields.
         - Populating denormalised data in related Topic, Forum and
-          ForumProfile objects when this is a new Post.
+          ForumProfile objects when this is a new Post, or adding the
+          changes to the counter buffer if one is in use.
+        - Updating the search index.
+        - Preventing reuse of Searches which cover this Post's Forum when
+          this is a new Post.
         """
         self.body = self.body.strip()
         self.body_html = post_formatter.format_post(self.body, self.emoticons)
+        self.formatter_version = post_formatter.version
         is_new = False
         if not self.pk:
             self.posted_at = datetime.datetime.now()
-            self.num_in_topic = getattr(self.topic, '%spost_count' % \
-                                        (self.meta and 'meta' or '',)) + 1
+            self.num_in_topic = self.topic.allocate_num_in_topic()
             is_new = True
         else:
             self.edited_at = datetime.datetime.now()
         super(Post, self).save(*args, **kwargs)
+        search_backend.update_post(self)
         if is_new:
-            if not self.meta:
-                # Includes a non-metapost post count update
-                self.topic.set_last_post(self)
+            counter_buffer = get_counter_buffer()
+            if counter_buffer is not None:
+                counter_buffer.add_post(self)
             else:
-                self.topic.update_post_count(meta=True)
-
-            # Don't update the forum's last post if the topic is hidden
-            # - this allows moderators to add posts to hidden topics
-            # without them becoming visible on forum listing pages.
-            if not self.meta and not self.topic.hidden:
-                self.topic.forum.set_last_post(self)
-            ForumProfile.objects.get_for_user(self.user).update_post_count()
-            transaction.commit_unless_managed()
+                self.topic.add_post(self)
+
+                # Don't update the forum's last post if the topic is hidden
+                # - this allows moderators to add posts to hidden topics
+                # without them becoming visible on forum listing pages.
+                if not self.meta and not self.topic.hidden:
+                    self.topic.forum.set_last_post(self)
+                ForumProfile.objects.get_for_user(self.user).increment_post_count()
+            Search.objects.invalidate_forum(self.topic.forum)
+        transaction.commit_unless_managed()
 
     def delete(self):
         """
@@ -777,31 +1047,32 @@ class Post(models.Model):
         been deleted:
 
         - The ``post_count`` of the ForumProfile for the User who made
-          the post always needs to be updated.
+          the post always needs to be decremented.
         - The ``post_count`` or ``metapost_count`` of the Post's Topic
-          always needs to be updated.
+          always needs to be decremented.
         - If this is not a metapost and was the last Post in its Topic,
           the Topic's last Post details need to be updated.
         - If this is not a metapost was the last Post in its Topic's
           Forum, the Forum's last Post details need to be updated to the
           new last Post.
-        - If this was not the last Post in its Topic, the
-          ``num_in_topic`` of all later Posts need to be decremented.
+        - The Post needs to be removed from the search index.
+
+        Later Posts keep their ``num_in_topic``, as positions are
+        calculated from it when needed.
         """
         topic = self.topic
+        if get_counter_buffer() is not None:
+            # Use the Topic as updated by any waiting changes
+            flush_counters()
+            topic = Topic.objects.get(pk=self.topic_id)
         forum = topic.forum
         forum_profile = ForumProfile.objects.get_for_user(self.user)
+        search_backend.remove_posts([self.pk])
         super(Post, self).delete()
-        forum_profile.update_post_count()
-        if not self.meta and self.posted_at == topic.last_post_at:
-            # Includes a non-metapost post count update
-            topic.set_last_post()
-        else:
-            topic.update_post_count(meta=self.meta)
+        forum_profile.increment_post_count(-1)
+        topic.remove_post(self)
         if not self.meta and self.posted_at == forum.last_post_at:
             forum.set_last_post()
-        Post.objects.update_num_in_topic(topic, self.num_in_topic,
-                                         increment=False, meta=self.meta)
         transaction.commit_unless_managed()
 
     class Meta:
@@ -811,10 +1082,163 @@ class Post(models.Model):
     def get_absolute_url(self):
         return ('forum_redirect_to_post', (smart_unicode(self.pk),))
 
+    def get_position(self):
+        """
+        Gets this Post's position among the Posts or metaposts in its
+        Topic, starting from 1, unless it was already looked up as
+        ``position``.
+
+        Posts with the same number are ordered by id, as they are when
+        displayed.
+        """
+        if 'position' not in self.__dict__:
+            self.position = Post.objects.filter(
+                Q(num_in_topic__lt=self.num_in_topic) |
+                Q(num_in_topic=self.num_in_topic, pk__lte=self.pk),
+                topic=self.topic_id, meta=self.meta).count()
+        return self.position
+
+# Write back refreshed Posts after each request, and any still waiting when
+# the process exits.
+signals.request_finished.connect(Post.objects.write_refreshed_body_html)
+atexit.register(Post.objects.write_refreshed_body_html)
+
+class SearchManager(models.Manager):
+    def reusable(self):
+        """
+        Creates a ``QuerySet`` containing Searches whose results may be
+        reused for identical searches.
+        """
+        return self.exclude(criteria_hash='').filter(
+            searched_at__gte=datetime.datetime.now() - \
+                datetime.timedelta(seconds=app_settings.SEARCH_REUSE_TIMEOUT))
+
+    def reuse(self, criteria_hash, user, criteria_json):
+        """
+        Looks for a reusable Search with the given criteria hash, to save
+        the given User from performing an identical search.
+
+        If the User has such a Search of their own it is returned,
+        otherwise a copy of another User's Search is created for them.
+        Returns ``None`` if there is no reusable Search.
+        """
+        searches = self.reusable().filter(criteria_hash=criteria_hash)
+        try:
+            return searches.filter(user=user)[0]
+        except IndexError:
+            pass
+        try:
+            search = searches[0]
+        except IndexError:
+            return None
+        # The copy keeps the original search time, so the results aren't
+        # reused for longer than the original's.
+        return self.create(type=search.type, user=user,
+                           searched_at=search.searched_at,
+                           scope=search.scope,
+                           criteria_hash=criteria_hash,
+                           criteria_json=criteria_json,
+                           result_ids=search.result_ids,
+                           partial=search.partial)
+
+    def invalidate_forum(self, forum):
+        """
+        Prevents reuse of Searches whose results could include Posts or
+        Topics from the given Forum, as they may now be out of date.
+        """
+        from forum.forms import SearchForm
+        self.reusable().filter(scope__in=[SearchForm.SEARCH_ALL_FORUMS,
+            '%s.%s' % (SearchForm.SEARCH_IN_SECTION, forum.section_id),
+            '%s.%s' % (SearchForm.SEARCH_IN_FORUM, forum.pk),
+        ]).update(criteria_hash='')
+
+    def delete_ids(self, search_ids):
+        """
+        Deletes Searches with the given ids without loading them.
+        """
+        if not search_ids:
+            return
+        opts = self.model._meta
+        cursor = connection.cursor()
+        for i in xrange(0, len(search_ids), SQL_CHUNK_SIZE):
+            chunk = list(search_ids[i:i+SQL_CHUNK_SIZE])
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                qn(opts.db_table), qn(opts.pk.column),
+                ','.join(['%s'] * len(chunk))), chunk)
+        transaction.commit_unless_managed()
+
+    def purge_expired(self, chunk_size=1000, max_chunks=None):
+        """
+        Deletes Searches older than ``FORUM_SEARCH_MAX_AGE`` seconds,
+        ``chunk_size`` at a time, stopping after ``max_chunks`` chunks if
+        given.
+
+        Returns the number of Searches deleted.
+        """
+        if not app_settings.SEARCH_MAX_AGE:
+            return 0
+        expired = self.filter(searched_at__lt=datetime.datetime.now() - \
+            datetime.timedelta(seconds=app_settings.SEARCH_MAX_AGE)) \
+            .order_by('id').values_list('id', flat=True)
+        deleted, chunks = 0, 0
+        while max_chunks is None or chunks < max_chunks:
+            search_ids = list(expired[:chunk_size])
+            if not search_ids:
+                break
+            self.delete_ids(search_ids)
+            deleted += len(search_ids)
+            chunks += 1
+        return deleted
+
+    def purge_user(self, user_id):
+        """
+        Deletes all but the most recent ``FORUM_SEARCH_MAX_PER_USER``
+        Searches for the User with the given id.
+
+        Returns the number of Searches deleted.
+        """
+        if not app_settings.SEARCH_MAX_PER_USER:
+            return 0
+        search_ids = list(self.filter(user=user_id) \
+            .order_by('-searched_at', '-id') \
+            .values_list('id', flat=True)[app_settings.SEARCH_MAX_PER_USER:])
+        self.delete_ids(search_ids)
+        return len(search_ids)
+
+    def purge(self, chunk_size=1000):
+        """
+        Enforces the Search retention policy, deleting expired Searches
+        and Searches beyond each User's limit.
+
+        Returns the number of Searches deleted.
+        """
+        deleted = self.purge_expired(chunk_size)
+        if app_settings.SEARCH_MAX_PER_USER:
+            for row in self.values('user').order_by() \
+                           .annotate(search_count=models.Count('id')) \
+                           .filter(search_count__gt=app_settings.SEARCH_MAX_PER_USER):
+                deleted += self.purge_user(row['user'])
+        return deleted
+
+    def sweep(self, user):
+        """
+        Performs a small, bounded amount of purging, intended to be called
+        while handling requests which create Searches.
+
+        This deletes up to one chunk of expired Searches and any
+        Searches beyond the given User's limit.
+        """
+        return (self.purge_expired(chunk_size=SQL_CHUNK_SIZE, max_chunks=1) +
+                self.purge_user(user.pk))
+
 class Search(models.Model):
     """
     Caches search criteria and a limited number of results to avoid
     repitition of expensive searches when paginating results.
+
+    Results are also reused for identical searches performed within
+    ``FORUM_SEARCH_REUSE_TIMEOUT`` seconds, unless new Posts have been
+    made in the Forums which were searched in the meantime.
     """
     POST_SEARCH  = 'P'
     TOPIC_SEARCH = 'T'
@@ -827,14 +1251,21 @@ class Search(models.Model):
     user          = models.ForeignKey(User, related_name='searches')
     searched_at   = models.DateTimeField(editable=False)
     criteria_json = models.TextField()
-    result_ids    = models.TextField()
+    criteria_hash = models.CharField(max_length=40, blank=True, db_index=True)
+    # The Forum, Section or all Forums (as a SearchForm search_in choice)
+    # whose new Posts prevent reuse of this Search's results.
+    scope         = models.CharField(max_length=20, blank=True, db_index=True)
+    result_ids    = PackedIdsField()
+    partial       = models.BooleanField(default=False)
+
+    objects = SearchManager()
 
     def __unicode__(self):
         return '%s searched for %s at %s' % (
             self.user, self.get_type_display(), self.searched_at)
 
     def save(self, *args, **kwargs):
-        if not self.pk:
+        if not self.pk and self.searched_at is None:
             self.searched_at = datetime.datetime.now()
         super(Search, self).save(*args, **kwargs)
 
@@ -852,6 +1283,12 @@ class Search(models.Model):
         """
         return {self.POST_SEARCH: Post, self.TOPIC_SEARCH: Topic}[self.type]
 
+    def get_keywords(self):
+        """
+        Returns the raw search keywords this Search was performed with.
+        """
+        return simplejson.loads(self.criteria_json).get('keywords', u'')
+
     def is_post_search(self):
         """
         Returns ``True`` if this is a Post Search, ``False`` otherwise.
@@ -863,3 +1300,175 @@ class Search(models.Model):
         Returns ``True`` if this is a Topic Search, ``False`` otherwise.
         """
         return self.type == self.TOPIC_SEARCH
+
+class SearchIndexEntryManager(models.Manager):
+    def object_ids(self, type, term):
+        """
+        Creates a ``ValuesQuerySet`` of the ids of items of the given
+        type which contain the given term, suitable for use as a
+        subquery.
+        """
+        return self.filter(type=type, term=term).values('object_id')
+
+    def phrase_object_ids(self, type, phrase, max_ids=None):
+        """
+        Returns a set of the ids of items of the given type which contain
+        the searchable terms in the given phrase in the same relative
+        positions, by intersecting the positions recorded for each term.
+
+        Terms are intersected starting from the one which appears in the
+        fewest items, so only the positions of items which may still
+        match are loaded. If given, ``None`` is returned without loading
+        any positions if that term appears in more than ``max_ids``
+        items.
+
+        Words too short to be indexed aren't checked - they only keep
+        the terms either side of them apart.
+        """
+        terms = tokenize_positions(phrase)
+        if not terms:
+            return set()
+        # Offsets of each distinct term from the start of the phrase
+        offsets = {}
+        for position, term in terms:
+            offsets.setdefault(term, []).append(position - terms[0][0])
+        counts = dict(self.filter(type=type, term__in=offsets.keys()) \
+                          .values_list('term') \
+                          .order_by() \
+                          .annotate(count=models.Count('id')))
+        if len(counts) < len(offsets):
+            return set()
+        ordered_terms = sorted(offsets, key=lambda term: counts[term])
+        if max_ids is not None and counts[ordered_terms[0]] > max_ids:
+            return None
+        to_positions = self.model._meta.get_field('positions').to_python
+        # Positions in each item at which the phrase may still start
+        starts = None
+        for term in ordered_terms:
+            entries = self.filter(type=type, term=term)
+            if starts is None:
+                chunks = [entries]
+            else:
+                object_ids = starts.keys()
+                chunks = [entries.filter(
+                              object_id__in=object_ids[i:i+SQL_CHUNK_SIZE])
+                          for i in xrange(0, len(object_ids), SQL_CHUNK_SIZE)]
+            matched = {}
+            for chunk in chunks:
+                for object_id, positions in chunk.values_list('object_id',
+                                                              'positions'):
+                    positions = to_positions(positions)
+                    remaining = None
+                    for offset in offsets[term]:
+                        term_starts = set([p - offset for p in positions])
+                        if remaining is None:
+                            remaining = term_starts
+                        else:
+                            remaining &= term_starts
+                    if starts is not None:
+                        remaining &= starts[object_id]
+                    if remaining:
+                        matched[object_id] = remaining
+            starts = matched
+            if not starts:
+                break
+        return set(starts.keys())
+
+    def index_objects(self, type, texts):
+        """
+        Adds index entries for the terms in items of the given type, given
+        a list of (object id, text) two-tuples, using a single bulk insert.
+
+        Any existing entries for the items should already have been
+        removed. The caller is responsible for committing.
+        """
+        positions_field = self.model._meta.get_field('positions')
+        rows = []
+        for object_id, text in texts:
+            term_positions = {}
+            for position, term in tokenize_positions(text):
+                term_positions.setdefault(term, []).append(position)
+            rows.extend([(type, term, object_id,
+                          positions_field.get_db_prep_save(positions,
+                              connection=connection))
+                         for term, positions in term_positions.items()])
+        if not rows:
+            return
+        opts = self.model._meta
+        cursor = connection.cursor()
+        cursor.executemany("""
+            INSERT INTO %(index_table)s
+                (%(type)s, %(term)s, %(object_id)s, %(positions)s)
+            VALUES (%%s, %%s, %%s, %%s)""" % {
+                'index_table': qn(opts.db_table),
+                'type': qn(opts.get_field('type').column),
+                'term': qn(opts.get_field('term').column),
+                'object_id': qn(opts.get_field('object_id').column),
+                'positions': qn(positions_field.column),
+            }, rows)
+
+    def remove_objects(self, type, object_ids):
+        """
+        Removes all index entries for items of the given type with the
+        given ids. The caller is responsible for committing.
+        """
+        if not object_ids:
+            return
+        opts = self.model._meta
+        cursor = connection.cursor()
+        for i in xrange(0, len(object_ids), SQL_CHUNK_SIZE):
+            chunk = list(object_ids[i:i+SQL_CHUNK_SIZE])
+            cursor.execute("""
+                DELETE FROM %(index_table)s
+                WHERE %(type)s=%%s
+                  AND %(object_id)s IN (%(object_ids)s)""" % {
+                    'index_table': qn(opts.db_table),
+                    'type': qn(opts.get_field('type').column),
+                    'object_id': qn(opts.get_field('object_id').column),
+                    'object_ids': ','.join(['%s'] * len(chunk)),
+                }, [type] + chunk)
+
+    def clear(self):
+        """
+        Removes all index entries.
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % qn(self.model._meta.db_table))
+        transaction.commit_unless_managed()
+
+class SearchIndexEntry(models.Model):
+    """
+    An entry in the search index, recording that a term appears in a
+    Post's body or a Topic's title and the word positions it appears at.
+    """
+    type      = models.CharField(max_length=1, choices=Search.TYPE_CHOICES)
+    term      = models.CharField(max_length=50)
+    object_id = models.PositiveIntegerField(db_index=True)
+    positions = PackedIdsField()
+
+    objects = SearchIndexEntryManager()
+
+    def __unicode__(self):
+        return '%s in %s %s' % (self.term, self.get_type_display(),
+                                self.object_id)
+
+    class Meta:
+        unique_together = (('type', 'term', 'object_id'),)
+        verbose_name_plural = 'search index entries'
+
+class SearchIndexQueueEntry(models.Model):
+    """
+    A change to a Post or Topic which is waiting to be applied to the
+    search index - ``update`` is ``True`` if the item needs to be
+    (re)indexed or ``False`` if it needs to be removed from the index.
+    """
+    type      = models.CharField(max_length=1, choices=Search.TYPE_CHOICES)
+    object_id = models.PositiveIntegerField()
+    update    = models.BooleanField(default=True)
+
+    def __unicode__(self):
+        return '%s %s %s' % (self.update and 'Update' or 'Remove',
+                             self.get_type_display(), self.object_id)
+
+    class Meta:
+        verbose_name_plural = 'search index queue entries'
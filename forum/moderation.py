@@ -2,39 +2,33 @@
 Functions which perform moderation tasks - this can involve making
 multiple, complex changes to the items being moderated.
 """
-from forum.models import Post
+from django.db import transaction
 
-def _update_num_in_topic(post, topic):
-    """
-    Updates the ``num_in_topic`` field for Posts in the given Topic
-    affected by the given Post having its ``meta`` flag changed.
-    """
-    # Decrement num_in_topic for the post's current meta type
-    Post.objects.update_num_in_topic(topic, post.num_in_topic, increment=False,
-                                     meta=not post.meta)
-    try:
-        # Find the first prior post of the new meta type by post time -
-        # fall back on id if times are equal.
-        previous_post = \
-            (topic.posts.filter(meta=post.meta, posted_at__lt=post.posted_at) | \
-             topic.posts.filter(meta=post.meta, posted_at=post.posted_at, pk__lt=post.pk)) \
-             .order_by('-posted_at', '-id')[0]
-        post.num_in_topic = previous_post.num_in_topic + 1
-        increment_from = previous_post.num_in_topic
-    except IndexError:
-        # There is no existing, earlier post - make this the first
-        post.num_in_topic = 1
-        increment_from = 0
-    # Increment num_in_topic for the post's new meta type
-    Post.objects.update_num_in_topic(topic, increment_from, increment=True,
-                                     meta=post.meta)
-    # Save the post to update its meta and num_in_topic attributes
-    post.save()
+from forum.counters import flush_counters, get_counter_buffer
+from forum.models import Forum, ForumProfile, Post, Search, Topic
+from forum.search import SQL_CHUNK_SIZE, search_backend
+
+def _with_waiting_changes(topic, forum):
+    """
+    Applies any changes waiting in the counter buffer, returning the given
+    Topic and Forum as updated by them.
+    """
+    if get_counter_buffer() is None:
+        return topic, forum
+    flush_counters()
+    return Topic.objects.get(pk=topic.pk), Forum.objects.get(pk=forum.pk)
+
+def _chunks(ids):
+    """
+    Splits a list of ids into lists which can be used in a single query.
+    """
+    return [ids[i:i+SQL_CHUNK_SIZE] for i in xrange(0, len(ids), SQL_CHUNK_SIZE)]
 
 def make_post_not_meta(post, topic, forum):
     """
     Performs changes required to turn a metapost into a regular post.
     """
+    topic, forum = _with_waiting_changes(topic, forum)
     # If this becomes the new last post in its topic, the topic will need
     # its last post details updated.
     is_last_in_topic = False
@@ -45,8 +39,9 @@ def make_post_not_meta(post, topic, forum):
     is_last_in_forum = False
     if post.posted_at > forum.last_post_at:
         is_last_in_forum = True
-    # Update num_in_topic for all affected posts
-    _update_num_in_topic(post, topic)
+    # The post keeps its num_in_topic, which orders it among posts of
+    # either type.
+    post.save()
     # Make any changes required to the topic and forum
     if is_last_in_topic:
         topic.set_last_post(post)
@@ -60,6 +55,7 @@ def make_post_meta(post, topic, forum):
     """
     Performs changes required to turn a regular post into a metapost.
     """
+    topic, forum = _with_waiting_changes(topic, forum)
     # If this was the last post in its topic, the topic will need its
     # last post details updated.
     was_last_in_topic = False
@@ -73,8 +69,9 @@ def make_post_meta(post, topic, forum):
        forum.last_post_at == post.posted_at and \
        forum.last_user_id == post.user_id:
         was_last_in_forum = True
-    # Update num_in_topic for all affected posts
-    _update_num_in_topic(post, topic)
+    # The post keeps its num_in_topic, which orders it among posts of
+    # either type.
+    post.save()
     # Make any changes required to the topic and forum
     if was_last_in_topic:
         topic.set_last_post()
@@ -83,3 +80,156 @@ def make_post_meta(post, topic, forum):
     topic.update_post_count(meta=True)
     if was_last_in_forum:
         forum.set_last_post()
+
+def _update_moved_post_details(topic, first_post_id, from_topic_ids,
+                               forum_ids=()):
+    """
+    Recalculates denormalised data once Posts have been moved into the
+    given Topic, whose first Post before the move had the given id, from
+    the Topics with the given ids, which must still have Posts, and
+    updates the Forums they're in and those with the given ids.
+    """
+    topic.renumber_posts(first_post_id)
+    topics = [topic] + list(Topic.objects.filter(pk__in=from_topic_ids))
+    forum_ids = set(forum_ids)
+    for affected_topic in topics:
+        affected_topic.update_post_count(meta=True)
+        affected_topic.set_last_post()
+        forum_ids.add(affected_topic.forum_id)
+    for forum in Forum.objects.filter(pk__in=forum_ids):
+        forum.set_last_post()
+        Search.objects.invalidate_forum(forum)
+
+def move_posts(posts, topic):
+    """
+    Moves the given Posts to the given Topic in a single transaction,
+    updating their Topic with set-based updates and recalculating the
+    denormalised data of the Topics and Forums involved once.
+
+    Moved Posts keep their posting times, so they're numbered into the
+    Topic's existing Posts in posting order after its first Post.
+
+    Raises ``ValueError`` if the Posts include the first Post of a Topic
+    they're being moved from, which would leave it without an opening
+    Post - use ``merge_topics`` to move all of a Topic's Posts.
+    """
+    flush_counters()
+    first_post_id = topic.get_first_post().pk
+    post_ids = []
+    from_topic_ids = set()
+    for post in posts:
+        post_ids.append(post.pk)
+        from_topic_ids.add(post.topic_id)
+    from_topic_ids.discard(topic.pk)
+    moved_post_ids = set(post_ids)
+    for from_topic in Topic.objects.filter(pk__in=list(from_topic_ids)):
+        if from_topic.get_first_post().pk in moved_post_ids:
+            raise ValueError('The first Post in Topic %s can\'t be moved - '
+                             'use merge_topics to move all of its Posts.' %
+                             from_topic.pk)
+    for chunk in _chunks(post_ids):
+        Post.objects.filter(pk__in=chunk).update(topic=topic)
+    _update_moved_post_details(topic, first_post_id, from_topic_ids)
+    transaction.commit_unless_managed()
+
+def merge_topics(topics, topic):
+    """
+    Moves all Posts from the given Topics into the given Topic and
+    deletes the emptied Topics in a single transaction, recalculating
+    the denormalised data of the Topic and Forums involved once.
+
+    The given Topic's first Post stays first, followed by the other
+    Posts in posting order.
+    """
+    flush_counters()
+    topic_ids = [merged.pk for merged in topics if merged.pk != topic.pk]
+    if not topic_ids:
+        return
+    first_post_id = topic.get_first_post().pk
+    forum_topic_counts = {}
+    for merged in Topic.objects.filter(pk__in=topic_ids):
+        forum_topic_counts[merged.forum_id] = \
+            forum_topic_counts.get(merged.forum_id, 0) + 1
+    Post.objects.filter(topic__in=topic_ids).update(topic=topic)
+    search_backend.remove_topics(topic_ids)
+    Topic.objects.filter(pk__in=topic_ids).delete()
+    for forum in Forum.objects.filter(pk__in=forum_topic_counts.keys()):
+        forum.increment_topic_count(-forum_topic_counts[forum.pk])
+    _update_moved_post_details(topic, first_post_id, [],
+                               forum_topic_counts.keys())
+    transaction.commit_unless_managed()
+
+def purge_user(user, dry_run=False):
+    """
+    Deletes all Topics started by the given User, including any replies
+    to them by other Users, and all Posts made by the given User, in a
+    single transaction.
+
+    Topics and Posts are deleted in chunks, after which the denormalised
+    data of the remaining Topics and the Forums and ForumProfiles
+    involved is recalculated once.
+
+    Returns a dict reporting the number of ``topics`` and ``posts``
+    deleted and the number of remaining Topics (``updated_topics``),
+    Forums (``updated_forums``) and other Users' ForumProfiles
+    (``updated_profiles``) which needed updating. If ``dry_run`` is
+    ``True``, nothing is deleted and the report describes what would be
+    changed.
+    """
+    flush_counters()
+    topic_forum_ids = dict(Topic.objects.filter(user=user) \
+                                        .values_list('id', 'forum'))
+    post_ids = []
+    updated_topic_ids = set()
+    for post_id, topic_id in Post.objects.filter(user=user) \
+                                         .values_list('id', 'topic').iterator():
+        post_ids.append(post_id)
+        if topic_id not in topic_forum_ids:
+            updated_topic_ids.add(topic_id)
+    user_post_counts = {}
+    if post_ids:
+        user_post_counts[user.pk] = len(post_ids)
+    # Other Users' replies to the User's Topics are deleted with them
+    for topic_ids in _chunks(topic_forum_ids.keys()):
+        for post_id, user_id in Post.objects.filter(topic__in=topic_ids) \
+                                            .exclude(user=user) \
+                                            .values_list('id', 'user'):
+            post_ids.append(post_id)
+            user_post_counts[user_id] = user_post_counts.get(user_id, 0) + 1
+    forum_ids = set(topic_forum_ids.values())
+    updated_topic_ids = list(updated_topic_ids)
+    for topic_ids in _chunks(updated_topic_ids):
+        forum_ids.update(Topic.objects.filter(pk__in=topic_ids) \
+                                      .values_list('forum', flat=True))
+    report = {
+        'topics': len(topic_forum_ids),
+        'posts': len(post_ids),
+        'updated_topics': len(updated_topic_ids),
+        'updated_forums': len(forum_ids),
+        'updated_profiles': len([user_id for user_id in user_post_counts
+                                 if user_id != user.pk]),
+    }
+    if dry_run:
+        return report
+
+    search_backend.remove_topics(topic_forum_ids.keys())
+    search_backend.remove_posts(post_ids)
+    ForumProfile.objects.subtract_post_counts(user_post_counts.items())
+    for chunk in _chunks(post_ids):
+        Post.objects.filter(pk__in=chunk).delete()
+    for chunk in _chunks(topic_forum_ids.keys()):
+        Topic.objects.filter(pk__in=chunk).delete()
+    for topic_ids in _chunks(updated_topic_ids):
+        for topic in Topic.objects.filter(pk__in=topic_ids):
+            topic.update_post_count(meta=True)
+            if topic.posts.filter(meta=False).exists():
+                topic.set_last_post()
+            else:
+                # The opening post must have been made a metapost
+                topic.update_post_count(meta=False)
+    for forum in Forum.objects.filter(pk__in=forum_ids):
+        forum.update_topic_count()
+        forum.set_last_post()
+        Search.objects.invalidate_forum(forum)
+    transaction.commit_unless_managed()
+    return report
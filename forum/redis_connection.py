@@ -5,6 +5,7 @@ import datetime
 import time
 
 from django.core import signals
+from django.utils import simplejson
 from django.utils.html import escape
 
 import redis
@@ -20,6 +21,12 @@ ACTIVE_USERS = 'au'
 USER_USERNAME = 'u:%s:un'
 USER_LAST_SEEN = 'u:%s:s'
 USER_DOING = 'u:%s:d'
+FORMATTED_POST = 'fp:%s'
+PENDING_COUNTERS = 'pc'
+COUNTER_CHANGES = 'pc:%s:%s'
+LAST_POST_CHANGES = 'pc:%s:%s:l'
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 
 def increment_view_count(topic):
     """Increments the view count for a Topic."""
@@ -101,3 +108,63 @@ def get_last_seen(user):
         last_seen = user.date_joined
     doing = r.get(USER_DOING % user.pk)
     return last_seen, doing
+
+def get_formatted_post(key):
+    """Gets a cached formatted post body, or ``None``."""
+    html = r.get(FORMATTED_POST % key)
+    if html is not None:
+        return html.decode('utf-8')
+    return None
+
+def set_formatted_post(key, html, timeout):
+    """Caches a formatted post body for ``timeout`` seconds."""
+    r.setex(FORMATTED_POST % key, timeout, html.encode('utf-8'))
+
+def add_counter_changes(counts, last_posts):
+    """
+    Adds changes to denormalised Post counts and last Post details to
+    those waiting to be applied, as held by ``forum.counters``.
+
+    Last Post details are held in a sorted set scored by the Post's time,
+    so the latest can be taken.
+    """
+    pipe = r.pipeline()
+    for (kind, object_id, field_name), amount in counts.items():
+        pipe.hincrby(COUNTER_CHANGES % (kind, object_id), field_name, amount)
+        pipe.sadd(PENDING_COUNTERS, '%s:%s' % (kind, object_id))
+    for (kind, object_id), details in last_posts.items():
+        posted_at = details[0]
+        pipe.zadd(LAST_POST_CHANGES % (kind, object_id),
+                  time.mktime(posted_at.timetuple()) + posted_at.microsecond / 1e6,
+                  simplejson.dumps([posted_at.strftime(DATETIME_FORMAT)] +
+                                   list(details[1:])))
+        pipe.sadd(PENDING_COUNTERS, '%s:%s' % (kind, object_id))
+    pipe.execute()
+
+def take_counter_changes():
+    """
+    Removes and returns all changes waiting to be applied, as a dict of
+    count changes and a dict of the latest last Post details.
+
+    Objects are marked as no longer pending before their changes are
+    taken, so changes added in the meantime are never left unmarked.
+    """
+    counts, last_posts = {}, {}
+    for pending in r.smembers(PENDING_COUNTERS):
+        r.srem(PENDING_COUNTERS, pending)
+        kind, object_id = pending.split(':')
+        object_id = int(object_id)
+        pipe = r.pipeline()
+        pipe.hgetall(COUNTER_CHANGES % (kind, object_id))
+        pipe.zrange(LAST_POST_CHANGES % (kind, object_id), -1, -1)
+        pipe.delete(COUNTER_CHANGES % (kind, object_id),
+                    LAST_POST_CHANGES % (kind, object_id))
+        changes, latest, deleted = pipe.execute()
+        for field_name, amount in changes.items():
+            counts[(kind, object_id, field_name)] = int(amount)
+        if latest:
+            details = simplejson.loads(latest[0])
+            last_posts[(kind, object_id)] = tuple(
+                [datetime.datetime.strptime(details[0], DATETIME_FORMAT)] +
+                details[1:])
+    return counts, last_posts
@@ -0,0 +1,845 @@
+"""
+Search backends, which are responsible for turning search keywords into
+filters and for maintaining any index required to do so.
+"""
+import atexit
+import datetime
+import math
+import operator
+import re
+import threading
+import time
+
+from django.core import signals
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.query_utils import Q
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.text import smart_split
+
+MIN_TERM_LENGTH = 3
+MAX_TERM_LENGTH = 50
+
+# Maximum number of ids to use in a single IN clause
+SQL_CHUNK_SIZE = 500
+
+# Maximum number of words in a search result snippet
+SNIPPET_WORDS = 30
+
+# BM25 term frequency saturation and document length normalisation
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+term_re = re.compile(r'\w+', re.UNICODE)
+# Splitting with a group alternates between the text in between terms and
+# the terms themselves.
+term_split_re = re.compile(r'(\w+)', re.UNICODE)
+
+qn = connection.ops.quote_name
+
+def tokenize(text):
+    """
+    Returns a list of the searchable terms in the given text, in the order
+    in which they appear.
+
+    Terms are lowercased and terms shorter than ``MIN_TERM_LENGTH`` are
+    dropped, which matches the minimum keyword length enforced when
+    searching.
+    """
+    return [term for position, term in tokenize_positions(text)]
+
+def tokenize_positions(text):
+    """
+    Returns a list of (position, term) two-tuples for the searchable terms
+    in the given text, as for ``tokenize``.
+
+    Positions are word positions which also count dropped words, so
+    words which are too short to be searchable still separate terms.
+    """
+    return [(position, term[:MAX_TERM_LENGTH])
+            for position, term in enumerate(term_re.findall(text.lower()))
+            if len(term) >= MIN_TERM_LENGTH]
+
+def parse_keywords(keywords):
+    """
+    Parses raw search keywords into a 4-tuple of lists of (required
+    keywords, excluded keywords, optional keywords, phrases).
+
+    Keywords prefixed with ``+`` are required, those prefixed with ``-``
+    are excluded and those wrapped in single or double quotes are phrases.
+    """
+    required, excluded, one_of, phrases = [], [], [], []
+    for keyword in smart_split(keywords):
+        if keyword[0] == '+':
+            required.append(keyword[1:])
+        elif keyword[0] == '-':
+            excluded.append(keyword[1:])
+        elif keyword[0] == '"' and keyword[-1] == '"' or \
+             keyword[0] == "'" and keyword[-1] == "'":
+            phrases.append(keyword[1:-1])
+        else:
+            one_of.append(keyword)
+    return required, excluded, one_of, phrases
+
+def get_keyword_terms(keywords):
+    """
+    Returns a set of the searchable terms in raw search keywords which
+    matching items may contain - i.e. those which aren't excluded.
+    """
+    required, excluded, one_of, phrases = parse_keywords(keywords)
+    return set(tokenize(u' '.join(required + one_of + phrases)))
+
+def make_snippet(text, terms, max_words=SNIPPET_WORDS):
+    """
+    Creates an HTML snippet of up to ``max_words`` words from the given
+    text, starting shortly before the first word which contains any of
+    the given terms, with the parts of words which contain them
+    highlighted.
+    """
+    is_match = lambda token: any([term in token.lower() for term in terms])
+    words = text.split()
+    matches = [any(map(is_match, term_re.findall(word))) for word in words]
+    start = 0
+    if True in matches:
+        start = max(min(matches.index(True) - max_words // 3,
+                        len(words) - max_words), 0)
+    end = start + max_words
+    html = []
+    if start > 0:
+        html.append('&hellip;')
+    for word, matched in zip(words[start:end], matches[start:end]):
+        if not matched:
+            html.append(escape(word))
+            continue
+        parts = term_split_re.split(word)
+        html.append(u''.join([i % 2 and is_match(part) and
+                              '<strong class="highlight">%s</strong>' % part or
+                              escape(part) for i, part in enumerate(parts)]))
+    if end < len(words):
+        html.append('&hellip;')
+    return mark_safe(u' '.join(html))
+
+def id_range_chunks(queryset, chunk_size, descending=True):
+    """
+    Splits the given ``QuerySet`` into a sequence of ``QuerySets`` each
+    restricted to a range of ``chunk_size`` consecutive ids, in descending
+    or ascending id order, so no chunk can examine more than
+    ``chunk_size`` rows however few of them match.
+    """
+    bounds = queryset.model._default_manager.aggregate(
+        min_id=models.Min('id'), max_id=models.Max('id'))
+    if bounds['min_id'] is None:
+        return
+    if descending:
+        queryset = queryset.order_by('-id')
+        for high in xrange(bounds['max_id'], bounds['min_id'] - 1, -chunk_size):
+            yield queryset.filter(pk__range=(high - chunk_size + 1, high))
+    else:
+        queryset = queryset.order_by('id')
+        for low in xrange(bounds['min_id'], bounds['max_id'] + 1, chunk_size):
+            yield queryset.filter(pk__range=(low, low + chunk_size - 1))
+
+def keyset_chunks(queryset, chunk_size, descending=True):
+    """
+    Splits the rows of the given ``values_list`` ``QuerySet``, whose
+    first value is each item's id, into a sequence of lists of up to
+    ``chunk_size`` rows in descending or ascending id order.
+
+    Each chunk picks up after the last id in the previous chunk, so only
+    rows which match the ``QuerySet`` are examined. Chunks are fetched as
+    they are needed.
+    """
+    if descending:
+        queryset, lookup = queryset.order_by('-id'), 'pk__lt'
+    else:
+        queryset, lookup = queryset.order_by('id'), 'pk__gt'
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_id = chunk[-1]
+        if isinstance(last_id, tuple):
+            last_id = last_id[0]
+        chunk = list(queryset.filter(**{lookup: last_id})[:chunk_size])
+
+class SearchBackend(object):
+    """
+    Base search backend.
+
+    If used as a search backend itself, performs case-insensitive
+    substring matching against Post bodies and Topic titles, which
+    requires no index to be maintained.
+    """
+    def filter_queryset(self, queryset, search_type, keywords):
+        """
+        Restricts the given Post or Topic ``QuerySet``, depending on
+        ``search_type``, to items which match the given raw search
+        keywords.
+        """
+        filters = self.get_filters(search_type, keywords)
+        if filters:
+            queryset = queryset.filter(reduce(operator.and_, filters))
+        return queryset
+
+    def get_filters(self, search_type, keywords):
+        """
+        Returns a list of ``Q`` objects which restrict a Post or Topic
+        ``QuerySet``, depending on ``search_type``, to items which match
+        the given raw search keywords.
+        """
+        required, excluded, one_of, phrases = parse_keywords(keywords)
+        filters = [self.keyword_filter(search_type, keyword)
+                   for keyword in required]
+        filters.extend([~self.keyword_filter(search_type, keyword)
+                        for keyword in excluded])
+        if one_of:
+            filters.append(reduce(operator.or_,
+                [self.keyword_filter(search_type, keyword)
+                 for keyword in one_of]))
+        if phrases:
+            filters.append(reduce(operator.or_,
+                [self.phrase_filter(search_type, phrase)
+                 for phrase in phrases]))
+        return filters
+
+    def keyword_filter(self, search_type, keyword):
+        """
+        Creates a ``Q`` object matching items which contain the given
+        keyword.
+        """
+        return Q(**{'%s__icontains' % self.get_text_field(search_type): keyword})
+
+    def phrase_filter(self, search_type, phrase):
+        """
+        Creates a ``Q`` object matching items which contain the given
+        phrase.
+        """
+        return Q(**{'%s__icontains' % self.get_text_field(search_type): phrase})
+
+    def get_model(self, search_type):
+        """
+        Returns the model class which is searched for the given search
+        type.
+        """
+        from forum.models import Post, Search, Topic
+        return {Search.POST_SEARCH: Post, Search.TOPIC_SEARCH: Topic}[search_type]
+
+    def get_text_field(self, search_type):
+        """
+        Returns the name of the field which is searched for the given
+        search type.
+        """
+        from forum.models import Search
+        return {Search.POST_SEARCH: 'body', Search.TOPIC_SEARCH: 'title'}[search_type]
+
+    def get_snippets(self, search_type, object_ids, keywords):
+        """
+        Returns a dict mapping the given ids of items of the given type to
+        HTML snippets of their text, highlighting the given raw search
+        keywords.
+        """
+        terms = get_keyword_terms(keywords)
+        return dict([(object_id, make_snippet(text, terms))
+                     for object_id, text in \
+                     self.get_model(search_type).objects.filter(
+                         pk__in=list(object_ids)).values_list('id',
+                             self.get_text_field(search_type))])
+
+    def get_date_field(self, search_type):
+        """
+        Returns the name of the field used to determine how recent items
+        are for the given search type.
+        """
+        from forum.models import Search
+        return {Search.POST_SEARCH: 'posted_at', Search.TOPIC_SEARCH: 'started_at'}[search_type]
+
+    def rank_items(self, items, keywords, limit):
+        """
+        Returns a list of the ids of up to ``limit`` of the given items,
+        ordered by relevance to the given raw search keywords, given a
+        list of (id, searchable text, date) three-tuples for matching
+        items, most recent first.
+
+        Relevance is the BM25 score of each item's text for the terms in
+        the keywords which aren't excluded, boosted for recent items.
+        """
+        terms = get_keyword_terms(keywords)
+        if not terms:
+            return [object_id for object_id, text, date in items][:limit]
+        candidates = []
+        doc_freqs = dict([(term, 0) for term in terms])
+        total_length = 0
+        for object_id, text, date in items:
+            tokens = tokenize(text)
+            term_freqs = {}
+            for token in tokens:
+                if token in terms:
+                    term_freqs[token] = term_freqs.get(token, 0) + 1
+            for term in term_freqs:
+                doc_freqs[term] += 1
+            total_length += len(tokens)
+            candidates.append((object_id, date, len(tokens), term_freqs))
+        if not candidates:
+            return []
+        doc_count = len(candidates)
+        average_length = float(total_length) / doc_count or 1.0
+        idfs = dict([(term, math.log(1.0 + (doc_count - df + 0.5) / (df + 0.5)))
+                     for term, df in doc_freqs.items()])
+        now = datetime.datetime.now()
+        scored = []
+        for object_id, date, length, term_freqs in candidates:
+            score = 0.0
+            for term, tf in term_freqs.items():
+                score += idfs[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * \
+                    (1 - BM25_B + BM25_B * length / average_length))
+            score *= 1 + self.recency_boost(now - date)
+            scored.append((score, date, object_id))
+        scored.sort(reverse=True)
+        return [object_id for _score, _date, object_id in scored[:limit]]
+
+    def recency_boost(self, age):
+        """
+        Returns the proportion by which the relevance of an item of the
+        given age, a ``timedelta``, is increased - this starts at
+        ``FORUM_SEARCH_RECENCY_BOOST`` and halves every
+        ``FORUM_SEARCH_BOOST_HALF_LIFE`` days.
+        """
+        from forum import app_settings
+        age_in_days = max(age.days + age.seconds / 86400.0, 0)
+        return app_settings.SEARCH_RECENCY_BOOST * \
+            0.5 ** (age_in_days / app_settings.SEARCH_BOOST_HALF_LIFE)
+
+    def update_post(self, post):
+        """
+        Called when a Post has been created or edited.
+        """
+        pass
+
+    def update_topic(self, topic):
+        """
+        Called when a Topic has been created or edited.
+        """
+        pass
+
+    def remove_posts(self, post_ids):
+        """
+        Called when Posts with the given ids are being deleted.
+
+        ``post_ids`` may be a lazy ``QuerySet``, which will only be
+        evaluated by backends which maintain an index.
+        """
+        pass
+
+    def remove_topics(self, topic_ids):
+        """
+        Called when Topics with the given ids are being deleted.
+
+        ``topic_ids`` may be a lazy ``QuerySet``, which will only be
+        evaluated by backends which maintain an index.
+        """
+        pass
+
+    def request_finished(self):
+        """
+        Called at the end of each request, to apply pending changes to
+        the index if it's time to.
+        """
+        pass
+
+    def flush(self):
+        """
+        Applies any pending changes to the index.
+        """
+        pass
+
+    def rebuild(self, chunk_size=1000, progress=None):
+        """
+        Rebuilds the index from scratch.
+        """
+        pass
+
+class IndexedSearchBackend(SearchBackend):
+    """
+    Base class for search backends which maintain an index.
+
+    Changes are queued as deltas in the ``SearchIndexQueueEntry`` table,
+    as part of the transaction which changes the items, so they survive
+    the process which queued them and can be applied by any process.
+    Queued changes are coalesced and applied to the index in batches once
+    this process has queued changes to ``batch_size`` items or
+    ``max_delay`` seconds have passed since it last applied them, which
+    is checked at the end of each request.
+
+    Subclasses must implement ``add_to_index``, ``remove_from_index`` and
+    ``clear_index``. Changes made by ``add_to_index`` and
+    ``remove_from_index`` are committed by their caller, so an item's
+    removal and reinsertion are committed together.
+    """
+    def __init__(self, batch_size=None, max_delay=None):
+        from forum import app_settings
+        if batch_size is None: batch_size = app_settings.SEARCH_INDEX_BATCH_SIZE
+        if max_delay is None: max_delay = app_settings.SEARCH_INDEX_MAX_DELAY
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        # (search type, object id) of items this process has queued
+        # changes to since it last applied changes.
+        self.queued = set()
+        self.last_flushed_at = time.time()
+        self.lock = threading.Lock()
+
+    def update_post(self, post):
+        from forum.models import Search
+        self.enqueue(Search.POST_SEARCH, [post.pk], True)
+
+    def update_topic(self, topic):
+        from forum.models import Search
+        self.enqueue(Search.TOPIC_SEARCH, [topic.pk], True)
+
+    def remove_posts(self, post_ids):
+        from forum.models import Search
+        self.enqueue(Search.POST_SEARCH, post_ids, False)
+
+    def remove_topics(self, topic_ids):
+        from forum.models import Search
+        self.enqueue(Search.TOPIC_SEARCH, topic_ids, False)
+
+    def enqueue(self, search_type, object_ids, update):
+        """
+        Queues index changes for items of the given type - ``update`` is
+        ``True`` if they need to be (re)indexed or ``False`` if they need
+        to be removed from the index.
+
+        Changes are committed by the caller, along with the changes made
+        to the items.
+        """
+        from forum.models import SearchIndexQueueEntry
+        object_ids = list(object_ids)
+        if not object_ids:
+            return
+        opts = SearchIndexQueueEntry._meta
+        connection.cursor().executemany("""
+            INSERT INTO %s (%s, %s, %s)
+            VALUES (%%s, %%s, %%s)""" % (
+                qn(opts.db_table),
+                qn(opts.get_field('type').column),
+                qn(opts.get_field('object_id').column),
+                qn(opts.get_field('update').column),
+            ), [(search_type, object_id, update) for object_id in object_ids])
+        self.lock.acquire()
+        try:
+            self.queued.update([(search_type, object_id)
+                                for object_id in object_ids])
+        finally:
+            self.lock.release()
+
+    def request_finished(self, **kwargs):
+        """
+        Applies queued changes if this process has queued changes to
+        ``batch_size`` items or hasn't applied them for ``max_delay``
+        seconds, so changes queued by processes which have since died or
+        gone idle are also applied.
+        """
+        if len(self.queued) >= self.batch_size or \
+           time.time() - self.last_flushed_at >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """
+        Applies all queued changes to the index, in chunks in the order
+        they were queued, and removes them from the queue in the same
+        transaction. Only the latest change queued for each item in a
+        chunk is applied, using a bulk removal and a bulk insert for each
+        search type.
+
+        The text of items being (re)indexed is read at this point, so the
+        index reflects the latest saved version of each item.
+
+        If another process reindexed any of the same items between the
+        removal and the insert, the insert fails on the index's unique
+        constraint - the changes are then rolled back and applied to one
+        item at a time, leaving the other process's entries in place for
+        items it has just indexed again.
+        """
+        from forum.models import Search, SearchIndexQueueEntry
+        self.lock.acquire()
+        try:
+            self.queued = set()
+            self.last_flushed_at = time.time()
+        finally:
+            self.lock.release()
+        queryset = SearchIndexQueueEntry.objects.order_by('id').values_list(
+            'id', 'type', 'object_id', 'update')
+        last_id = 0
+        while True:
+            queued = list(queryset.filter(pk__gt=last_id)[:SQL_CHUNK_SIZE])
+            if not queued:
+                break
+            pending = {}
+            for entry_id, search_type, object_id, update in queued:
+                pending[(search_type, object_id)] = update
+            for search_type in (Search.POST_SEARCH, Search.TOPIC_SEARCH):
+                object_ids = [object_id for (t, object_id) in pending
+                              if t == search_type]
+                if not object_ids:
+                    continue
+                texts = self.get_texts(search_type,
+                                       [object_id for object_id in object_ids
+                                        if pending[(search_type, object_id)]])
+                if not self.replace_in_index(search_type, object_ids, texts):
+                    texts = dict(texts)
+                    for object_id in object_ids:
+                        item_texts = []
+                        if object_id in texts:
+                            item_texts.append((object_id, texts[object_id]))
+                        self.replace_in_index(search_type, [object_id],
+                                              item_texts)
+            SearchIndexQueueEntry.objects.filter(
+                pk__in=[entry[0] for entry in queued]).delete()
+            transaction.commit_unless_managed()
+            if len(queued) < SQL_CHUNK_SIZE:
+                break
+            last_id = queued[-1][0]
+
+    def replace_in_index(self, search_type, object_ids, texts):
+        """
+        Removes items of the given type with the given ids from the index
+        and indexes the given list of (object id, searchable text)
+        two-tuples, within a savepoint.
+
+        Returns ``False`` if the insert failed because some of the items
+        had already been indexed again, after rolling back to the
+        savepoint.
+        """
+        sid = transaction.savepoint()
+        try:
+            self.remove_from_index(search_type, object_ids)
+            self.add_to_index(search_type, texts)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+    def get_texts(self, search_type, object_ids):
+        """
+        Returns a list of (object id, searchable text) two-tuples for
+        items of the given type which still exist.
+        """
+        model = self.get_model(search_type)
+        texts = []
+        for i in xrange(0, len(object_ids), SQL_CHUNK_SIZE):
+            texts.extend(model.objects.filter(
+                pk__in=object_ids[i:i+SQL_CHUNK_SIZE]).values_list(
+                    'id', self.get_text_field(search_type)))
+        return texts
+
+    def rebuild(self, chunk_size=1000, progress=None):
+        """
+        Rebuilds the index from scratch, reading items in chunks of
+        ``chunk_size`` in id order.
+
+        If given, ``progress`` will be called with the search type, the
+        number of items indexed so far and the total number of items
+        after each chunk has been indexed.
+        """
+        from forum.models import Search, SearchIndexQueueEntry
+        self.lock.acquire()
+        try:
+            self.queued = set()
+            self.last_flushed_at = time.time()
+        finally:
+            self.lock.release()
+        # Changes queued so far are covered by reading every item again
+        SearchIndexQueueEntry.objects.all().delete()
+        self.clear_index()
+        for search_type in (Search.POST_SEARCH, Search.TOPIC_SEARCH):
+            queryset = self.get_model(search_type).objects.order_by('id')
+            total = queryset.count()
+            indexed, last_id = 0, 0
+            while True:
+                texts = list(queryset.filter(pk__gt=last_id).values_list(
+                    'id', self.get_text_field(search_type))[:chunk_size])
+                if not texts:
+                    break
+                self.add_to_index(search_type, texts)
+                transaction.commit_unless_managed()
+                indexed += len(texts)
+                last_id = texts[-1][0]
+                if progress is not None:
+                    progress(search_type, indexed, total)
+
+    def add_to_index(self, search_type, texts):
+        """
+        Indexes items of the given type, given a list of (object id,
+        searchable text) two-tuples for items which are not currently in
+        the index.
+        """
+        raise NotImplementedError
+
+    def remove_from_index(self, search_type, object_ids):
+        """
+        Removes items of the given type with the given ids from the index.
+        """
+        raise NotImplementedError
+
+    def clear_index(self):
+        """
+        Removes everything from the index.
+        """
+        raise NotImplementedError
+
+class InvertedIndexBackend(IndexedSearchBackend):
+    """
+    Search backend which maintains an inverted index of the terms used
+    in Post bodies and Topic titles, so keyword lookups are resolved
+    against the index rather than by scanning every Post.
+
+    Keywords match whole terms rather than arbitrary substrings.
+    """
+    def keyword_filter(self, search_type, keyword):
+        """
+        Creates a ``Q`` object matching items which contain every term
+        in the given keyword, falling back to substring matching if the
+        keyword contains no indexable terms.
+        """
+        from forum.models import SearchIndexEntry
+        terms = set(tokenize(keyword))
+        if not terms:
+            return super(InvertedIndexBackend, self).keyword_filter(
+                search_type, keyword)
+        return reduce(operator.and_,
+            [Q(pk__in=SearchIndexEntry.objects.object_ids(search_type, term))
+             for term in terms])
+
+    def phrase_filter(self, search_type, phrase):
+        """
+        Creates a ``Q`` object matching items which contain the terms in
+        the given phrase in the same relative positions, resolved using
+        the positions recorded in the index. If the phrase contains words
+        too short to be indexed, those items must also contain the phrase
+        itself as a substring.
+
+        If the phrase contains no indexable terms, or its rarest term
+        appears in too many items to filter by their ids, the index is
+        only used to find items containing every term in the phrase and
+        the phrase itself is then matched as a substring.
+        """
+        from forum.models import SearchIndexEntry
+        substring_filter = super(InvertedIndexBackend, self).phrase_filter(
+            search_type, phrase)
+        terms = tokenize(phrase)
+        if not terms:
+            return substring_filter
+        object_ids = SearchIndexEntry.objects.phrase_object_ids(search_type,
+            phrase, max_ids=SQL_CHUNK_SIZE)
+        if object_ids is None:
+            return self.keyword_filter(search_type, phrase) & substring_filter
+        ids_filter = Q(pk__in=sorted(object_ids))
+        if len(terms) < len(term_re.findall(phrase)):
+            return ids_filter & substring_filter
+        return ids_filter
+
+    def add_to_index(self, search_type, texts):
+        from forum.models import SearchIndexEntry
+        SearchIndexEntry.objects.index_objects(search_type, texts)
+
+    def remove_from_index(self, search_type, object_ids):
+        from forum.models import SearchIndexEntry
+        SearchIndexEntry.objects.remove_objects(search_type, object_ids)
+
+    def clear_index(self):
+        from forum.models import SearchIndexEntry
+        SearchIndexEntry.objects.clear()
+
+class SQLiteFTSBackend(IndexedSearchBackend):
+    """
+    Search backend for SQLite databases which mirrors Post bodies and
+    Topic titles into FTS5 full-text tables and translates search
+    keywords into FTS5 ``MATCH`` expressions.
+
+    The full-text tables are created by ``syncdb`` while this is the
+    configured backend, or by rebuilding the index when switching to it.
+
+    Keywords match whole terms rather than arbitrary substrings.
+    """
+    def __init__(self, *args, **kwargs):
+        from django.core import exceptions
+        if connection.vendor != 'sqlite':
+            raise exceptions.ImproperlyConfigured, 'The SQLite full-text search backend can only be used with SQLite databases'
+        super(SQLiteFTSBackend, self).__init__(*args, **kwargs)
+
+    def get_table(self, search_type):
+        """
+        Returns the name of the full-text table for the given search type.
+        """
+        return '%s_fts' % self.get_model(search_type)._meta.db_table
+
+    def create_tables(self):
+        """
+        Creates the full-text tables if they don't already exist.
+
+        Creating a table will commit any open transaction, as SQLite
+        commits before executing DDL statements.
+        """
+        from forum.models import Search
+        cursor = connection.cursor()
+        existing_tables = connection.introspection.get_table_list(cursor)
+        for search_type in (Search.POST_SEARCH, Search.TOPIC_SEARCH):
+            if self.get_table(search_type) not in existing_tables:
+                cursor.execute('CREATE VIRTUAL TABLE %s USING fts5(%s)' % (
+                    qn(self.get_table(search_type)),
+                    qn(self.get_text_field(search_type))))
+        transaction.commit_unless_managed()
+
+    def get_match_expression(self, keywords):
+        """
+        Translates the given raw search keywords into an FTS5 ``MATCH``
+        expression.
+
+        Returns ``None`` if the keywords can't be expressed as a ``MATCH``
+        expression - if they only exclude items or if any keyword has no
+        searchable content.
+        """
+        required, excluded, one_of, phrases = parse_keywords(keywords)
+        for keyword in required + excluded + one_of + phrases:
+            if not term_re.search(keyword):
+                return None
+        quote = lambda keyword: '"%s"' % keyword.replace('"', '""')
+        expressions = [quote(keyword) for keyword in required]
+        if one_of:
+            expressions.append('(%s)' % ' OR '.join(map(quote, one_of)))
+        if phrases:
+            expressions.append('(%s)' % ' OR '.join(map(quote, phrases)))
+        if not expressions:
+            return None
+        expression = ' AND '.join(expressions)
+        if excluded:
+            expression = '(%s) NOT (%s)' % (expression,
+                                            ' OR '.join(map(quote, excluded)))
+        return expression
+
+    def rebuild(self, *args, **kwargs):
+        self.create_tables()
+        super(SQLiteFTSBackend, self).rebuild(*args, **kwargs)
+
+    def filter_queryset(self, queryset, search_type, keywords):
+        """
+        Restricts the given ``QuerySet`` to items whose ids are found in
+        the full-text table, falling back to substring matching for
+        keywords which can't be expressed as a ``MATCH`` expression.
+        """
+        expression = self.get_match_expression(keywords)
+        if expression is None:
+            return super(SQLiteFTSBackend, self).filter_queryset(
+                queryset, search_type, keywords)
+        opts = queryset.model._meta
+        fts_table = qn(self.get_table(search_type))
+        return queryset.extra(
+            where=['%s.%s IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+                qn(opts.db_table), qn(opts.pk.column), fts_table, fts_table)],
+            params=[expression])
+
+    def get_snippets(self, search_type, object_ids, keywords):
+        """
+        Uses FTS5's ``snippet`` function to create snippets from the
+        full-text table, falling back to creating snippets from each
+        item's text for keywords which can't be expressed as a ``MATCH``
+        expression or items which aren't in the full-text table.
+        """
+        snippets = {}
+        expression = self.get_match_expression(keywords)
+        object_ids = list(object_ids)
+        if expression is not None and object_ids:
+            fts_table = qn(self.get_table(search_type))
+            cursor = connection.cursor()
+            # Markers which will survive escaping the snippet
+            cursor.execute("""
+                SELECT rowid, snippet(%(fts_table)s, 0, %%s, %%s, %%s, %(words)s)
+                FROM %(fts_table)s
+                WHERE %(fts_table)s MATCH %%s
+                  AND rowid IN (%(object_ids)s)""" % {
+                    'fts_table': fts_table,
+                    'words': SNIPPET_WORDS,
+                    'object_ids': ','.join(['%s'] * len(object_ids)),
+                }, ['\x02', '\x03', '\x04', expression] + object_ids)
+            for object_id, snippet in cursor.fetchall():
+                snippets[object_id] = mark_safe(escape(snippet) \
+                    .replace('\x02', '<strong class="highlight">') \
+                    .replace('\x03', '</strong>') \
+                    .replace('\x04', '&hellip;'))
+        missing_ids = [object_id for object_id in object_ids
+                       if object_id not in snippets]
+        if missing_ids:
+            snippets.update(super(SQLiteFTSBackend, self).get_snippets(
+                search_type, missing_ids, keywords))
+        return snippets
+
+    def add_to_index(self, search_type, texts):
+        if not texts:
+            return
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (rowid, %s) VALUES (%%s, %%s)' % (
+            qn(self.get_table(search_type)),
+            qn(self.get_text_field(search_type))), texts)
+
+    def remove_from_index(self, search_type, object_ids):
+        cursor = connection.cursor()
+        for i in xrange(0, len(object_ids), SQL_CHUNK_SIZE):
+            chunk = list(object_ids[i:i+SQL_CHUNK_SIZE])
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (
+                qn(self.get_table(search_type)),
+                ','.join(['%s'] * len(chunk))), chunk)
+
+    def clear_index(self):
+        from forum.models import Search
+        cursor = connection.cursor()
+        for search_type in (Search.POST_SEARCH, Search.TOPIC_SEARCH):
+            cursor.execute('DELETE FROM %s' % qn(self.get_table(search_type)))
+        transaction.commit_unless_managed()
+
+def get_search_backend():
+    """
+    Creates a search backend object as specified by current settings.
+    """
+    from django.core import exceptions
+    from forum import app_settings
+    try:
+        dot = app_settings.SEARCH_BACKEND.rindex('.')
+    except ValueError:
+        raise exceptions.ImproperlyConfigured, '%s isn\'t a search backend module' % app_settings.SEARCH_BACKEND
+    modulename, classname = app_settings.SEARCH_BACKEND[:dot], app_settings.SEARCH_BACKEND[dot+1:]
+    try:
+        mod = __import__(modulename, {}, {}, [''])
+    except ImportError, e:
+        raise exceptions.ImproperlyConfigured, 'Error importing search backend module %s: "%s"' % (modulename, e)
+    try:
+        backend_class = getattr(mod, classname)
+    except AttributeError:
+        raise exceptions.ImproperlyConfigured, 'Search backend module "%s" does not define a "%s" class' % (modulename, classname)
+    return backend_class()
+
+def create_fts_tables(sender, **kwargs):
+    """
+    Creates the full-text tables when the forum application's tables are
+    synced, if the configured backend uses them - other backends, and
+    SQLite builds without FTS5, never need them.
+    """
+    if sender.__name__ == 'forum.models' and \
+       isinstance(search_backend, SQLiteFTSBackend):
+        search_backend.create_tables()
+
+# For convenience, make a single instance of the currently specified search
+# backend available for reuse.
+search_backend = get_search_backend()
+models.signals.post_syncdb.connect(create_fts_tables)
+
+def request_finished(**kwargs):
+    """
+    Gives the search backend in use the chance to apply pending changes
+    to its index at the end of a request.
+    """
+    search_backend.request_finished()
+
+signals.request_finished.connect(request_finished)
+atexit.register(lambda: search_backend.flush())
@@ -0,0 +1,153 @@
+"""
+An in-process index of usernames, which resolves partial usernames to
+User ids without scanning the User table.
+"""
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+
+from forum import app_settings
+
+TRIGRAM_LENGTH = 3
+
+def trigrams(text):
+    """
+    Returns a set of the overlapping three character sequences in the
+    given text.
+    """
+    return set([text[i:i+TRIGRAM_LENGTH]
+                for i in xrange(len(text) - TRIGRAM_LENGTH + 1)])
+
+class UsernameIndex(object):
+    """
+    A trigram index of lowercased usernames.
+
+    The index is loaded when first used. Users created since then, by any
+    process, are picked up by checking for User ids beyond the highest one
+    indexed, at most once every ``check_interval`` seconds. Renamed and
+    deleted Users are updated as they're saved or deleted in this process;
+    the whole index is loaded again every ``reload_interval`` seconds to
+    pick up Users renamed or deleted by other processes.
+    """
+    def __init__(self, check_interval=None, reload_interval=None):
+        if check_interval is None:
+            check_interval = app_settings.USERNAME_INDEX_CHECK_INTERVAL
+        if reload_interval is None:
+            reload_interval = app_settings.USERNAME_INDEX_RELOAD_INTERVAL
+        self.check_interval = check_interval
+        self.reload_interval = reload_interval
+        self.usernames = {}
+        self.trigrams = {}
+        self.max_id = None
+        self.loaded_at = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+        post_save.connect(self.user_saved, sender=User)
+        post_delete.connect(self.user_deleted, sender=User)
+
+    def user_ids(self, fragment):
+        """
+        Returns a set of the ids of Users whose usernames contain the given
+        fragment, ignoring case.
+        """
+        self.load_new_users()
+        fragment = fragment.lower()
+        self.lock.acquire()
+        try:
+            if len(fragment) < TRIGRAM_LENGTH:
+                candidates = self.usernames.keys()
+            else:
+                postings = sorted([self.trigrams.get(trigram, set())
+                                   for trigram in trigrams(fragment)], key=len)
+                candidates = postings[0].intersection(*postings[1:])
+            return set([user_id for user_id in candidates
+                        if fragment in self.usernames[user_id]])
+        finally:
+            self.lock.release()
+
+    def load_new_users(self):
+        """
+        Loads all Users if the index hasn't been loaded for
+        ``reload_interval`` seconds, otherwise adds Users created since the
+        index was last updated if it hasn't been checked for
+        ``check_interval`` seconds.
+        """
+        now = time.time()
+        if (self.loaded_at is None or
+            now - self.loaded_at >= self.reload_interval):
+            self.load_all_users(now)
+            return
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        max_id = User.objects.aggregate(max_id=Max('id'))['max_id']
+        if max_id is None or max_id == self.max_id:
+            return
+        users = User.objects.filter(pk__gt=self.max_id)
+        self.lock.acquire()
+        try:
+            for user_id, username in users.values_list('id', 'username'):
+                self.add(user_id, username)
+            self.max_id = max(max_id, self.max_id)
+        finally:
+            self.lock.release()
+
+    def load_all_users(self, now):
+        """
+        Replaces the contents of the index with all current Users.
+        """
+        users = list(User.objects.values_list('id', 'username'))
+        self.lock.acquire()
+        try:
+            self.usernames = {}
+            self.trigrams = {}
+            for user_id, username in users:
+                self.add(user_id, username)
+            self.max_id = max([user_id for user_id, username in users] or [0])
+            self.loaded_at = self.checked_at = now
+        finally:
+            self.lock.release()
+
+    def add(self, user_id, username):
+        username = username.lower()
+        self.remove(user_id)
+        self.usernames[user_id] = username
+        for trigram in trigrams(username):
+            self.trigrams.setdefault(trigram, set()).add(user_id)
+
+    def remove(self, user_id):
+        username = self.usernames.pop(user_id, None)
+        if username is None:
+            return
+        for trigram in trigrams(username):
+            self.trigrams[trigram].discard(user_id)
+            if not self.trigrams[trigram]:
+                del self.trigrams[trigram]
+
+    def user_saved(self, instance, **kwargs):
+        """
+        Adds or updates a saved User if the index has been loaded.
+        """
+        if self.max_id is not None:
+            self.lock.acquire()
+            try:
+                self.add(instance.pk, instance.username)
+            finally:
+                self.lock.release()
+
+    def user_deleted(self, instance, **kwargs):
+        """
+        Removes a deleted User from the index.
+        """
+        self.lock.acquire()
+        try:
+            self.remove(instance.pk)
+        finally:
+            self.lock.release()
+
+# For convenience, make a single instance of the username index available
+# for reuse.
+username_index = UsernameIndex()
@@ -34,6 +34,15 @@ def add_view_counts(topics):
     Topic.objects.add_view_counts(topics)
     return mark_safe(u'')
 
+@register.simple_tag
+def refresh_body_html(posts):
+    """
+    Formats any of the given Posts which were formatted by a different
+    version of the post formatter again.
+    """
+    Post.objects.refresh_body_html(posts)
+    return mark_safe(u'')
+
 @register.simple_tag
 def add_topic_view_counts(posts):
     """
@@ -186,11 +195,11 @@ def joined_date(date):
 ########################
 
 @register.filter
-def is_first_post(post):
+def is_first_post(post, topic):
     """
-    Determines if the given post is the first post in a topic.
+    Determines if the given post is the first post in the given topic.
     """
-    return post.num_in_topic == 1 and not post.meta
+    return not post.meta and post.pk == topic.get_first_post().pk
 
 @register.filter
 def topic_status_image(topic):
@@ -1,4 +1,6 @@
 import forum
 
 from forum.tests.auth import *
-from forum.tests.models import *
\ No newline at end of file
+from forum.tests.formatters import *
+from forum.tests.models import *
+from forum.tests.search import *
\ No newline at end of file
@@ -0,0 +1,332 @@
+import datetime
+import threading
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils.html import escape, linebreaks, urlize
+
+from forum import app_settings
+from forum.formatters import (BBCodeFormatter, MarkdownFormatter,
+    PostFormatter, post_formatter)
+from forum.formatters.cache import RenderCache
+from forum.formatters.emoticons import Emoticons
+from forum.management.commands import rerender_posts
+from forum.management.commands.rerender_posts import render_posts
+from forum.models import Post
+
+class CountingFormatter(PostFormatter):
+    """
+    A post formatter which counts how many times it formats a post body.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingFormatter, self).__init__(*args, **kwargs)
+        self.formatted = 0
+
+    def format_post_body(self, body):
+        self.formatted += 1
+        return super(CountingFormatter, self).format_post_body(body)
+
+class PostFormatterTestCase(TestCase):
+    """
+    Tests for basic post formatting.
+    """
+    fixtures = ['testdata.json']
+
+    def assertFormattedAsChain(self, body):
+        self.assertEquals(PostFormatter().format_post_body(body),
+                          linebreaks(urlize(escape(body.strip()))))
+
+    def test_format_post_body(self):
+        """
+        Verifies that formatting is the same as escaping, converting URLs
+        to links and converting line breaks in turn.
+        """
+        for body in (u'',
+                     u'  Line 1\r\nLine 2\rLine 3\n\n\r\nPara 2 \n \nLine 2\n\r',
+                     u'<b>"Quoted" & \'apostrophes\'</b>',
+                     u'(http://example.com/?a=1&b=\u00e9). <www.example.org>, x.com',
+                     u'me@example.com mailto:me@example.com @ a@b :http: 9.net _x.com',
+                     u'\u00e9.com\twww.\u00e9.com\x0bhttps://\u00e9.net\x0c\u2028.com\x85'):
+            self.assertFormattedAsChain(body)
+        for body in Post.objects.values_list('body', flat=True):
+            self.assertFormattedAsChain(body)
+
+class ConcurrentFormattingTestCase(TestCase):
+    """
+    Tests for using a post formatter from multiple threads at once.
+    """
+    def assertFormatsConcurrently(self, formatter, make_body):
+        bodies = [make_body(i) for i in xrange(200)]
+        expected = [formatter.format_post_body(body) for body in bodies]
+        failures = []
+        def format_bodies():
+            for body, html in zip(bodies, expected):
+                if formatter.format_post_body(body) != html:
+                    failures.append(body)
+        threads = [threading.Thread(target=format_bodies) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(failures, [])
+
+    def test_markdown(self):
+        self.assertFormatsConcurrently(MarkdownFormatter(),
+            lambda i: u'*Post %s* [link][%s]\n\n[%s]: http://example.com/%s' % (
+                i, i, i, i))
+
+    def test_bbcode(self):
+        self.assertFormatsConcurrently(BBCodeFormatter(),
+            lambda i: u'[b]Post %s[/b] [url=http://example.com/%s]link[/url]' % (
+                i, i))
+
+class EmoticonsTestCase(TestCase):
+    """
+    Tests for emoticon replacement.
+    """
+    fixtures = ['testdata.json']
+
+    def test_longest_match(self):
+        """
+        Verifies that the longest symbol at each position is replaced,
+        including where symbols share prefixes.
+        """
+        em = Emoticons({':': 'colon.gif', ':p': 'tongue.gif', ':ph34r:': 'ninja.gif',
+                        ':ph': 'phew.gif'})
+        self.assertEquals(em.process(u':ph34r: :ph34 :p :'),
+            u'<img src="ninja.gif" alt=":ph34r:"> <img src="phew.gif" alt=":ph">34 '
+            u'<img src="tongue.gif" alt=":p"> <img src="colon.gif" alt=":">')
+
+    def test_special_characters(self):
+        """
+        Verifies that symbols are matched literally.
+        """
+        em = Emoticons({'(*)': 'star.gif', '.': 'dot.gif'})
+        self.assertEquals(em.process(u'a(*)b.(x)'),
+            u'a<img src="star.gif" alt="(*)">b<img src="dot.gif" alt=".">(x)')
+
+    def test_benchmark_emoticons(self):
+        """
+        Verifies that the benchmark finds no differences from the previous
+        implementation.
+        """
+        stdout = StringIO()
+        call_command('benchmark_emoticons', extra_emoticons=100, repeat=1,
+                     stdout=stdout)
+        self.assertTrue(stdout.getvalue().endswith(
+            '162 Posts, 115 emoticons, 0 differences\n'))
+
+class RenderCacheTestCase(TestCase):
+    """
+    Tests for caching of formatted post bodies.
+    """
+    def setUp(self):
+        self.cache = RenderCache(2)
+        self.formatter = CountingFormatter(emoticons={':p': 'tongue.gif'},
+                                           render_cache=self.cache)
+
+    def test_format_post(self):
+        """
+        Verifies that unchanged post bodies are only formatted once.
+        """
+        html = self.formatter.format_post(u'Cheeky :p')
+        self.assertEquals(self.formatter.format_post(u'Cheeky :p'), html)
+        self.assertEquals(self.formatter.formatted, 1)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertNotEquals(self.formatter.format_post(u'Cheeky :p', False),
+                             html)
+        self.assertEquals(self.formatter.formatted, 2)
+
+    def test_key(self):
+        """
+        Verifies that cache keys distinguish formatters, emoticon
+        processing and post bodies.
+        """
+        other_formatter = PostFormatter()
+        keys = set([self.cache.make_key(self.formatter, u'Test', True),
+                    self.cache.make_key(self.formatter, u'Test', False),
+                    self.cache.make_key(self.formatter, u'Test!', True),
+                    self.cache.make_key(other_formatter, u'Test', True)])
+        self.assertEquals(len(keys), 4)
+
+    def test_version(self):
+        """
+        Verifies that formatter versions change with the emoticons in use.
+        """
+        self.assertEquals(CountingFormatter(emoticons={':p': 'tongue.gif'}).version,
+                          self.formatter.version)
+        self.assertNotEquals(CountingFormatter().version, self.formatter.version)
+        self.assertNotEquals(PostFormatter().version, CountingFormatter().version)
+
+    def test_eviction(self):
+        """
+        Verifies that the least recently used formatted body is evicted
+        when the cache is full.
+        """
+        for body in (u'One', u'Two', u'One', u'Three'):
+            self.formatter.format_post(body)
+        self.assertEquals(self.formatter.formatted, 3)
+        self.formatter.format_post(u'One')
+        self.assertEquals(self.formatter.formatted, 3)
+        self.formatter.format_post(u'Two')
+        self.assertEquals(self.formatter.formatted, 4)
+        self.cache.clear()
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 0))
+
+class RerenderPostsTestCase(TestCase):
+    """
+    Tests for formatting all Post bodies again.
+    """
+    fixtures = ['testdata.json']
+
+    def setUp(self):
+        Post.objects.all().update(body_html='Stale')
+
+    def assertRendered(self, posts):
+        for post in posts:
+            self.assertEquals(post.body_html,
+                              post_formatter.render_post(post.body, post.emoticons))
+
+    def test_rerender_posts(self):
+        """
+        Verifies that every Post is formatted again, in chunks.
+        """
+        stdout = StringIO()
+        call_command('rerender_posts', chunk_size=100, processes=1,
+                     stdout=stdout)
+        self.assertRendered(Post.objects.all())
+        self.assertEquals(len(stdout.getvalue().splitlines()), 2)
+        self.assertTrue(stdout.getvalue().startswith(
+            'Formatted 100 of 162 Posts, up to id 100 '))
+
+    def test_start_after(self):
+        """
+        Verifies that an interrupted run can be resumed.
+        """
+        call_command('rerender_posts', start_after=150, processes=2,
+                     verbosity=0)
+        self.assertRendered(Post.objects.filter(pk__gt=150))
+        self.assertEquals(Post.objects.filter(pk__lte=150,
+                                              body_html='Stale').count(), 150)
+
+    def test_edited_while_running(self):
+        """
+        Verifies that Posts edited after being read keep the body
+        formatted when they were saved.
+        """
+        def render_and_edit(posts):
+            for post in Post.objects.filter(pk__in=[1, 101]):
+                post.body = 'Edited'
+                post.save()
+            return render_posts(posts)
+        rerender_posts.render_posts = render_and_edit
+        try:
+            call_command('rerender_posts', chunk_size=100, processes=1,
+                         verbosity=0)
+        finally:
+            rerender_posts.render_posts = render_posts
+        for post in Post.objects.filter(pk__in=[1, 101]):
+            self.assertEquals(post.body_html,
+                              post_formatter.render_post('Edited', post.emoticons))
+        self.assertRendered(Post.objects.exclude(pk__in=[1, 101]))
+
+class RefreshBodyHtmlTestCase(TestCase):
+    """
+    Tests for formatting Posts formatted by another formatter version when
+    they're displayed.
+    """
+    fixtures = ['testdata.json']
+
+    def setUp(self):
+        Post.objects.all().update(body_html='Stale', formatter_version='old')
+        Post.objects.filter(topic=2).update(body_html='Current',
+            formatter_version=post_formatter.version)
+        # Viewing Topics shouldn't need Redis for sessions or view counts
+        self.session_engine = settings.SESSION_ENGINE
+        self.use_redis = app_settings.USE_REDIS
+        settings.SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+        app_settings.USE_REDIS = False
+
+    def tearDown(self):
+        settings.SESSION_ENGINE = self.session_engine
+        app_settings.USE_REDIS = self.use_redis
+
+    def test_refresh_body_html(self):
+        """
+        Verifies that only stale Posts are formatted again, and that they're
+        written back separately.
+        """
+        posts = Post.objects.refresh_body_html(
+            list(Post.objects.with_user_details().filter(topic__in=[1, 2])))
+        for post in posts:
+            if post.topic_id == 1:
+                self.assertEquals(post.body_html,
+                                  post_formatter.render_post(post.body, post.emoticons))
+            else:
+                self.assertEquals(post.body_html, 'Current')
+            self.assertEquals(post.formatter_version, post_formatter.version)
+        self.assertEquals(Post.objects.filter(body_html='Stale', topic=1).count(),
+                          Post.objects.filter(topic=1).count())
+        Post.objects.write_refreshed_body_html()
+        self.assertEquals(Post.objects.filter(topic=1).exclude(
+            formatter_version=post_formatter.version).count(), 0)
+        self.assertEquals(Post.objects.filter(topic=1, body_html='Stale').count(), 0)
+        self.assertEquals(Post.objects.filter(body_html='Stale').count(),
+                          Post.objects.exclude(topic__in=[1, 2]).count())
+
+    def test_edited_before_write_back(self):
+        """
+        Verifies that Posts edited after being refreshed, whether or not
+        they had been edited before, keep the body formatted when they
+        were saved.
+        """
+        Post.objects.filter(pk=2).update(
+            edited_at=datetime.datetime(2011, 1, 1, 12, 30, 15, 500))
+        Post.objects.refresh_body_html(
+            list(Post.objects.filter(pk__in=[1, 2, 3])))
+        for post in Post.objects.filter(pk__in=[1, 2]):
+            post.body = 'Edited'
+            post.save()
+        Post.objects.write_refreshed_body_html()
+        for post in Post.objects.filter(pk__in=[1, 2]):
+            self.assertEquals(post.body_html,
+                              post_formatter.render_post('Edited', post.emoticons))
+        post = Post.objects.get(pk=3)
+        self.assertEquals(post.body_html,
+                          post_formatter.render_post(post.body, post.emoticons))
+
+    def test_topic_detail(self):
+        """
+        Verifies that stale Posts are refreshed when a Topic is viewed.
+        """
+        self.client.login(username='user', password='user')
+        response = self.client.get(reverse('forum_topic_detail', args=(1,)))
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse('Stale' in response.content)
+        self.assertEquals(Post.objects.filter(topic=1, meta=False,
+                                              body_html='Stale').count(), 0)
+
+class BenchmarkFormattersTestCase(TestCase):
+    """
+    Tests for benchmarking post formatters.
+    """
+    def test_benchmark_formatters(self):
+        """
+        Verifies that each formatter is benchmarked with and without
+        emoticons.
+        """
+        stdout = StringIO()
+        call_command('benchmark_formatters', posts=20, max_words=50,
+                     formatters=['forum.formatters.PostFormatter',
+                                 'forum.formatters.BBCodeFormatter'],
+                     stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEquals(len(lines), 5)
+        self.assertEquals([line.split()[:2] for line in lines[1:]],
+                          [['forum.formatters.PostFormatter', 'off'],
+                           ['forum.formatters.PostFormatter', 'on'],
+                           ['forum.formatters.BBCodeFormatter', 'off'],
+                           ['forum.formatters.BBCodeFormatter', 'on']])
@@ -1,8 +1,13 @@
+import datetime
+
 from django.contrib.auth.models import User
+from django.core import signals
+from django.db import connection
 from django.test import TestCase
 
-from forum import moderation
+from forum import consistency, counters, moderation, redis_connection
 from forum.models import Forum, ForumProfile, Post, Section, Topic
+from forum.templatetags.forum_tags import is_first_post
 
 class ForumProfileTestCase(TestCase):
     fixtures = ['testdata.json']
@@ -100,6 +105,7 @@ class TopicTestCase(TestCase):
 
         post = Post.objects.create(topic=topic, user=user, body='Test Post.')
         self.assertEquals(post.num_in_topic, 1)
+        self.assertEquals(Topic.objects.get(pk=topic.pk).last_num_in_topic, 1)
         self.assertNotEquals(post.posted_at, None)
         self.assertNotEquals(post.body_html, '')
         self.assertEquals(post.edited_at, None)
@@ -249,7 +255,8 @@ class PostTestCase(TestCase):
         topic = Topic.objects.get(pk=1)
 
         post = Post.objects.create(topic=topic, user=user, body='Test Post.')
-        self.assertEquals(post.num_in_topic, 4)
+        self.assertEquals(post.num_in_topic, 7)
+        self.assertEquals(post.get_position(), 4)
         self.assertNotEquals(post.posted_at, None)
         self.assertNotEquals(post.body_html, '')
         self.assertEquals(post.edited_at, None)
@@ -275,6 +282,18 @@ class PostTestCase(TestCase):
         self.assertEquals(user.posts.count(), 55)
         self.assertEquals(forum_profile.post_count, 55)
 
+    def test_add_posts_with_stale_topic(self):
+        """
+        Verifies that Posts added through Topics loaded before each other's
+        Posts were saved are given distinct numbers.
+        """
+        user = User.objects.get(pk=1)
+        topics = [Topic.objects.get(pk=1), Topic.objects.get(pk=1)]
+        posts = [Post.objects.create(topic=topic, user=user, body='Test Post.')
+                 for topic in topics]
+        self.assertEquals([post.num_in_topic for post in posts], [7, 8])
+        self.assertEquals(Topic.objects.get(pk=1).last_num_in_topic, 8)
+
     def test_edit_post(self):
         """
         Verifies that editing a Post results in appropriate Post fields
@@ -314,16 +333,17 @@ class PostTestCase(TestCase):
     def test_delete_post(self):
         """
         Verifies that deleting a Post which is *not* the last Post in
-        its topic results in following Posts' position counters being
-        decremented appropriately, and that last Post denormalised data
-        is unaffected.
+        its topic moves following Posts up a position without renumbering
+        them, and that last Post denormalised data is unaffected.
         """
         post = Post.objects.get(pk=1)
         post.delete()
 
-        self.assertEquals(Post.objects.get(pk=2).num_in_topic, 1)
+        self.assertEquals(Post.objects.get(pk=2).num_in_topic, 2)
+        self.assertEquals(Post.objects.get(pk=2).get_position(), 1)
         last_post = Post.objects.get(pk=3)
-        self.assertEquals(last_post.num_in_topic, 2)
+        self.assertEquals(last_post.num_in_topic, 3)
+        self.assertEquals(last_post.get_position(), 2)
 
         topic = Topic.objects.get(pk=1)
         self.assertEquals(topic.posts.count(), 5)
@@ -338,6 +358,28 @@ class PostTestCase(TestCase):
         self.assertEquals(user.posts.count(), 53)
         self.assertEquals(forum_profile.post_count, 53)
 
+    def test_first_post_before_repair(self):
+        """
+        Verifies that a reply numbered 1 because its Topic's
+        ``last_num_in_topic`` wasn't populated isn't taken for the
+        Topic's first Post.
+        """
+        Topic.objects.filter(pk=1).update(last_num_in_topic=0)
+        post = Post.objects.create(topic=Topic.objects.get(pk=1),
+                                   user=User.objects.get(pk=1), body='Reply.')
+        self.assertEquals(post.num_in_topic, 1)
+
+        topic = Topic.objects.get(pk=1)
+        self.assertEquals(topic.get_first_post().pk, 1)
+        self.assertTrue(is_first_post(Post.objects.get(pk=1), topic))
+        self.assertFalse(is_first_post(post, topic))
+
+        # Posts sharing a number are positioned by id
+        self.assertEquals(Post.objects.get(pk=1).get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=post.pk).get_position(), 2)
+        self.assertEquals(Post.objects.with_standalone_details() \
+                                      .get(pk=post.pk).position, 2)
+
     def test_delete_last_post_in_topic(self):
         """
         Verifies that deleting the last Post in a Topic has the
@@ -403,6 +445,270 @@ class PostTestCase(TestCase):
         self.assertEquals(user.posts.count(), 53)
         self.assertEquals(forum_profile.post_count, 53)
 
+    def test_counts_not_recalculated(self):
+        """
+        Verifies that adding and deleting Posts adjusts denormalised
+        counts rather than counting Posts.
+        """
+        user = User.objects.get(pk=1)
+        topic = Topic.objects.get(pk=1)
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            post = Post.objects.create(topic=topic, user=user, body='Test Post.')
+            metapost = Post.objects.create(topic=topic, user=user,
+                                           body='Test Metapost.', meta=True)
+            post.delete()
+            metapost.delete()
+            queries = [query['sql'] for query in connection.queries[start:]]
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        self.assertEquals([sql for sql in queries if 'COUNT(' in sql], [])
+
+        topic = Topic.objects.get(pk=1)
+        self.assertEquals(topic.post_count, 3)
+        self.assertEquals(topic.metapost_count, 3)
+        self.assertEquals(ForumProfile.objects.get(pk=1).post_count, 54)
+
+class CounterBufferTestCase(TestCase):
+    """
+    Tests for accumulating changes new Posts make to denormalised data.
+    """
+    fixtures = ['testdata.json']
+    buffer_class = counters.CounterBuffer
+
+    def setUp(self):
+        self.buffer = self.buffer_class(60)
+        self.previous_buffer = counters.set_counter_buffer(self.buffer)
+
+    def tearDown(self):
+        counters.set_counter_buffer(self.previous_buffer)
+
+    def test_add_posts(self):
+        """
+        Verifies that changes are applied together when flushed.
+        """
+        user = User.objects.get(pk=1)
+        topic = Topic.objects.get(pk=1)
+        first = Post.objects.create(topic=topic, user=user, body='First.')
+        second = Post.objects.create(topic=topic, user=user, body='Second.')
+        metapost = Post.objects.create(topic=topic, user=user, body='Meta.',
+                                       meta=True)
+        self.assertEquals((first.num_in_topic, second.num_in_topic,
+                           metapost.num_in_topic), (7, 8, 9))
+        # Post numbers are allocated immediately rather than buffered
+        self.assertEquals(Topic.objects.get(pk=1).last_num_in_topic, 9)
+        self.assertEquals(Topic.objects.get(pk=1).post_count, 3)
+        self.assertEquals(ForumProfile.objects.get(pk=1).post_count, 54)
+
+        signals.request_finished.send(sender=None)
+        self.assertEquals(Topic.objects.get(pk=1).post_count, 3)
+        self.buffer.interval = 0
+        signals.request_finished.send(sender=None)
+
+        topic = Topic.objects.get(pk=1)
+        self.assertEquals(topic.post_count, 5)
+        self.assertEquals(topic.metapost_count, 4)
+        self.assertEquals(topic.last_post_at, second.posted_at)
+        forum = Forum.objects.get(pk=1)
+        self.assertEquals(forum.last_post_at, second.posted_at)
+        self.assertEquals(forum.last_topic_id, topic.pk)
+        self.assertEquals(ForumProfile.objects.get(pk=1).post_count, 57)
+
+    def test_delete_post(self):
+        """
+        Verifies that waiting changes are applied before a Post is deleted.
+        """
+        user = User.objects.get(pk=1)
+        topic = Topic.objects.get(pk=1)
+        post = Post.objects.create(topic=topic, user=user, body='Test Post.')
+        Post.objects.get(pk=post.pk).delete()
+
+        topic = Topic.objects.get(pk=1)
+        self.assertEquals(topic.post_count, 3)
+        self.assertEquals(topic.last_post_at, topic.posts.filter(meta=False) \
+                          .order_by('-posted_at')[0].posted_at)
+        self.assertEquals(ForumProfile.objects.get(pk=1).post_count, 54)
+
+    def test_earlier_last_post(self):
+        """
+        Verifies that last Post details earlier than those held are
+        ignored.
+        """
+        topic = Topic.objects.get(pk=1)
+        self.buffer.store({('topic', 1, 'post_count'): 2}, {
+            ('topic', 1): (topic.last_post_at - datetime.timedelta(days=1),
+                           2, 'moderator'),
+        })
+        self.buffer.flush()
+        updated_topic = Topic.objects.get(pk=1)
+        self.assertEquals(updated_topic.post_count, 5)
+        self.assertEquals(updated_topic.last_post_at, topic.last_post_at)
+        self.assertEquals(updated_topic.last_username, topic.last_username)
+
+    def test_flush_failure(self):
+        """
+        Verifies that changes which couldn't be applied are kept, along
+        with changes added in the meantime, without the error being
+        raised.
+        """
+        user = User.objects.get(pk=1)
+        topic = Topic.objects.get(pk=1)
+        first = Post.objects.create(topic=topic, user=user, body='First.')
+        # Whichever update is made first fails
+        db_tables = [(model, model._meta.db_table)
+                     for model in (Topic, Forum, ForumProfile)]
+        for model, db_table in db_tables:
+            model._meta.db_table = 'missing_%s' % db_table
+        errors = []
+        counters.logger.exception = lambda *args: errors.append(args)
+        try:
+            self.buffer.flush()
+        finally:
+            del counters.logger.exception
+            for model, db_table in db_tables:
+                model._meta.db_table = db_table
+        self.assertEquals(len(errors), 1)
+        second = Post.objects.create(topic=topic, user=user, body='Second.')
+        self.assertEquals((first.num_in_topic, second.num_in_topic), (7, 8))
+        self.buffer.flush()
+
+        topic = Topic.objects.get(pk=1)
+        self.assertEquals(topic.post_count, 5)
+        self.assertEquals(topic.last_num_in_topic, 8)
+        self.assertEquals(topic.last_post_at, second.posted_at)
+        self.assertEquals(ForumProfile.objects.get(pk=1).post_count, 56)
+
+    def test_missing_profile(self):
+        """
+        Verifies that a ForumProfile is created for a User who doesn't
+        have one when changes to it are applied.
+        """
+        user = User.objects.get(pk=1)
+        ForumProfile.objects.filter(user=user).delete()
+        Post.objects.create(topic=Topic.objects.get(pk=1), user=user,
+                            body='Test Post.')
+        self.buffer.flush()
+        self.assertEquals(ForumProfile.objects.get(user=user).post_count, 1)
+
+class FakeRedis(object):
+    """
+    Implements the Redis commands used to accumulate counter changes,
+    holding data in memory.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self):
+        return FakeRedisPipeline(self)
+
+    def hincrby(self, key, field, amount):
+        hash = self.data.setdefault(key, {})
+        hash[field] = str(int(hash.get(field, 0)) + amount)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def sadd(self, key, member):
+        self.data.setdefault(key, set()).add(member)
+
+    def srem(self, key, member):
+        self.data.get(key, set()).discard(member)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def zadd(self, key, score, member):
+        self.data.setdefault(key, {})[member] = score
+
+    def zrange(self, key, start, end):
+        members = sorted(self.data.get(key, {}).items(),
+                         key=lambda (member, score): score)
+        end = end == -1 and len(members) or end + 1
+        return [member for member, score in members][start:end]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+class FakeRedisPipeline(object):
+    """
+    Queues commands for a ``FakeRedis`` until they're executed.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args) for name, args in self.commands]
+
+class RedisCounterBufferTestCase(CounterBufferTestCase):
+    """
+    Tests for accumulating changes in Redis, which is replaced with an
+    in-memory implementation of the commands used.
+    """
+    buffer_class = counters.RedisCounterBuffer
+
+    def setUp(self):
+        self.redis = redis_connection.r
+        redis_connection.r = FakeRedis()
+        super(RedisCounterBufferTestCase, self).setUp()
+
+    def tearDown(self):
+        super(RedisCounterBufferTestCase, self).tearDown()
+        redis_connection.r = self.redis
+
+class ConsistencyTestCase(TestCase):
+    """
+    Tests for checking and repairing denormalised data.
+    """
+    fixtures = ['testdata.json']
+
+    def check(self):
+        discrepancies = []
+        for forum in Forum.objects.all():
+            discrepancies.extend(consistency.check_forum(forum))
+        discrepancies.extend(consistency.check_forums())
+        discrepancies.extend(consistency.check_profiles())
+        return discrepancies
+
+    def test_consistent(self):
+        self.assertEquals(self.check(), [])
+        # Numbers left unused by deleted Posts are expected
+        Post.objects.get(pk=2).delete()
+        self.assertEquals(self.check(), [])
+
+    def test_check_and_repair(self):
+        """
+        Verifies that drifted counts, last Post details and sequence
+        numbers are found and repaired.
+        """
+        Topic.objects.filter(pk=1).update(post_count=99, last_username='x')
+        Forum.objects.filter(pk=1).update(topic_count=0)
+        ForumProfile.objects.filter(pk=1).update(post_count=0)
+        Post.objects.filter(pk=3).update(num_in_topic=2)
+
+        discrepancies = self.check()
+        self.assertEquals(sorted([(model.__name__, object_id, field_name,
+                                   stored, expected)
+                                  for model, object_id, field_name, stored,
+                                      expected in discrepancies]), [
+            ('Forum', 1, 'topic_count', 0, 3),
+            ('ForumProfile', 1, 'post_count', 0, 54),
+            ('Post', 3, 'num_in_topic', 2, 3),
+            ('Topic', 1, 'last_username', u'x', u'admin'),
+            ('Topic', 1, 'post_count', 99, 3),
+        ])
+
+        consistency.repair(discrepancies)
+        self.assertEquals(self.check(), [])
+        self.assertEquals(Topic.objects.get(pk=1).post_count, 3)
+        self.assertEquals(Post.objects.get(pk=3).num_in_topic, 3)
+
 class MetapostTestCase(TestCase):
     """
     Tests for the Post model when working with Posts flagged as "meta":
@@ -422,7 +728,7 @@ class MetapostTestCase(TestCase):
         topic = Topic.objects.get(pk=1)
 
         post = Post.objects.create(topic=topic, user=user, meta=True, body='Test Metapost.')
-        self.assertEquals(post.num_in_topic, 4)
+        self.assertEquals(post.get_position(), 4)
         self.assertNotEquals(post.posted_at, None)
         self.assertNotEquals(post.body_html, '')
         self.assertEquals(post.edited_at, None)
@@ -461,7 +767,7 @@ class MetapostTestCase(TestCase):
         post = Post.objects.get(pk=90)
         post.body = 'Test Metapost.'
         post.save()
-        self.assertEquals(post.num_in_topic, 3)
+        self.assertEquals(post.get_position(), 3)
         self.assertNotEquals(post.posted_at, None)
         self.assertNotEquals(post.edited_at, None)
         self.assertTrue(post.edited_at > post.posted_at)
@@ -498,11 +804,11 @@ class MetapostTestCase(TestCase):
         post = Post.objects.get(pk=82)
         post.delete()
 
-        self.assertEquals(Post.objects.get(pk=1).num_in_topic, 1)
-        self.assertEquals(Post.objects.get(pk=2).num_in_topic, 2)
-        self.assertEquals(Post.objects.get(pk=3).num_in_topic, 3)
-        self.assertEquals(Post.objects.get(pk=83).num_in_topic, 1)
-        self.assertEquals(Post.objects.get(pk=84).num_in_topic, 2)
+        self.assertEquals(Post.objects.get(pk=1).get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=2).get_position(), 2)
+        self.assertEquals(Post.objects.get(pk=3).get_position(), 3)
+        self.assertEquals(Post.objects.get(pk=83).get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=84).get_position(), 2)
 
         last_post = Post.objects.get(pk=3)
         topic = Topic.objects.get(pk=1)
@@ -528,20 +834,31 @@ class ModerationTestCase(TestCase):
     - Make a metapost into a post.
     - Make a metapost into a post which will become the last post in a
       topic/forum.
+    - Move posts to another topic.
+    - Merge a topic into another topic.
+    - Purge a user's topics and posts.
     """
     fixtures = ['testdata.json']
 
+    def assertConsistent(self):
+        discrepancies = []
+        for forum in Forum.objects.all():
+            discrepancies.extend(consistency.check_forum(forum))
+        discrepancies.extend(consistency.check_forums())
+        discrepancies.extend(consistency.check_profiles())
+        self.assertEquals(discrepancies, [])
+
     def test_post_to_metapost(self):
         post = Post.objects.get(pk=2)
         post.meta = True
         moderation.make_post_meta(post, post.topic, post.topic.forum)
 
-        self.assertEquals(post.num_in_topic, 1)
-        self.assertEquals(Post.objects.get(pk=82).num_in_topic, 2)
-        self.assertEquals(Post.objects.get(pk=83).num_in_topic, 3)
-        self.assertEquals(Post.objects.get(pk=84).num_in_topic, 4)
-        self.assertEquals(Post.objects.get(pk=1).num_in_topic, 1)
-        self.assertEquals(Post.objects.get(pk=3).num_in_topic, 2)
+        self.assertEquals(post.get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=82).get_position(), 2)
+        self.assertEquals(Post.objects.get(pk=83).get_position(), 3)
+        self.assertEquals(Post.objects.get(pk=84).get_position(), 4)
+        self.assertEquals(Post.objects.get(pk=1).get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=3).get_position(), 2)
 
         topic = Topic.objects.get(pk=1)
         self.assertEquals(topic.post_count, 2)
@@ -552,10 +869,10 @@ class ModerationTestCase(TestCase):
         post.meta = True
         moderation.make_post_meta(post, post.topic, post.topic.forum)
 
-        self.assertEquals(post.num_in_topic, 1)
-        self.assertEquals(Post.objects.get(pk=88).num_in_topic, 2)
-        self.assertEquals(Post.objects.get(pk=89).num_in_topic, 3)
-        self.assertEquals(Post.objects.get(pk=90).num_in_topic, 4)
+        self.assertEquals(post.get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=88).get_position(), 2)
+        self.assertEquals(Post.objects.get(pk=89).get_position(), 3)
+        self.assertEquals(Post.objects.get(pk=90).get_position(), 4)
 
         topic = Topic.objects.get(pk=3)
         last_post = Post.objects.get(pk=8)
@@ -575,9 +892,9 @@ class ModerationTestCase(TestCase):
         post.meta = False
         moderation.make_post_not_meta(post, post.topic, post.topic.forum)
 
-        self.assertEquals(post.num_in_topic, 4)
-        self.assertEquals(Post.objects.get(pk=82).num_in_topic, 1)
-        self.assertEquals(Post.objects.get(pk=84).num_in_topic, 2)
+        self.assertEquals(post.get_position(), 4)
+        self.assertEquals(Post.objects.get(pk=82).get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=84).get_position(), 2)
 
         topic = Topic.objects.get(pk=1)
         self.assertEquals(topic.post_count, 4)
@@ -593,7 +910,7 @@ class ModerationTestCase(TestCase):
         post.meta = False
         moderation.make_post_not_meta(post, post.topic, post.topic.forum)
 
-        self.assertEquals(post.num_in_topic, 4)
+        self.assertEquals(post.get_position(), 4)
 
         topic = Topic.objects.get(pk=3)
         self.assertEquals(topic.post_count, 4)
@@ -609,6 +926,79 @@ class ModerationTestCase(TestCase):
         self.assertEquals(forum.last_user_id, post.user_id)
         self.assertEquals(forum.last_username, post.user.username)
 
+    def test_move_posts(self):
+        first_post = Topic.objects.get(pk=4).get_first_post()
+        moderation.move_posts(Post.objects.filter(pk__in=[5, 6, 86]),
+                              Topic.objects.get(pk=4))
+
+        topic = Topic.objects.get(pk=4)
+        self.assertEquals(topic.get_first_post().pk, first_post.pk)
+        self.assertEquals(topic.post_count, 5)
+        self.assertEquals(topic.metapost_count, 4)
+        self.assertEquals(topic.last_num_in_topic, 9)
+        self.assertEquals(Post.objects.get(pk=86).get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=12).get_position(), 5)
+        from_topic = Topic.objects.get(pk=2)
+        self.assertEquals(from_topic.post_count, 1)
+        self.assertEquals(from_topic.metapost_count, 2)
+        self.assertEquals(from_topic.last_user_id, 2)
+        self.assertConsistent()
+
+    def test_move_first_post(self):
+        first_post = Topic.objects.get(pk=2).get_first_post()
+        self.assertRaises(ValueError, moderation.move_posts,
+                          Post.objects.filter(pk__in=[first_post.pk, 6]),
+                          Topic.objects.get(pk=4))
+        self.assertEquals(Post.objects.get(pk=first_post.pk).topic_id, 2)
+        self.assertEquals(Post.objects.get(pk=6).topic_id, 2)
+
+    def test_merge_topics(self):
+        first_post = Topic.objects.get(pk=4).get_first_post()
+        moderation.merge_topics([Topic.objects.get(pk=2)],
+                                Topic.objects.get(pk=4))
+
+        self.assertFalse(Topic.objects.filter(pk=2).exists())
+        topic = Topic.objects.get(pk=4)
+        self.assertEquals(topic.post_count, 6)
+        self.assertEquals(topic.metapost_count, 6)
+        # The merged Topic's first Post, which is ordered before the
+        # Topic's own in posting order, follows it
+        self.assertEquals(topic.get_first_post().pk, first_post.pk)
+        self.assertEquals(Post.objects.get(pk=first_post.pk).get_position(), 1)
+        self.assertEquals(Post.objects.get(pk=4).get_position(), 2)
+        self.assertEquals(Forum.objects.get(pk=1).topic_count, 2)
+        self.assertEquals(Forum.objects.get(pk=2).topic_count, 3)
+        self.assertConsistent()
+
+    def test_purge_user(self):
+        admin = User.objects.get(pk=1)
+        spammer = User.objects.get(pk=3)
+        Post.objects.create(topic=Topic.objects.get(pk=3), user=admin,
+                            body='Reply to spam.')
+        Post.objects.create(topic=Topic.objects.get(pk=1), user=spammer,
+                            body='Spam.')
+        topic_count = spammer.topics.count()
+        post_count = spammer.posts.count()
+        self.assertEquals(Topic.objects.get(pk=1).post_count, 4)
+
+        report = moderation.purge_user(spammer, dry_run=True)
+        self.assertEquals(report, {
+            'topics': topic_count,
+            'posts': post_count + 1,
+            'updated_topics': 1,
+            'updated_forums': Forum.objects.count(),
+            'updated_profiles': 1,
+        })
+        self.assertEquals(spammer.posts.count(), post_count)
+
+        self.assertEquals(moderation.purge_user(spammer), report)
+        self.assertEquals(spammer.topics.count(), 0)
+        self.assertEquals(spammer.posts.count(), 0)
+        self.assertEquals(Topic.objects.get(pk=1).post_count, 3)
+        self.assertEquals(ForumProfile.objects.get(pk=1).post_count, 54)
+        self.assertEquals(ForumProfile.objects.get(pk=3).post_count, 0)
+        self.assertConsistent()
+
 class ManagerTestCase(TestCase):
     """
     Tests for custom Manager methods which add extra data to retrieved
@@ -629,6 +1019,7 @@ class ManagerTestCase(TestCase):
 
     def test_post_manager_with_standalone_details(self):
         post = Post.objects.with_standalone_details().get(pk=1)
+        self.assertEquals(post.position, 1)
         forum_profile = ForumProfile.objects.get_for_user(post.user)
         topic = post.topic
         forum = topic.forum
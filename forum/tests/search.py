@@ -0,0 +1,746 @@
+import datetime
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import simplejson
+
+from forum import app_settings
+from forum.forms import SearchForm
+from forum.models import (Post, Search, SearchIndexEntry, SearchIndexQueueEntry,
+    Topic)
+from forum.search import (InvertedIndexBackend, SearchBackend,
+    SQLiteFTSBackend, make_snippet, parse_keywords, search_backend,
+    tokenize)
+from forum.search.usernames import UsernameIndex, trigrams
+from forum.utils.fields import PackedIds
+
+class KeywordParsingTestCase(TestCase):
+    """
+    Tests for search keyword parsing and tokenisation.
+    """
+    def test_tokenize(self):
+        """
+        Verifies that terms are lowercased and short terms are dropped.
+        """
+        self.assertEquals(tokenize(u'The quick, brown FOX is a dog.'),
+                          [u'the', u'quick', u'brown', u'fox', u'dog'])
+
+    def test_parse_keywords(self):
+        """
+        Verifies that keywords are split into required, excluded,
+        optional and phrase keywords.
+        """
+        required, excluded, one_of, phrases = \
+            parse_keywords(u'+spam -eggs ham "green eggs" bacon')
+        self.assertEquals(required, [u'spam'])
+        self.assertEquals(excluded, [u'eggs'])
+        self.assertEquals(one_of, [u'ham', u'bacon'])
+        self.assertEquals(phrases, [u'green eggs'])
+
+class SnippetTestCase(TestCase):
+    """
+    Tests for creation of search result snippets.
+    """
+    def test_make_snippet(self):
+        """
+        Verifies that snippets are escaped and highlight matching words.
+        """
+        self.assertEquals(make_snippet(u'Spam & <eggs>, spammy', set([u'spam'])),
+            u'<strong class="highlight">Spam</strong> &amp; &lt;eggs&gt;, '
+            u'<strong class="highlight">spammy</strong>')
+
+    def test_snippet_window(self):
+        """
+        Verifies that long text is cut down to a window around the first
+        matching word.
+        """
+        words = [u'word%s' % i for i in xrange(20)]
+        self.assertEquals(make_snippet(u' '.join(words), set([u'word10']), 6),
+            u'&hellip; word8 word9 <strong class="highlight">word10</strong> '
+            u'word11 word12 word13 &hellip;')
+        self.assertEquals(make_snippet(u' '.join(words), set([u'word18']), 6),
+            u'&hellip; word14 word15 word16 word17 '
+            u'<strong class="highlight">word18</strong> word19')
+        self.assertEquals(make_snippet(u' '.join(words), set([u'toast']), 3),
+            u'word0 word1 word2 &hellip;')
+
+class UsernameIndexTestCase(TestCase):
+    """
+    Tests for resolving partial usernames to User ids.
+    """
+    fixtures = ['testdata.json']
+
+    def setUp(self):
+        self.index = UsernameIndex(check_interval=0)
+
+    def test_trigrams(self):
+        """
+        Verifies that text is split into overlapping trigrams.
+        """
+        self.assertEquals(trigrams(u'admin'), set([u'adm', u'dmi', u'min']))
+        self.assertEquals(trigrams(u'ad'), set())
+
+    def test_user_ids(self):
+        """
+        Verifies that usernames are matched by case-insensitive substring.
+        """
+        self.assertEquals(self.index.user_ids(u'ADMIN'), set([1]))
+        self.assertEquals(self.index.user_ids(u'er'), set([2, 3]))
+        self.assertEquals(self.index.user_ids(u'rato'), set([2]))
+        self.assertEquals(self.index.user_ids(u'dmn'), set())
+
+    def test_updates(self):
+        """
+        Verifies that the index picks up new, renamed and deleted Users.
+        """
+        self.assertEquals(self.index.user_ids(u'user'), set([3]))
+        user = User.objects.create_user('superuser', 'superuser@example.com',
+                                        'password')
+        self.assertEquals(self.index.user_ids(u'user'), set([3, user.pk]))
+        user.username = 'renamed'
+        user.save()
+        self.assertEquals(self.index.user_ids(u'user'), set([3]))
+        self.assertEquals(self.index.user_ids(u'name'), set([user.pk]))
+        user.delete()
+        self.assertEquals(self.index.user_ids(u'name'), set())
+
+    def test_new_users_from_other_processes(self):
+        """
+        Verifies that Users created without the index being notified are
+        picked up.
+        """
+        self.index.user_ids(u'user')
+        self.index.max_id = None
+        User.objects.create_user('newuser', 'newuser@example.com', 'password')
+        self.index.max_id = 3
+        self.assertEquals(len(self.index.user_ids(u'user')), 2)
+
+    def test_check_interval(self):
+        """
+        Verifies that checks for new Users are rate-limited.
+        """
+        self.index.check_interval = 60
+        self.index.user_ids(u'user')
+        self.index.max_id = None
+        User.objects.create_user('newuser', 'newuser@example.com', 'password')
+        self.index.max_id = 3
+        self.assertEquals(len(self.index.user_ids(u'user')), 1)
+        self.index.checked_at -= 60
+        self.assertEquals(len(self.index.user_ids(u'user')), 2)
+
+    def test_reload(self):
+        """
+        Verifies that Users renamed or deleted without the index being
+        notified are picked up when it's loaded again.
+        """
+        self.assertEquals(self.index.user_ids(u'user'), set([3]))
+        User.objects.filter(pk=3).update(username='renamed')
+        User.objects.filter(pk=2).delete()
+        self.assertEquals(self.index.user_ids(u'user'), set([3]))
+        self.index.loaded_at -= self.index.reload_interval
+        self.assertEquals(self.index.user_ids(u'user'), set())
+        self.assertEquals(self.index.user_ids(u'name'), set([3]))
+        self.assertEquals(self.index.user_ids(u'rato'), set())
+
+class SearchResultsTestCase(TestCase):
+    """
+    Tests for storage of search result ids.
+    """
+    fixtures = ['testdata.json']
+
+    def test_packed_ids(self):
+        """
+        Verifies indexing and slicing of packed ids.
+        """
+        ids = PackedIds.from_ids([5, 70000, 3, 4294967295, 12])
+        self.assertEquals(len(ids), 5)
+        self.assertEquals(len(ids.data), 20)
+        self.assertEquals(ids[1], 70000)
+        self.assertEquals(ids[-2], 4294967295)
+        self.assertRaises(IndexError, lambda: ids[5])
+        self.assertEquals(ids[1:3], [70000, 3])
+        self.assertEquals(ids[3:10], [4294967295, 12])
+        self.assertEquals(ids[4:2], [])
+        self.assertEquals(list(ids), [5, 70000, 3, 4294967295, 12])
+        self.assertEquals(list(PackedIds()), [])
+
+    def test_result_ids(self):
+        """
+        Verifies that result ids are stored and retrieved in order.
+        """
+        search = Search.objects.create(type=Search.POST_SEARCH,
+            user=User.objects.get(pk=1), criteria_json='{}',
+            result_ids=[163, 2, 1000, 81])
+        search = Search.objects.get(pk=search.pk)
+        self.assertEquals(len(search.result_ids), 4)
+        self.assertEquals(search.result_ids[1:3], [2, 1000])
+        self.assertEquals(Search._meta.get_field('result_ids').value_to_string(search),
+                          u'163,2,1000,81')
+        search = Search.objects.create(type=Search.POST_SEARCH,
+            user=User.objects.get(pk=1), criteria_json='{}', result_ids=[])
+        self.assertEquals(len(Search.objects.get(pk=search.pk).result_ids), 0)
+
+class SearchReuseTestCase(TestCase):
+    """
+    Tests for reuse of the results of identical searches.
+    """
+    fixtures = ['testdata.json']
+
+    def setUp(self):
+        self.user = User.objects.get(pk=1)
+        self.other_user = User.objects.get(pk=2)
+
+    def form(self, **kwargs):
+        data = {
+            'search_type': Search.POST_SEARCH,
+            'keywords': 'Ham',
+            'post_type': SearchForm.SEARCH_ALL_POSTS,
+            'search_in': [SearchForm.SEARCH_ALL_FORUMS],
+            'search_from': SearchForm.SEARCH_ANY_DATE,
+            'search_when': SearchForm.SEARCH_OLDER,
+            'sort_by': SearchForm.SORT_BY_RELEVANCE,
+            'sort_direction': SearchForm.SORT_DESCENDING,
+        }
+        data.update(kwargs)
+        form = SearchForm(data)
+        self.assertTrue(form.is_valid())
+        return form
+
+    def search(self, user, **kwargs):
+        form = self.form(**kwargs)
+        criteria_hash = form.get_criteria_hash()
+        search = Search.objects.reuse(criteria_hash, user, '{}')
+        if search is None:
+            search = Search.objects.create(type=Search.POST_SEARCH, user=user,
+                criteria_json=simplejson.dumps(form.cleaned_data),
+                criteria_hash=criteria_hash, scope=form.get_search_scope(),
+                result_ids=[1, 2, 3])
+        return search
+
+    def test_criteria_hash(self):
+        """
+        Verifies that equivalent criteria produce the same hash.
+        """
+        criteria_hash = self.form().get_criteria_hash()
+        self.assertEquals(self.form(keywords=' ham  ').get_criteria_hash(),
+                          criteria_hash)
+        self.assertEquals(self.form(search_when=SearchForm.SEARCH_NEWER,
+                                    sort_direction=SearchForm.SORT_ASCENDING)
+                              .get_criteria_hash(), criteria_hash)
+        self.assertNotEquals(self.form(keywords='spam').get_criteria_hash(),
+                             criteria_hash)
+        self.assertNotEquals(self.form(sort_by=SearchForm.SORT_BY_DATE)
+                                 .get_criteria_hash(), criteria_hash)
+        self.assertEquals(self.form(search_in=['F.2', 'S.3']).get_criteria_hash(),
+                          self.form(search_in=['S.3', 'F.2']).get_criteria_hash())
+
+    def test_search_scope(self):
+        """
+        Verifies that a Search's scope contains everything searched in.
+        """
+        self.assertEquals(self.form().get_search_scope(), 'A')
+        self.assertEquals(self.form(search_in=[]).get_search_scope(), 'A')
+        self.assertEquals(self.form(search_in=['F.2']).get_search_scope(), 'F.2')
+        self.assertEquals(self.form(search_in=['S.1', 'F.2']).get_search_scope(),
+                          'S.1')
+        self.assertEquals(self.form(search_in=['F.2', 'F.3']).get_search_scope(),
+                          'S.1')
+        self.assertEquals(self.form(search_in=['S.2', 'F.9']).get_search_scope(),
+                          'A')
+
+    def test_reuse(self):
+        """
+        Verifies that a User's own Search is reused and that another
+        User's Search is copied.
+        """
+        search = self.search(self.user)
+        self.assertEquals(self.search(self.user).pk, search.pk)
+        copy = self.search(self.other_user)
+        self.assertNotEquals(copy.pk, search.pk)
+        self.assertEquals(copy.user_id, self.other_user.pk)
+        self.assertEquals(copy.searched_at, search.searched_at)
+        self.assertEquals(list(copy.result_ids), [1, 2, 3])
+        self.assertNotEquals(self.search(self.user, keywords='spam').pk,
+                             search.pk)
+
+    def test_timeout(self):
+        """
+        Verifies that Searches aren't reused once they have timed out.
+        """
+        search = self.search(self.user)
+        Search.objects.filter(pk=search.pk).update(
+            searched_at=datetime.datetime.now() - datetime.timedelta(
+                seconds=app_settings.SEARCH_REUSE_TIMEOUT + 1))
+        self.assertNotEquals(self.search(self.user).pk, search.pk)
+
+    def test_invalidation(self):
+        """
+        Verifies that new Posts prevent reuse of Searches which covered
+        their Forum.
+        """
+        all_forums = self.search(self.user)
+        section = self.search(self.user, search_in=['S.1'])
+        forum = self.search(self.user, search_in=['F.2'])
+        other = self.search(self.user, search_in=['S.2', 'F.9'])
+        other_section = self.search(self.user, search_in=['F.4', 'F.5'])
+        topic = Topic.objects.filter(forum=2)[0]
+        Post.objects.create(topic=topic, user=self.user, body='Ham.')
+        self.assertNotEquals(self.search(self.user).pk, all_forums.pk)
+        self.assertNotEquals(self.search(self.user, search_in=['S.1']).pk,
+                             section.pk)
+        self.assertNotEquals(self.search(self.user, search_in=['F.2']).pk,
+                             forum.pk)
+        # Searches across Sections are scoped to all Forums
+        self.assertNotEquals(self.search(self.user, search_in=['S.2', 'F.9']).pk,
+                             other.pk)
+        self.assertEquals(self.search(self.user, search_in=['F.4', 'F.5']).pk,
+                          other_section.pk)
+
+class SearchRetentionTestCase(TestCase):
+    """
+    Tests for purging of old Searches.
+    """
+    fixtures = ['testdata.json']
+
+    def setUp(self):
+        self.max_age = app_settings.SEARCH_MAX_AGE
+        self.max_per_user = app_settings.SEARCH_MAX_PER_USER
+        app_settings.SEARCH_MAX_AGE = 60 * 60
+        app_settings.SEARCH_MAX_PER_USER = 3
+        now = datetime.datetime.now()
+        self.searches = {}
+        for user_id, count, hours_ago in ((1, 5, 0), (2, 2, 0), (2, 4, 2)):
+            for i in xrange(count):
+                search = Search.objects.create(type=Search.POST_SEARCH,
+                    user_id=user_id, criteria_json='{}', result_ids=[1],
+                    searched_at=now - datetime.timedelta(hours=hours_ago,
+                                                         seconds=i))
+                self.searches.setdefault(user_id, []).append(search.pk)
+
+    def tearDown(self):
+        app_settings.SEARCH_MAX_AGE = self.max_age
+        app_settings.SEARCH_MAX_PER_USER = self.max_per_user
+
+    def remaining(self, user_id):
+        return sorted(Search.objects.filter(user=user_id) \
+                                    .values_list('id', flat=True))
+
+    def test_purge_expired(self):
+        """
+        Verifies that expired Searches are deleted in chunks.
+        """
+        self.assertEquals(Search.objects.purge_expired(chunk_size=3,
+                                                       max_chunks=1), 3)
+        self.assertEquals(Search.objects.purge_expired(chunk_size=3), 1)
+        self.assertEquals(self.remaining(2), self.searches[2][:2])
+        self.assertEquals(len(self.remaining(1)), 5)
+
+    def test_purge_user(self):
+        """
+        Verifies that only each User's most recent Searches are kept.
+        """
+        self.assertEquals(Search.objects.purge_user(1), 2)
+        self.assertEquals(self.remaining(1), self.searches[1][:3])
+        self.assertEquals(Search.objects.purge_user(1), 0)
+
+    def test_purge(self):
+        """
+        Verifies that the purge command applies the retention policy.
+        """
+        stdout = StringIO()
+        call_command('purge_searches', stdout=stdout)
+        self.assertEquals(stdout.getvalue(), 'Deleted 6 searches\n')
+        self.assertEquals(self.remaining(1), self.searches[1][:3])
+        self.assertEquals(self.remaining(2), self.searches[2][:2])
+
+    def test_sweep(self):
+        """
+        Verifies that sweeping performs a limited amount of purging.
+        """
+        self.assertEquals(Search.objects.sweep(User.objects.get(pk=2)), 4)
+        self.assertEquals(len(self.remaining(1)), 5)
+
+class SearchExecutionTestCase(TestCase):
+    """
+    Tests for performing searches in chunks within a budget.
+    """
+    fixtures = ['testdata.json']
+
+    def setUp(self):
+        self.settings = dict([(name, getattr(app_settings, name)) for name in
+            ('SEARCH_TIME_LIMIT', 'SEARCH_ROW_LIMIT', 'SEARCH_SCAN_CHUNK_SIZE',
+             'SEARCH_RANK_CANDIDATES')])
+        app_settings.SEARCH_SCAN_CHUNK_SIZE = 10
+        # Ensure fixture data is indexed by the configured backend
+        search_backend.rebuild()
+        self.metapost_ids = list(Post.objects.filter(body__icontains='metapost') \
+            .order_by('-posted_at', '-id').values_list('id', flat=True))
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            setattr(app_settings, name, value)
+
+    def search(self, limit=1000, **kwargs):
+        data = {
+            'search_type': Search.POST_SEARCH,
+            'keywords': 'metapost',
+            'post_type': SearchForm.SEARCH_ALL_POSTS,
+            'search_in': [SearchForm.SEARCH_ALL_FORUMS],
+            'search_from': SearchForm.SEARCH_ANY_DATE,
+            'search_when': SearchForm.SEARCH_OLDER,
+            'sort_by': SearchForm.SORT_BY_DATE,
+            'sort_direction': SearchForm.SORT_DESCENDING,
+        }
+        data.update(kwargs)
+        form = SearchForm(data)
+        self.assertTrue(form.is_valid())
+        return form.perform_search(limit)
+
+    def test_complete(self):
+        """
+        Verifies that all chunks are searched when there is no budget.
+        """
+        self.assertEquals(self.search(), (self.metapost_ids, False))
+        self.assertEquals(self.search(
+            sort_direction=SearchForm.SORT_ASCENDING),
+            (list(reversed(self.metapost_ids)), False))
+        result_ids, partial = self.search(sort_by=SearchForm.SORT_BY_RELEVANCE)
+        self.assertEquals(sorted(result_ids), sorted(self.metapost_ids))
+        self.assertFalse(partial)
+
+    def test_limit(self):
+        """
+        Verifies that searching stops once enough results have been found.
+        """
+        self.assertEquals(self.search(limit=5), (self.metapost_ids[:5], False))
+
+    def test_row_limit(self):
+        """
+        Verifies that results are partial when the row budget runs out.
+        """
+        app_settings.SEARCH_ROW_LIMIT = 20
+        self.assertEquals(self.search(), (self.metapost_ids[:20], True))
+
+    def test_time_limit(self):
+        """
+        Verifies that results are partial when the time budget runs out,
+        but that the first chunk is always searched.
+        """
+        app_settings.SEARCH_TIME_LIMIT = -1
+        max_id = Post.objects.order_by('-id')[0].pk
+        self.assertEquals(self.search(),
+            ([post_id for post_id in self.metapost_ids if post_id > max_id - 10],
+             True))
+
+    def test_chunks_are_id_ranges(self):
+        """
+        Verifies that chunks are ranges of ids rather than runs of
+        matching items, so each chunk examines a bounded number of rows.
+        """
+        app_settings.SEARCH_TIME_LIMIT = -1
+        app_settings.SEARCH_SCAN_CHUNK_SIZE = 1
+        max_id = Post.objects.order_by('-id')[0].pk
+        self.assertEquals(self.search(),
+            (max_id in self.metapost_ids and [max_id] or [], True))
+
+    def test_rank_candidates(self):
+        """
+        Verifies that no more candidates than are ranked are fetched when
+        sorting by relevance.
+        """
+        app_settings.SEARCH_RANK_CANDIDATES = 3
+        result_ids, partial = self.search(sort_by=SearchForm.SORT_BY_RELEVANCE)
+        self.assertEquals(sorted(result_ids), sorted(self.metapost_ids[:3]))
+        self.assertFalse(partial)
+
+class RankingTestCase(TestCase):
+    """
+    Tests for relevance ranking of search results.
+    """
+    fixtures = ['testdata.json']
+
+    def setUp(self):
+        self.backend = SearchBackend()
+        user = User.objects.get(pk=1)
+        topic = Topic.objects.create(forum_id=1, user=user, title='Breakfast')
+        self.posts = dict([(name, Post.objects.create(topic=topic, user=user,
+                                                      body=body))
+            for name, body in (
+                ('once', 'Spam, followed by a very long list of other '
+                         'things which are not relevant at all.'),
+                ('twice', 'Spam and more spam.'),
+                ('both', 'Spam with eggs.'),
+                ('neither', 'Toast.'))])
+
+    def rank(self, keywords, queryset=None, limit=10):
+        if queryset is None:
+            queryset = Post.objects.filter(
+                pk__in=[post.pk for post in self.posts.values()])
+        ids = self.backend.rank_items(
+            self.backend.filter_queryset(queryset, Search.POST_SEARCH, keywords) \
+                .order_by('-posted_at', '-id').values_list('id', 'body',
+                                                           'posted_at'),
+            keywords, limit)
+        names = dict([(post.pk, name) for name, post in self.posts.items()])
+        return [names[id] for id in ids]
+
+    def test_term_frequency(self):
+        """
+        Verifies that items with more occurrences of a term in less text
+        are ranked higher.
+        """
+        self.assertEquals(self.rank(u'spam'), ['twice', 'both', 'once'])
+
+    def test_term_rarity(self):
+        """
+        Verifies that items matching rarer terms are ranked higher.
+        """
+        self.assertEquals(self.rank(u'spam eggs')[0], 'both')
+        self.assertEquals(self.rank(u'spam -eggs'), ['twice', 'once'])
+
+    def test_limit(self):
+        """
+        Verifies that only the top ranked items are returned.
+        """
+        self.assertEquals(self.rank(u'spam', limit=2), ['twice', 'both'])
+
+    def test_recency_boost(self):
+        """
+        Verifies that recent items are ranked above older items of similar
+        relevance.
+        """
+        Post.objects.filter(pk=self.posts['twice'].pk).update(
+            posted_at=datetime.datetime.now() - datetime.timedelta(days=365))
+        self.assertEquals(self.rank(u'spam'), ['both', 'twice', 'once'])
+        self.assertAlmostEquals(
+            self.backend.recency_boost(datetime.timedelta(days=30)),
+            self.backend.recency_boost(datetime.timedelta(0)) / 2)
+
+class IndexedSearchBackendTests(object):
+    """
+    Tests common to search backends which maintain an index.
+    """
+    fixtures = ['testdata.json']
+    backend_class = None
+
+    def setUp(self):
+        self.backend = self.backend_class()
+        user = User.objects.get(pk=1)
+        self.topic = Topic.objects.create(forum_id=1, user=user,
+                                          title='Breakfast Ideas')
+        self.posts = [Post.objects.create(topic=self.topic, user=user, body=body)
+                      for body in ('Green eggs and ham.',
+                                   'Ham, spam and more spam.',
+                                   'Eggs are green sometimes.')]
+        for post in self.posts:
+            self.backend.update_post(post)
+        self.backend.update_topic(self.topic)
+        self.backend.flush()
+
+    def search(self, keywords, search_type=Search.POST_SEARCH):
+        model = {Search.POST_SEARCH: Post, Search.TOPIC_SEARCH: Topic}[search_type]
+        qs = self.backend.filter_queryset(model.objects.all(), search_type,
+                                          keywords)
+        return sorted([item.pk for item in qs])
+
+    def test_keywords(self):
+        """
+        Verifies optional, required and excluded keyword searches.
+        """
+        green, spam, sometimes = [p.pk for p in self.posts]
+        self.assertEquals(self.search(u'ham'), [green, spam])
+        self.assertEquals(self.search(u'SPAM eggs'), [green, spam, sometimes])
+        self.assertEquals(self.search(u'+eggs +ham'), [green])
+        self.assertEquals(self.search(u'ham -spam'), [green])
+        self.assertEquals(self.search(u'breakfast', Search.TOPIC_SEARCH),
+                          [self.topic.pk])
+
+    def test_phrases(self):
+        """
+        Verifies that phrases only match where the terms are adjacent.
+        """
+        self.assertEquals(self.search(u'"green eggs"'), [self.posts[0].pk])
+        self.assertEquals(self.search(u'"eggs green"'), [])
+
+    def test_snippets(self):
+        """
+        Verifies that snippets highlight the search keywords.
+        """
+        green, spam, sometimes = [p.pk for p in self.posts]
+        self.assertEquals(self.backend.get_snippets(Search.POST_SEARCH,
+                                                    [green, spam], u'ham -toast'),
+            {green: u'Green eggs and <strong class="highlight">ham</strong>.',
+             spam: u'<strong class="highlight">Ham</strong>, spam and more spam.'})
+
+    def test_remove_posts(self):
+        """
+        Verifies that deleted items are removed from the index.
+        """
+        self.backend.remove_posts([self.posts[0].pk])
+        self.backend.flush()
+        self.assertEquals(self.search(u'ham'), [self.posts[1].pk])
+
+    def test_batching(self):
+        """
+        Verifies that changes are queued until changes to enough items
+        have been queued and that only the latest change to each item is
+        applied.
+        """
+        self.backend = self.backend_class(batch_size=3, max_delay=60)
+        backend = self.backend
+        post = self.posts[1]
+        post.body = 'Beans on toast.'
+        post.save()
+        backend.update_post(post)
+        backend.remove_posts([post.pk])
+        backend.update_post(post)
+        backend.request_finished()
+        self.assertEquals(SearchIndexQueueEntry.objects.count(), 3)
+        self.assertEquals(self.search(u'beans'), [])
+
+        backend.remove_posts([self.posts[0].pk, self.posts[2].pk])
+        backend.request_finished()
+        self.assertEquals(SearchIndexQueueEntry.objects.count(), 0)
+        self.assertEquals(self.search(u'beans'), [post.pk])
+        self.assertEquals(self.search(u'eggs'), [])
+        self.assertEquals(self.search(u'ham'), [])
+
+    def test_max_delay(self):
+        """
+        Verifies that changes queued by other processes, which may have
+        died, are applied once ``max_delay`` has passed.
+        """
+        post = self.posts[1]
+        post.body = 'Beans on toast.'
+        post.save()
+        self.backend_class().update_post(post)
+        self.backend = self.backend_class(batch_size=3, max_delay=60)
+        self.backend.request_finished()
+        self.assertEquals(self.search(u'beans'), [])
+        self.backend.max_delay = 0
+        self.backend.request_finished()
+        self.assertEquals(self.search(u'beans'), [post.pk])
+
+    def test_concurrent_flush(self):
+        """
+        Verifies that flushing succeeds when another process indexes some
+        of the same items between the removal and the insert.
+        """
+        other_backend = self.backend_class()
+        remove_from_index = self.backend.remove_from_index
+        def remove_and_race(search_type, object_ids):
+            remove_from_index(search_type, object_ids)
+            if len(object_ids) > 1:
+                other_backend.update_post(self.posts[0])
+                other_backend.flush()
+        self.backend.remove_from_index = remove_and_race
+        for post in self.posts:
+            post.body = post.body.replace('ham', 'toast')
+            post.save()
+            self.backend.update_post(post)
+        self.backend.flush()
+        green, spam, sometimes = [p.pk for p in self.posts]
+        self.assertEquals(self.search(u'toast'), [green])
+        self.assertEquals(self.search(u'ham'), [spam])
+        self.assertEquals(self.search(u'eggs'), [green, sometimes])
+
+    def test_rebuild(self):
+        """
+        Verifies that rebuilding the index indexes all existing items.
+        """
+        progress = []
+        self.backend.rebuild(chunk_size=50,
+            progress=lambda *args: progress.append(args))
+        self.assertEquals(progress[-1], (Search.TOPIC_SEARCH, 28, 28))
+        self.assertEquals(len([p for p in progress
+                               if p[0] == Search.POST_SEARCH]), 4)
+        self.assertEquals(self.search(u'ham'),
+                          [self.posts[0].pk, self.posts[1].pk])
+        self.assertEquals(len(self.search(u'metapost')), 81)
+
+class InvertedIndexBackendTestCase(IndexedSearchBackendTests, TestCase):
+    """
+    Tests for searching with the inverted index search backend.
+    """
+    backend_class = InvertedIndexBackend
+
+    def test_index_object(self):
+        """
+        Verifies that each distinct term in an item is indexed once.
+        """
+        self.assertEquals(
+            sorted(SearchIndexEntry.objects.filter(type=Search.POST_SEARCH,
+                object_id=self.posts[1].pk).values_list('term', flat=True)),
+            [u'and', u'ham', u'more', u'spam'])
+        self.assertEquals(list(SearchIndexEntry.objects.get(
+            type=Search.POST_SEARCH, object_id=self.posts[1].pk,
+            term=u'spam').positions), [1, 4])
+
+    def test_phrase_positions(self):
+        """
+        Verifies that phrases are matched using term positions, with short
+        words which aren't indexed still separating terms.
+        """
+        post = Post.objects.create(topic=self.topic, user=self.topic.user,
+                                   body='The cat in the hat.')
+        self.backend.update_post(post)
+        self.backend.flush()
+        self.assertEquals(SearchIndexEntry.objects.phrase_object_ids(
+            Search.POST_SEARCH, u'and more spam'), set([self.posts[1].pk]))
+        self.assertEquals(self.search(u'"cat in the hat"'), [post.pk])
+        self.assertEquals(self.search(u'"cat the hat"'), [])
+        self.assertEquals(self.search(u'"spam spam"'), [])
+        self.assertEquals(self.search(u'"spam and more spam"'),
+                          [self.posts[1].pk])
+
+    def test_phrase_short_words(self):
+        """
+        Verifies that short words in phrases, which aren't indexed, are
+        matched against the text itself.
+        """
+        post = Post.objects.create(topic=self.topic, user=self.topic.user,
+                                   body='The cat in the hat.')
+        self.backend.update_post(post)
+        self.backend.flush()
+        self.assertEquals(SearchIndexEntry.objects.phrase_object_ids(
+            Search.POST_SEARCH, u'cat on the hat'), set([post.pk]))
+        self.assertEquals(self.search(u'"cat on the hat"'), [])
+
+    def test_phrase_max_ids(self):
+        """
+        Verifies that no ids are returned for phrases whose rarest term
+        appears in too many items.
+        """
+        self.assertEquals(SearchIndexEntry.objects.phrase_object_ids(
+            Search.POST_SEARCH, u'green eggs', max_ids=1), None)
+        self.assertEquals(SearchIndexEntry.objects.phrase_object_ids(
+            Search.POST_SEARCH, u'green eggs', max_ids=2),
+            set([self.posts[0].pk]))
+        self.assertEquals(SearchIndexEntry.objects.phrase_object_ids(
+            Search.POST_SEARCH, u'green toast', max_ids=0), set())
+
+class SQLiteFTSBackendTestCase(IndexedSearchBackendTests, TestCase):
+    """
+    Tests for searching with the SQLite full-text search backend.
+    """
+    backend_class = SQLiteFTSBackend
+
+    @classmethod
+    def setUpClass(cls):
+        # Created outside any test's transaction, as creating tables
+        # commits it.
+        SQLiteFTSBackend().create_tables()
+
+    def test_match_expression(self):
+        """
+        Verifies translation of search keywords to FTS5 expressions.
+        """
+        self.assertEquals(
+            self.backend.get_match_expression(u'+spam ham eggs "green eggs" -toast'),
+            u'("spam" AND ("ham" OR "eggs") AND ("green eggs")) NOT ("toast")')
+        self.assertEquals(self.backend.get_match_expression(u'-toast'), None)
+        self.assertEquals(self.backend.get_match_expression(u'ham +!!!'), None)
+        self.assertEquals(self.backend.get_match_expression(u'-toast ham'),
+                          u'(("ham")) NOT ("toast")')
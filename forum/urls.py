@@ -24,6 +24,8 @@ urlpatterns = patterns('forum.views',
     url(r'^topic/(?P<topic_id>\d+)/last_post/$',         'redirect_to_last_post',    name='forum_redirect_to_last_post'),
     url(r'^topic/(?P<topic_id>\d+)/unread_post/$',       'redirect_to_unread_post',  name='forum_redirect_to_unread_post'),
     url(r'^topic/(?P<topic_id>\d+)/delete/$',            'delete_topic',             name='forum_delete_topic'),
+    url(r'^topic/(?P<topic_id>\d+)/move_posts/$',        'move_posts',               name='forum_move_posts'),
+    url(r'^topic/(?P<topic_id>\d+)/merge/$',             'merge_topic',              name='forum_merge_topic'),
     url(r'^topic/(?P<topic_id>\d+)/meta/$',              'topic_detail',             {'meta': True}, name='forum_topic_meta_detail'),
     url(r'^topic/(?P<topic_id>\d+)/meta/reply/$',        'add_reply',                {'meta': True}, name='forum_add_meta_reply'),
     url(r'^topic/(?P<topic_id>\d+)/summary/$',           'topic_post_summary',       name='forum_topic_post_summary'),
@@ -33,6 +35,7 @@ urlpatterns = patterns('forum.views',
     url(r'^post/(?P<post_id>\d+)/delete/$',              'delete_post',              name='forum_delete_post'),
     url(r'^user/(?P<user_id>\d+)/$',                     'user_profile',             name='forum_user_profile'),
     url(r'^user/(?P<user_id>\d+)/topics/$',              'user_topics',              name='forum_user_topics'),
+    url(r'^user/(?P<user_id>\d+)/purge/$',               'purge_user',               name='forum_purge_user'),
     url(r'^user/(?P<user_id>\d+)/edit_profile/$',        'edit_user_forum_profile',  name='forum_edit_user_forum_profile'),
     url(r'^user/edit_forum_settings/$',                  'edit_user_forum_settings', name='forum_edit_user_forum_settings'),
 )
@@ -0,0 +1,102 @@
+"""
+Custom model fields.
+"""
+import struct
+
+from django.db import models
+from django.utils.encoding import smart_unicode
+
+class PackedIds(object):
+    """
+    A read-only sequence of ids packed into a string of little-endian
+    unsigned 32-bit integers.
+
+    Ids are only unpacked when they are accessed, so taking a slice of a
+    large number of ids only unpacks the ids in the slice.
+    """
+    ID_SIZE = 4
+
+    def __init__(self, data=''):
+        self.data = data
+
+    @classmethod
+    def from_ids(cls, ids):
+        """
+        Creates a ``PackedIds`` from a sequence of integer ids.
+        """
+        ids = [int(id) for id in ids]
+        return cls(struct.pack('<%sI' % len(ids), *ids))
+
+    def __len__(self):
+        return len(self.data) // self.ID_SIZE
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if stop <= start:
+                return []
+            ids = struct.unpack('<%sI' % (stop - start),
+                self.data[start * self.ID_SIZE:stop * self.ID_SIZE])
+            return list(ids[::step])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('PackedIds index out of range')
+        return struct.unpack('<I',
+            self.data[index * self.ID_SIZE:(index + 1) * self.ID_SIZE])[0]
+
+    def __eq__(self, other):
+        return isinstance(other, PackedIds) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<PackedIds: %s ids>' % len(self)
+
+class PackedIdsField(models.Field):
+    """
+    Stores a sequence of ids as a ``PackedIds`` in a binary column, using
+    4 bytes per id.
+
+    Lists of integer ids may be assigned to the field, and are packed
+    on assignment.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('default', PackedIds)
+        super(PackedIdsField, self).__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        return {
+            'mysql': 'longblob',
+            'oracle': 'BLOB',
+            'postgresql': 'bytea',
+        }.get(connection.vendor, 'blob')
+
+    def to_python(self, value):
+        if isinstance(value, PackedIds):
+            return value
+        if value is None:
+            return PackedIds()
+        if isinstance(value, unicode):
+            # Serialised form, as created by value_to_string
+            return PackedIds.from_ids([id for id in value.split(',') if id])
+        if isinstance(value, (str, buffer)):
+            return PackedIds(str(value))
+        return PackedIds.from_ids(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        data = self.to_python(value).data
+        if connection.vendor == 'mysql':
+            return data
+        return buffer(data)
+
+    def value_to_string(self, obj):
+        return u','.join([smart_unicode(id)
+                          for id in self._get_val_from_obj(obj)])
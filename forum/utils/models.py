@@ -14,3 +14,25 @@ def update(model_instance, *args):
              connection.ops.quote_name(opts.pk.column)),
              db_values + opts.pk.get_db_prep_lookup('exact', model_instance.pk))
         transaction.commit_unless_managed()
+
+def increment(model_instance, amounts, *args):
+    """
+    Atomically adds amounts to counter fields of the given model instance,
+    given a dict mapping field names to amounts, also updating any other
+    specified fields, in a single query.
+    """
+    qn = connection.ops.quote_name
+    opts = model_instance._meta
+    counters = [(opts.get_field(f), amount) for f, amount in amounts.items()]
+    fields = [opts.get_field(f) for f in args]
+    db_values = [amount for f, amount in counters] + \
+                [f.get_db_prep_save(f.pre_save(model_instance, False)) for f in fields]
+    connection.cursor().execute("UPDATE %s SET %s WHERE %s=%%s" % \
+        (qn(opts.db_table),
+         ','.join(['%s=%s+%%s' % (qn(f.column), qn(f.column)) for f, amount in counters] +
+                  ['%s=%%s' % qn(f.column) for f in fields]),
+         qn(opts.pk.column)),
+         db_values + opts.pk.get_db_prep_lookup('exact', model_instance.pk))
+    for f, amount in counters:
+        setattr(model_instance, f.attname, getattr(model_instance, f.attname) + amount)
+    transaction.commit_unless_managed()
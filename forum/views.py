@@ -1,4 +1,5 @@
 import datetime
+import random
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
@@ -19,6 +20,7 @@ from forum import forms
 from forum import moderation
 from forum.formatters import post_formatter
 from forum.models import Forum, ForumProfile, Post, Search, Section, Topic
+from forum.search import search_backend
 
 if app_settings.USE_REDIS:
     from forum import redis_connection as redis
@@ -139,12 +141,26 @@ def search(request):
     if request.method == 'POST':
         form = forms.SearchForm(request.POST)
         if form.is_valid():
-            results = form.get_queryset().values('id')[:1000]
-            search = Search.objects.create(type=form.cleaned_data['search_type'],
-                user=request.user,
-                criteria_json=simplejson.dumps(form.cleaned_data),
-                result_ids=','.join([smart_unicode(result['id']) \
-                                      for result in results]))
+            criteria_json = simplejson.dumps(form.cleaned_data)
+            search = None
+            criteria_hash = scope = ''
+            if app_settings.SEARCH_REUSE_TIMEOUT:
+                criteria_hash = form.get_criteria_hash()
+                scope = form.get_search_scope()
+                search = Search.objects.reuse(criteria_hash, request.user,
+                                              criteria_json)
+            if search is None:
+                result_ids, partial = form.perform_search(1000)
+                search = Search.objects.create(
+                    type=form.cleaned_data['search_type'],
+                    user=request.user,
+                    criteria_json=criteria_json,
+                    criteria_hash=criteria_hash,
+                    scope=scope,
+                    result_ids=result_ids,
+                    partial=partial)
+            if random.random() < app_settings.SEARCH_SWEEP_CHANCE:
+                Search.objects.sweep(request.user)
             return HttpResponseRedirect(search.get_absolute_url())
     else:
         form = forms.SearchForm()
@@ -168,18 +184,29 @@ def search_results(request, search_id):
         items_per_page = get_posts_per_page(request.user)
     else:
         items_per_page = get_topics_per_page(request.user)
-    search_result_ids = []
-    if search.result_ids:
-        search_result_ids = search.result_ids.split(',')
-    paginator = Paginator(search_result_ids, items_per_page)
+    # Only the ids for the requested page are unpacked
+    paginator = Paginator(search.result_ids, items_per_page)
     page = get_page_or_404(request, paginator)
     model = search.get_result_model()
     model_name = capfirst(model._meta.verbose_name)
+    queryset = model.objects.with_standalone_details() \
+                            .filter(pk__in=page.object_list)
+    if search.type == Search.POST_SEARCH:
+        # Posts are displayed as snippets of their bodies instead
+        queryset = queryset.defer('body', 'body_html')
+    # Results are displayed in the order they were ranked in when the
+    # search was performed.
+    results = dict([(result.pk, result) for result in queryset])
+    if search.type == Search.POST_SEARCH:
+        snippets = search_backend.get_snippets(search.type, results.keys(),
+                                               search.get_keywords())
+        for result in results.values():
+            result.snippet = snippets.get(result.pk, u'')
     context = {
         'title': '%s Search Results' % model_name,
         'search': search,
-        'object_list': model.objects.with_standalone_details() \
-                             .filter(pk__in=page.object_list).order_by('id'),
+        'object_list': [results[result_id] for result_id in page.object_list
+                        if result_id in results],
         'object_name': model_name,
         'is_paginated': paginator.num_pages > 1,
         'has_next': page.has_next(),
@@ -500,7 +527,7 @@ def topic_detail(request, topic_id, meta=False):
             redis.seen_user(request.user, 'Viewing Topic:', topic)
     return object_list(request,
         Post.objects.with_user_details().filter(topic=topic, meta=meta) \
-                                         .order_by('posted_at', 'num_in_topic'),
+                                         .order_by('num_in_topic', 'id'),
         paginate_by=get_posts_per_page(request.user), allow_empty=True,
         template_name='forum/topic_detail.html',
         extra_context={
@@ -577,8 +604,7 @@ def delete_topic(request, topic_id):
     if not auth.is_moderator(request.user):
         filters['hidden'] = False
     topic = get_object_or_404(Topic, **filters)
-    post = Post.objects.with_user_details().get(topic=topic, meta=False,
-                                                num_in_topic=1)
+    post = Post.objects.with_user_details().get(pk=topic.get_first_post().pk)
     if not auth.user_can_edit_topic(request.user, topic):
         return permission_denied(request,
             message='You do not have permission to delete this topic.')
@@ -713,6 +739,64 @@ def add_reply(request, topic_id, meta=False, quote_post=None):
         'quick_help_template': post_formatter.QUICK_HELP_TEMPLATE,
     })
 
+@login_required
+@transaction.commit_on_success
+def move_posts(request, topic_id):
+    """
+    Moves selected Posts from a Topic to another Topic.
+    """
+    topic = get_object_or_404(Topic, pk=topic_id)
+    if not auth.is_moderator(request.user):
+        return permission_denied(request,
+            message='You do not have permission to move posts.')
+    forum = Forum.objects.select_related().get(pk=topic.forum_id)
+    if app_settings.USE_REDIS:
+        redis.seen_user(request.user, 'Moving posts in:', topic)
+    if request.method == 'POST':
+        form = forms.MovePostsForm(topic, request.POST)
+        if form.is_valid():
+            to_topic = form.cleaned_data['topic']
+            moderation.move_posts(form.cleaned_data['posts'], to_topic)
+            return HttpResponseRedirect(to_topic.get_absolute_url())
+    else:
+        form = forms.MovePostsForm(topic)
+    return render(request, 'forum/move_posts.html', {
+        'topic': topic,
+        'form': form,
+        'section': forum.section,
+        'forum': forum,
+        'title': 'Move Posts',
+    })
+
+@login_required
+@transaction.commit_on_success
+def merge_topic(request, topic_id):
+    """
+    Moves all of a Topic's Posts to another Topic and deletes it.
+    """
+    topic = get_object_or_404(Topic, pk=topic_id)
+    if not auth.is_moderator(request.user):
+        return permission_denied(request,
+            message='You do not have permission to merge topics.')
+    forum = Forum.objects.select_related().get(pk=topic.forum_id)
+    if app_settings.USE_REDIS:
+        redis.seen_user(request.user, 'Merging Topic:', topic)
+    if request.method == 'POST':
+        form = forms.MoveToTopicForm(topic, request.POST)
+        if form.is_valid():
+            to_topic = form.cleaned_data['topic']
+            moderation.merge_topics([topic], to_topic)
+            return HttpResponseRedirect(to_topic.get_absolute_url())
+    else:
+        form = forms.MoveToTopicForm(topic)
+    return render(request, 'forum/merge_topic.html', {
+        'topic': topic,
+        'form': form,
+        'section': forum.section,
+        'forum': forum,
+        'title': 'Merge Topic',
+    })
+
 @login_required
 def quote_post(request, post_id):
     """
@@ -726,7 +810,8 @@ def redirect_to_post(request, post_id, post=None):
     Redirects to the appropriate Topic page containing the given Post.
 
     If the Post itself is also given it will not be looked up, saving a
-    database query.
+    database query. The Post's position in its Topic is counted to
+    determine the page, unless it was already looked up.
     """
     if post is None:
         filters = {'pk': post_id}
@@ -735,8 +820,9 @@ def redirect_to_post(request, post_id, post=None):
             filters['topic__hidden'] = False
         post = get_object_or_404(Post, **filters)
     posts_per_page = get_posts_per_page(request.user)
-    page, remainder = divmod(post.num_in_topic, posts_per_page)
-    if post.num_in_topic < posts_per_page or remainder != 0:
+    position = post.get_position()
+    page, remainder = divmod(position, posts_per_page)
+    if position < posts_per_page or remainder != 0:
         page += 1
     url_name = post.meta and 'forum_topic_meta_detail' or 'forum_topic_detail'
     return HttpResponseRedirect('%s?page=%s&#post%s' \
@@ -852,7 +938,7 @@ def delete_post(request, post_id):
     if not auth.user_can_edit_post(request.user, post, topic):
         return permission_denied(request,
             message='You do not have permission to delete this post.')
-    if post.num_in_topic == 1 and not post.meta:
+    if not post.meta and post.pk == topic.get_first_post().pk:
         return delete_topic(request, post.topic_id)
     if app_settings.USE_REDIS:
         redis.seen_user(request.user, 'Deleting a post in:', topic)
@@ -900,6 +986,30 @@ def user_profile(request, user_id):
             redis.seen_user(request.user, 'Viewing user profile:', forum_user)
     return render(request, 'forum/user_profile.html', context)
 
+@login_required
+@transaction.commit_on_success
+def purge_user(request, user_id):
+    """
+    Deletes all Topics started by and Posts made by a User after
+    confirmation is made via POST, reporting what will be deleted and
+    updated beforehand.
+    """
+    forum_user = get_object_or_404(User, pk=user_id)
+    if not auth.is_moderator(request.user) or auth.is_moderator(forum_user):
+        return permission_denied(request,
+            message='You do not have permission to purge this user.')
+    if app_settings.USE_REDIS:
+        redis.seen_user(request.user, 'Purging user:', forum_user)
+    if request.method == 'POST':
+        moderation.purge_user(forum_user)
+        return HttpResponseRedirect(reverse('forum_user_profile',
+                                            args=(smart_unicode(forum_user.pk),)))
+    return render(request, 'forum/purge_user.html', {
+        'forum_user': forum_user,
+        'report': moderation.purge_user(forum_user, dry_run=True),
+        'title': 'Purge %s' % forum_user,
+    })
+
 def user_topics(request, user_id):
     """
     Displays Topics created by a given User.